@@ -0,0 +1,394 @@
+import datetime
+import argparse
+import logging
+import shutil
+import utils
+import time
+import os
+
+try:
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    import pyarrow as pa
+except ImportError:
+    pa = pc = pq = None
+
+logger = logging.getLogger('banking_archive')
+
+'''
+Cold transaction archiver
+
+Moves whole months of Transactions older than the horizon into zstd
+compressed Parquet files, one directory per month and one file per
+account_id range:
+
+    archive/2025-03/accounts_0000000000_0000099999.parquet
+
+Every transaction is written once per account it touches, under that
+account's range, so reading one account opens one file per month. Files
+are sorted by account_id and tx_time, which lets Parquet skip row groups
+of other accounts.
+
+A month is copied, deleted from Transactions and registered in
+ArchivedMonths in one REPEATABLE READ transaction, so the rows deleted
+are exactly the rows written. Readers only trust registered months, so
+files left behind by a failed run are never read and are overwritten by
+the next one. Rows that land in an archived month later stay in
+Transactions and are read from there.
+
+Usage:
+    python archive.py --horizon-days 365 --output archive
+'''
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_HORIZON_DAYS = int(os.getenv("ARCHIVE_HORIZON_DAYS", "365"))
+
+# Rows fetched per round trip from the server-side cursor
+FETCH_SIZE = 50000
+
+COLUMNS = ["account_id", "tx_time", "tx_id", "type_id", "from_user_id", "from_account_id",
+           "to_user_id", "to_account_id", "amount", "currency_id"]
+
+_MONTH_ROWS = """
+    SELECT account_id, tx_time, tx_id, type_id, from_user_id, from_account_id,
+           to_user_id, to_account_id, amount, currency_id FROM (
+        SELECT to_account_id AS account_id, tx_time, tx_id::text, type_id, from_user_id, from_account_id,
+               to_user_id, to_account_id, amount, currency_id
+        FROM Transactions
+        WHERE to_account_id IS NOT NULL AND tx_time >= %(start)s AND tx_time < %(end)s
+        UNION ALL
+        SELECT from_account_id, tx_time, tx_id::text, type_id, from_user_id, from_account_id,
+               to_user_id, to_account_id, amount, currency_id
+        FROM Transactions
+        WHERE from_account_id IS NOT NULL AND tx_time >= %(start)s AND tx_time < %(end)s) tx
+    ORDER BY account_id, tx_time"""
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("pyarrow is required to read or write the transaction archive: pip install pyarrow")
+
+
+def _schema():
+    return pa.schema([
+        ("account_id", pa.int32()),
+        ("tx_time", pa.timestamp("us")),
+        ("tx_id", pa.string()),
+        ("type_id", pa.int16()),
+        ("from_user_id", pa.int32()),
+        ("from_account_id", pa.int32()),
+        ("to_user_id", pa.int32()),
+        ("to_account_id", pa.int32()),
+        ("amount", pa.int64()),
+        ("currency_id", pa.int16()),
+    ])
+
+
+def _as_datetime(value):
+    '''Dates are taken as their first moment'''
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.combine(value, datetime.time())
+
+
+def _next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def range_path(month_dir, account_id, range_size):
+    '''Gets the file holding account_id's rows in a month's directory'''
+    first = account_id // range_size * range_size
+    return os.path.join(month_dir, f"accounts_{first:010d}_{first + range_size - 1:010d}.parquet")
+
+
+def archived_months(cur):
+    '''
+    Gets the registered archive months
+
+    Returns:
+        List of (month, path, range_size) ordered by month
+    '''
+    cur.execute("SELECT month, path, range_size FROM ArchivedMonths ORDER BY month")
+    return cur.fetchall()
+
+
+def account_rows(cur, account_id, start=None, end=None):
+    '''
+    Reads an account's archived transactions
+
+    Args:
+        cur: Cursor used to look up the archived months
+        account_id: Account to read
+        start: Earliest tx_time to include. Dates are taken as their first moment
+        end: tx_time to stop before
+
+    Returns:
+        List of (tx_time, tx_id, type_id, from_user_id, from_account_id,
+        to_user_id, to_account_id, amount, currency_id) ordered by tx_time
+    '''
+    start, end = _as_datetime(start), _as_datetime(end)
+    months = _months_between(cur, start, end)
+
+    if not months:
+        return []
+
+    _require_pyarrow()
+    filters = [("account_id", "=", account_id)]
+    if start is not None:
+        filters.append(("tx_time", ">=", start))
+    if end is not None:
+        filters.append(("tx_time", "<", end))
+
+    rows = []
+    for _, path, range_size in months:
+        file_path = range_path(path, account_id, range_size)
+        if not os.path.exists(file_path):
+            continue
+
+        table = pq.read_table(file_path, columns=COLUMNS[1:], filters=filters)
+        rows.extend(zip(*(table.column(name).to_pylist() for name in COLUMNS[1:])))
+
+    logger.info(f"Read {len(rows)} archived transactions of account {account_id} from {len(months)} months")
+    return rows
+
+
+def _months_between(cur, start, end):
+    '''Gets the registered months that overlap start..end'''
+    start, end = _as_datetime(start), _as_datetime(end)
+    return [(month, path, range_size) for month, path, range_size in archived_months(cur)
+            if (end is None or _as_datetime(month) < end)
+            and (start is None or _as_datetime(_next_month(month)) > start)]
+
+
+def _range_table(cur, first_id, last_id, columns, start=None, end=None):
+    '''Reads the archived rows of accounts first_id..last_id between start and end as one Table'''
+    months = _months_between(cur, start, end)
+    if not months:
+        return None
+
+    _require_pyarrow()
+    filters = [("account_id", ">=", first_id), ("account_id", "<=", last_id)]
+    if start is not None:
+        filters.append(("tx_time", ">=", _as_datetime(start)))
+    if end is not None:
+        filters.append(("tx_time", "<", _as_datetime(end)))
+
+    tables = [pq.read_table(path, columns=columns, filters=filters) for _, path, _ in months if os.path.isdir(path)]
+    return pa.concat_tables(tables) if tables else None
+
+
+def account_flows(cur, first_id, last_id, before=None):
+    '''
+    Reads the archived flows of accounts first_id..last_id
+
+    Args:
+        cur: Cursor used to look up the archived months
+        first_id: First account_id of the range
+        last_id: Last account_id of the range
+        before: tx_time to stop before. Reads every archived month when not given
+
+    Returns:
+        Tuple of NumPy arrays (account_id, amount), the amount signed from
+        the account's side. Empty when nothing is archived
+    '''
+    table = _range_table(cur, first_id, last_id, ["account_id", "to_account_id", "amount"], end=before)
+    if table is None:
+        return (), ()
+
+    credit = pc.fill_null(pc.equal(table["to_account_id"], table["account_id"]), False)
+    amount = pc.if_else(credit, table["amount"], pc.negate(table["amount"]))
+    return table["account_id"].to_numpy(), amount.to_numpy()
+
+
+def range_rows(cur, first_id, last_id, start, end):
+    '''
+    Reads the archived transactions of accounts first_id..last_id in a period
+
+    Args:
+        cur: Cursor used to look up the archived months
+        first_id: First account_id of the range
+        last_id: Last account_id of the range
+        start: Earliest tx_time to include
+        end: tx_time to stop before
+
+    Returns:
+        List of (account_id, tx_time, type_id, from_user_id, from_account_id,
+        to_user_id, to_account_id, amount) ordered by account_id and tx_time,
+        the amount signed from the account's side
+    '''
+    columns = ["account_id", "tx_time", "type_id", "from_user_id", "from_account_id", "to_user_id",
+               "to_account_id", "amount"]
+    table = _range_table(cur, first_id, last_id, columns, start, end)
+    if table is None:
+        return []
+
+    table = table.sort_by([("account_id", "ascending"), ("tx_time", "ascending")])
+    rows = zip(*(table.column(name).to_pylist() for name in columns))
+    return [(*row[:7], row[7] if row[6] == row[0] else -row[7]) for row in rows]
+
+
+def details(rows):
+    '''
+    Names the type and currency of archived rows
+
+    Returns:
+        List of rows shaped like the TransactionDetails view
+    '''
+    if rows and utils.currency_ids is None:
+        utils.load_currency_table()
+    codes = {currency_id: code for code, currency_id in (utils.currency_ids or {}).items()}
+
+    return [(tx_time, tx_id, utils.TX_TYPE_NAMES.get(type_id, type_id), from_user_id, from_account_id,
+             to_user_id, to_account_id, amount, codes.get(currency_id, currency_id))
+            for tx_time, tx_id, type_id, from_user_id, from_account_id, to_user_id, to_account_id, amount, currency_id
+            in rows]
+
+
+def _write_month(cur, month_dir, range_size):
+    '''Streams the month's rows into one Parquet file per account range'''
+    schema = _schema()
+    writer = None
+    writer_range = None
+    rows_written = 0
+
+    try:
+        while True:
+            batch = cur.fetchmany(FETCH_SIZE)
+            if not batch:
+                break
+
+            # The stream is ordered by account_id, so each range's rows arrive together
+            start = 0
+            while start < len(batch):
+                account_range = batch[start][0] // range_size
+                stop = start
+                while stop < len(batch) and batch[stop][0] // range_size == account_range:
+                    stop += 1
+
+                if account_range != writer_range:
+                    if writer:
+                        writer.close()
+                    writer = pq.ParquetWriter(range_path(month_dir, batch[start][0], range_size),
+                                              schema, compression="zstd")
+                    writer_range = account_range
+
+                columns = list(zip(*batch[start:stop]))
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+                rows_written += stop - start
+                start = stop
+    finally:
+        if writer:
+            writer.close()
+
+    return rows_written
+
+
+def archive_month(month, output_dir=ARCHIVE_DIR, range_size=100000):
+    '''
+    Moves one month of Transactions into the archive
+
+    Args:
+        month: First day of the month
+        output_dir: Archive root directory
+        range_size: account_ids per file
+
+    Returns:
+        Dictionary with the month, transactions moved and archive rows written
+    '''
+    _require_pyarrow()
+    start = _as_datetime(month)
+    end = _as_datetime(_next_month(month))
+    month_dir = os.path.abspath(os.path.join(output_dir, month.strftime("%Y-%m")))
+    tmp_dir = month_dir + ".part"
+
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    conn = utils.open_connection()
+
+    try:
+        with conn.cursor() as cur:
+            # The copy and the delete see the same snapshot
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+        with conn.cursor(name=f"archive_{month:%Y%m}") as cur:
+            cur.itersize = FETCH_SIZE
+            cur.execute(_MONTH_ROWS, {"start": start, "end": end})
+            rows_written = _write_month(cur, tmp_dir, range_size)
+
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM Transactions WHERE tx_time >= %s AND tx_time < %s", (start, end))
+            moved = cur.rowcount
+
+            cur.execute("INSERT INTO ArchivedMonths (month, path, range_size, transactions) VALUES (%s, %s, %s, %s)",
+                        (month, month_dir, range_size, moved))
+
+        # Unregistered until the commit, so readers never see a half moved month
+        shutil.rmtree(month_dir, ignore_errors=True)
+        os.replace(tmp_dir, month_dir)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        logger.error(f"Failed to archive {month:%Y-%m}: {e}")
+        raise
+    finally:
+        conn.close()
+
+    result = {"month": month.strftime("%Y-%m"), "transactions": moved, "archive_rows": rows_written}
+    logger.info(f"Archived {result}")
+    return result
+
+
+def archive(horizon_days=ARCHIVE_HORIZON_DAYS, output_dir=ARCHIVE_DIR, range_size=100000, now=None):
+    '''
+    Archives every whole month that ended before the horizon
+
+    Args:
+        horizon_days: Age in days past which transactions are cold
+        output_dir: Archive root directory
+        range_size: account_ids per file. Kept per month, so it can change between runs
+        now: Reference time for the horizon. Defaults to now
+
+    Returns:
+        Dictionary with the months archived, transactions moved and seconds taken
+    '''
+    cutoff = (now or datetime.datetime.now()) - datetime.timedelta(days=horizon_days)
+    conn = utils.connect_to_db()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT MIN(tx_time) FROM Transactions")
+            oldest = cur.fetchone()[0]
+            done = {month for month, _, _ in archived_months(cur)}
+        conn.commit()
+    finally:
+        utils.release_conn(conn)
+
+    started = time.perf_counter()
+    result = {"months": [], "transactions": 0}
+    month = oldest.date().replace(day=1) if oldest else None
+
+    while month and _as_datetime(_next_month(month)) <= cutoff:
+        if month not in done:
+            archived = archive_month(month, output_dir, range_size)
+            result["months"].append(archived["month"])
+            result["transactions"] += archived["transactions"]
+        month = _next_month(month)
+
+    result["seconds"] = round(time.perf_counter() - started, 2)
+    logger.info(f"Archive run up to {cutoff}: {result}")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move cold transactions into compressed Parquet files")
+    parser.add_argument("--horizon-days", type=int, default=ARCHIVE_HORIZON_DAYS)
+    parser.add_argument("--output", default=ARCHIVE_DIR)
+    parser.add_argument("--range-size", type=int, default=100000)
+    args = parser.parse_args()
+
+    utils.create_tables()
+    print(archive(args.horizon_days, args.output, args.range_size))
+
+# Godspeed
@@ -0,0 +1,106 @@
+import statistics
+import tempfile
+import argparse
+import logging
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+
+'''
+Benchmark: per-operation logging overhead
+
+Compares the old synchronous basicConfig file handler with the queue-based
+JSON pipeline in utils. Each simulated operation logs two INFO lines, like
+users.deposit does.
+
+Usage:
+    python benchmarks/bench_logging.py --ops 100000 --fsync
+'''
+
+
+class FsyncFileHandler(logging.FileHandler):
+    '''File handler that waits for the disk on every record, to show slow storage'''
+
+    def emit(self, record):
+        super().emit(record)
+        os.fsync(self.stream.fileno())
+
+
+def _reset_root():
+    '''Removes all handlers and returns the number of records the queue handler dropped'''
+    utils.stop_logging()
+    root = logging.getLogger()
+    dropped = 0
+
+    for handler in list(root.handlers):
+        dropped += getattr(handler, "dropped", 0)
+        root.removeHandler(handler)
+        handler.close()
+    return dropped
+
+
+def _run_ops(ops):
+    '''Runs the simulated operations and returns per-operation latencies in microseconds'''
+    logger = logging.getLogger('banking_users')
+    latencies = []
+
+    for i in range(ops):
+        started = time.perf_counter()
+        logger.info(f"Fetched account {i} from Database")
+        logger.info("Deposit successful")
+        latencies.append((time.perf_counter() - started) * 1e6)
+
+    return latencies
+
+
+def _report(name, result):
+    latencies, dropped = result
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"{name:<28} mean {statistics.mean(latencies):8.2f} us   p50 {statistics.median(latencies):8.2f} us   "
+          f"p99 {p99:8.2f} us   dropped {dropped}")
+
+
+def bench_sync(path, ops, fsync):
+    '''Old setup: basicConfig style formatter writing in the calling thread'''
+    _reset_root()
+    handler = FsyncFileHandler(path) if fsync else logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.INFO)
+
+    latencies = _run_ops(ops)
+    return latencies, _reset_root()
+
+
+def bench_async(path, ops, fsync, sample_rates, queue_size):
+    '''New setup: utils.setup_logging queue pipeline'''
+    _reset_root()
+    utils.setup_logging(filename=path, sample_rates=sample_rates, queue_size=queue_size)
+
+    if fsync:
+        for handler in utils.log_listener.handlers:
+            handler.__class__ = FsyncFileHandler
+
+    latencies = _run_ops(ops)
+    return latencies, _reset_root()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark logging overhead per operation")
+    parser.add_argument("--ops", type=int, default=50000)
+    parser.add_argument("--fsync", action="store_true", help="fsync every record to simulate slow disks")
+    parser.add_argument("--sample", type=float, default=0.1, help="sample rate for banking_users INFO records")
+    parser.add_argument("--queue-size", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _report("sync basicConfig", bench_sync(os.path.join(tmp, "sync.log"), args.ops, args.fsync))
+        _report("async queue", bench_async(os.path.join(tmp, "async.log"), args.ops, args.fsync,
+                                           {}, args.queue_size))
+        _report(f"async queue, sampled {args.sample}", bench_async(os.path.join(tmp, "sampled.log"), args.ops,
+                                                                args.fsync, {"banking_users": args.sample},
+                                                                args.queue_size))
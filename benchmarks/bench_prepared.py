@@ -0,0 +1,93 @@
+import statistics
+import argparse
+import datetime
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+
+'''
+Benchmark: statement latency with and without server-side prepared statements
+
+Runs each hot statement in utils.PREPARED_STATEMENTS against a real account,
+first as plain text then through utils.execute_prepared. Writes are rolled
+back so the database is left unchanged.
+
+Usage:
+    python benchmarks/bench_prepared.py --iterations 5000
+'''
+
+
+def _account(cur, account_id):
+    if account_id:
+        cur.execute("SELECT user_id, account_id, balance, currency_id FROM Accounts WHERE account_id = %s", (account_id,))
+    else:
+        cur.execute("SELECT user_id, account_id, balance, currency_id FROM Accounts ORDER BY account_id LIMIT 1")
+    return cur.fetchone()
+
+
+def _params(name, account):
+    user_id, account_id, _, currency_id = account
+
+    if name == "account_by_id":
+        return (account_id, user_id)
+    elif name == "debit_balance":
+        # Moves one minor unit at a time, the rollback at the end restores the balance
+        return (1, account_id, 1)
+    elif name == "credit_balance":
+        return (1, account_id)
+    else:
+        # tx_id is the primary key, so every insert needs a new one
+        return (datetime.datetime.now(), utils.new_tx_id(), utils.TX_TYPES["Deposit"], None, None,
+                user_id, account_id, 1, currency_id)
+
+
+def _time(run, iterations):
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        run()
+        latencies.append((time.perf_counter() - started) * 1e6)
+
+    latencies.sort()
+    return statistics.mean(latencies), statistics.median(latencies), latencies[int(len(latencies) * 0.99)]
+
+
+def bench(iterations, account_id=None):
+    conn = utils.open_connection()
+
+    try:
+        with conn.cursor() as cur:
+            account = _account(cur, account_id)
+            if not account:
+                print("No accounts found. Seed the database first with seed_data.py")
+                return
+
+            for name, sql in utils.PREPARED_STATEMENTS.items():
+                def plain():
+                    cur.execute(sql, _params(name, account))
+
+                def prepared():
+                    utils.execute_prepared(cur, name, _params(name, account))
+
+                # Warm up both paths, which also prepares the statement
+                plain()
+                prepared()
+
+                for label, run in (("plain", plain), ("prepared", prepared)):
+                    mean, p50, p99 = _time(run, iterations)
+                    print(f"{name:<20}{label:<10} mean {mean:8.1f} us   p50 {p50:8.1f} us   p99 {p99:8.1f} us")
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark prepared statement latency")
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--account-id", type=int, default=None)
+    args = parser.parse_args()
+
+    bench(args.iterations, args.account_id)
@@ -0,0 +1,85 @@
+import psycopg2.extras
+import argparse
+import time
+import uuid
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+
+'''
+Benchmark: insert throughput and primary key size per transaction id scheme
+
+Inserts the same number of rows into one scratch table per scheme, each
+with the id as its primary key, then compares rows per second with the
+size of the table and of the key index. The scratch tables are dropped at
+the end.
+
+    legacy   varchar(50) uuid4 string plus a millisecond timestamp
+    uuid4    native uuid, random
+    uuid7    native uuid from utils.new_tx_id, time-ordered
+
+Usage:
+    python benchmarks/bench_tx_ids.py --rows 1000000 --batch 1000
+'''
+
+SCHEMES = {
+    "legacy": ("varchar(50)", lambda: str(uuid.uuid4()) + str(int(time.time()) * 1000)),
+    "uuid4": ("uuid", lambda: str(uuid.uuid4())),
+    "uuid7": ("uuid", utils.new_tx_id),
+}
+
+
+def _bench_scheme(conn, name, column_type, make_id, rows, batch):
+    table = f"bench_tx_ids_{name}"
+
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+        cur.execute(f"""CREATE TABLE {table} (
+                            tx_id {column_type} PRIMARY KEY,
+                            tx_time TIMESTAMP NOT NULL,
+                            account_id integer NOT NULL,
+                            amount BIGINT NOT NULL)""")
+    conn.commit()
+
+    started = time.perf_counter()
+    with conn.cursor() as cur:
+        for first in range(0, rows, batch):
+            now = time.strftime("%Y-%m-%d %H:%M:%S")
+            values = [(make_id(), now, i % 10000, i) for i in range(first, min(first + batch, rows))]
+            psycopg2.extras.execute_values(cur, f"INSERT INTO {table} VALUES %s", values, page_size=batch)
+            conn.commit()
+    elapsed = time.perf_counter() - started
+
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT pg_relation_size('{table}'), pg_relation_size('{table}_pkey')")
+        table_size, index_size = cur.fetchone()
+
+        cur.execute(f"DROP TABLE {table}")
+    conn.commit()
+
+    return rows / elapsed, table_size, index_size
+
+
+def bench(rows, batch):
+    conn = utils.open_connection()
+
+    try:
+        print(f"{'Scheme':<10}{'Rows/s':>12}{'Table MB':>12}{'Index MB':>12}{'Index B/row':>14}")
+        for name, (column_type, make_id) in SCHEMES.items():
+            rate, table_size, index_size = _bench_scheme(conn, name, column_type, make_id, rows, batch)
+            print(f"{name:<10}{rate:>12,.0f}{table_size / 2 ** 20:>12.1f}{index_size / 2 ** 20:>12.1f}"
+                  f"{index_size / rows:>14.1f}")
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark transaction id schemes")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args()
+
+    bench(args.rows, args.batch)
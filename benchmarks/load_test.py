@@ -0,0 +1,147 @@
+import urllib.parse
+import http.client
+import collections
+import threading
+import argparse
+import json
+import time
+
+'''
+Load test: requests per second and latency of the HTTP API
+
+Logs in once, then runs --concurrency threads that each keep one
+keep-alive connection and send --path back to back for --duration
+seconds. Reports throughput, status codes and latency percentiles. 503s
+are the server shedding load when its connection pool is busy, so they
+are counted but left out of the latency figures.
+
+Start the server first:
+    python server.py --port 8080
+
+Usage:
+    python benchmarks/load_test.py --url http://127.0.0.1:8080 --concurrency 32 --duration 30 \
+        --path /accounts --username alice --password secret
+'''
+
+
+def _connect(url):
+    cls = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+    return cls(url.hostname, url.port, timeout=30)
+
+
+def _login(url, username, password):
+    conn = _connect(url)
+    try:
+        conn.request("POST", "/login", json.dumps({"username": username, "password": password}),
+                     {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        body = json.loads(response.read())
+    finally:
+        conn.close()
+
+    if response.status != 200:
+        raise SystemExit(f"Login failed ({response.status}): {body.get('error')}")
+    return body["token"]
+
+
+def _worker(url, path, headers, deadline, latencies, statuses, lock):
+    conn = _connect(url)
+    local_latencies = []
+    local_statuses = collections.Counter()
+
+    try:
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                # Reconnect and count the failure, the server may have closed a busy connection
+                local_statuses["error"] += 1
+                conn.close()
+                conn = _connect(url)
+                continue
+
+            local_statuses[response.status] += 1
+            if response.status != 503:
+                local_latencies.append(time.perf_counter() - started)
+    finally:
+        conn.close()
+
+    with lock:
+        latencies.extend(local_latencies)
+        statuses.update(local_statuses)
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def load_test(url, path="/accounts", concurrency=16, duration=10.0, username=None, password=None):
+    '''
+    Runs the load test
+
+    Args:
+        url: Base URL of the server
+        path: Path each request GETs
+        concurrency: Number of client threads, each with its own connection
+        duration: Seconds to run for
+        username: User to log in as. Without it requests go unauthenticated
+        password: That user's password
+
+    Returns:
+        Dictionary with requests, requests per second, status counts and
+        latency percentiles in milliseconds
+    '''
+    url = urllib.parse.urlsplit(url)
+    headers = {}
+    if username:
+        headers["Authorization"] = f"Bearer {_login(url, username, password)}"
+
+    latencies = []
+    statuses = collections.Counter()
+    lock = threading.Lock()
+
+    started = time.perf_counter()
+    deadline = started + duration
+    threads = [threading.Thread(target=_worker, args=(url, path, headers, deadline, latencies, statuses, lock))
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    requests = sum(statuses.values())
+    result = {
+        "requests": requests,
+        "rps": round(requests / elapsed, 1),
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+    }
+
+    latencies.sort()
+    if latencies:
+        result["latency_ms"] = {name: round(_percentile(latencies, fraction) * 1000, 2)
+                                for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))}
+        result["latency_ms"]["max"] = round(latencies[-1] * 1000, 2)
+
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure requests per second and latency of the HTTP API")
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--path", default="/accounts")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--username")
+    parser.add_argument("--password")
+    args = parser.parse_args()
+
+    result = load_test(args.url, args.path, args.concurrency, args.duration, args.username, args.password)
+
+    print(f"{result['requests']:,} requests, {result['rps']:,} req/s over {args.concurrency} connections")
+    print("Statuses: " + ", ".join(f"{status}: {count:,}" for status, count in result["statuses"].items()))
+    for name, value in result.get("latency_ms", {}).items():
+        print(f"{name:>4}: {value} ms")
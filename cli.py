@@ -1,26 +1,25 @@
 from datetime import datetime
 import pandas as pd
+import analytics
 import logging
 import getpass
+import metrics
+import rates
 import users
 import utils
 import sys
 
 '''
-Logging setup
+Logging setup is done by utils.setup_logging on import
 '''
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename=('banking_system.log')
-)
 logger = logging.getLogger("banking_cli")
 
-# For storing logged in user
+# For storing logged in user and the profile returned by login
 current_user = None
+current_profile = None
 
 def Bank_App():
-    global current_user
+    global current_user, current_profile
 
     while True:
         if not current_user:
@@ -67,25 +66,13 @@ def Bank_App():
                             password = utils.secure_password(input_password)
                             user = users.User(1, username, 1, 'email@emai.com', "email", datetime.now())
 
-                            result = user.authenticate_user(username, password)
-                            print(result)
-
-                            if result == "Login Successful":
-                                try:
-                                    conn = utils.connect_to_db()
-                                    with conn.cursor() as cur:
-                                        cur.execute("SELECT user_id FROM Users WHERE username = %s", (username,))
-                                        rows = cur.fetchone()
-                                        user_id = rows[0]
-
-                                except Exception as e:
-                                    logger.error(f"Failed to get user_id: {e}")
-                                    raise
-                                finally:
-                                    utils.release_conn(conn)
+                            # Verifies, resets the failed attempts and returns the profile in one round trip
+                            result = user.login(username, password)
 
-                                current_user = user_id
-                                logger.info(f"{current_user} logged in")
+                            if isinstance(result, dict):
+                                print("Login Successful")
+                                current_profile = result
+                                current_user = result["user_id"]
                                 
                             else:
                                 print(result)                           
@@ -98,21 +85,7 @@ def Bank_App():
                     sys.exit(0)
 
         if current_user:
-            try:
-                conn = utils.connect_to_db()
-                with conn.cursor() as cur:
-                    cur.execute("SELECT username FROM Users WHERE user_id = %s", (current_user,))
-                    rows = cur.fetchone()
-
-                if rows:
-                    username = rows[0]
-            except Exception as e:
-                logger.error(f"Unable to fetch username from DB: {e}")
-                raise
-            finally:
-                utils.release_conn(conn)
-
-            print(f"Welcome to the Royal Bank, {username}")
+            print(f"Welcome to the Royal Bank, {current_profile['username']}")
             print("1. Create Account")
             print("2. Deposit")
             print("3. Withdraw")
@@ -127,6 +100,8 @@ def Bank_App():
             print("12. Close Account")
             print("13. Logout")
             print("14. Quit")
+            print("15. Metrics Summary")
+            print("16. Net Worth")
             
             main_choice = input("Select an option: ")
 
@@ -139,7 +114,7 @@ def Bank_App():
 
                         # Get next account_id
                         with conn.cursor() as cur:
-                            cur.execute("SELECT account_id, currency_code FROM Accounts WHERE user_id = %s;", (current_user,))
+                            cur.execute("SELECT account_id, currency_code FROM AccountDetails WHERE user_id = %s;", (current_user,))
                             account_rows = cur.fetchall()
 
                             account_id = len(account_rows) + 1
@@ -169,14 +144,13 @@ def Bank_App():
 
                             print(currency)
 
-                            initial_deposit = int(input("Select an amount to deposit: "))
-                            
-                            # Checks if initial deposit is int not float
+                            # Parses the initial deposit into minor units of the currency
                             is_int = False
-                            if isinstance(initial_deposit, int):
-                               is_int = True 
-                            else:
-                                print("Not a valid number. Please input a whole number")
+                            try:
+                                initial_deposit = utils.parse_amount(input("Select an amount to deposit: "), currency)
+                                is_int = True
+                            except ValueError as e:
+                                print(f"Not a valid amount. {e}")
 
                             # Main create user logic
                             if current_user:
@@ -190,7 +164,7 @@ def Bank_App():
                                     # Get account_id if was created successfully
                                     try: 
                                         with conn.cursor() as cur:
-                                            cur.execute("SELECT account_id FROM Accounts WHERE user_id = %s AND currency_code = %s",
+                                            cur.execute("SELECT account_id FROM AccountDetails WHERE user_id = %s AND currency_code = %s",
                                                         (current_user, currency))
 
                                             rows = cur.fetchone()
@@ -224,7 +198,7 @@ def Bank_App():
                         # Connect to DB
                         conn = utils.connect_to_db()
                         with conn.cursor() as cur:
-                            cur.execute("SELECT DISTINCT currency_code FROM Accounts WHERE user_id = %s AND is_active = TRUE", 
+                            cur.execute("SELECT DISTINCT currency_code FROM AccountDetails WHERE user_id = %s AND is_active = TRUE", 
                                         (current_user,))
                             rows = cur.fetchall()
 
@@ -234,7 +208,7 @@ def Bank_App():
                             print(f"{i}. {code}")
 
                         select_currency = input("Select an option: ")
-                        amount = int(input("Enter amount to deposit: "))
+                        input_amount = input("Enter amount to deposit: ")
 
                         # Checks if response is digit and gets the corresponding currency code
                         if select_currency.isdigit():
@@ -247,6 +221,8 @@ def Bank_App():
                                 # Converts currency code to uppercase
                                 currency = select_currency.upper()
 
+                        amount = utils.parse_amount(input_amount, currency)
+
                         with conn.cursor() as cur:
                             cur.execute("SELECT account_id WHERE user_id = %s AND currency_code = %s", (current_user, currency))
                             rows = cur.fetchone()
@@ -271,7 +247,7 @@ def Bank_App():
                         # Connect to DB
                         conn = utils.connect_to_db()
                         with conn.cursor() as cur:
-                            cur.execute("SELECT DISTINCT currency_code FROM Accounts WHERE user_id = %s AND is_active = TRUE", 
+                            cur.execute("SELECT DISTINCT currency_code FROM AccountDetails WHERE user_id = %s AND is_active = TRUE", 
                                         (current_user,))
                             rows = cur.fetchall()
 
@@ -281,7 +257,7 @@ def Bank_App():
                             print(f"{i}. {code}")
 
                         select_currency = input("Select an option: ")
-                        amount = int(input("Enter amount to withdraw: "))
+                        input_amount = input("Enter amount to withdraw: ")
 
                         # Checks if response is digit and gets the corresponding currency code
                         if select_currency.isdigit():
@@ -296,6 +272,8 @@ def Bank_App():
                             else:
                                 print("Invalid selection. Check your selection")
 
+                        amount = utils.parse_amount(input_amount, currency)
+
                         with conn.cursor() as cur:
                             cur.execute("SELECT account_id WHERE user_id = %s AND currency_code = %s", (current_user, currency))
                             rows = cur.fetchone()
@@ -320,7 +298,7 @@ def Bank_App():
                         conn = utils.connect_to_db()
 
                         with conn.cursor() as cur:
-                            cur.execute("SELECT DISTINCT currency_code FROM Accounts WHERE user_id = %s AND is_active = TRUE", 
+                            cur.execute("SELECT DISTINCT currency_code FROM AccountDetails WHERE user_id = %s AND is_active = TRUE", 
                                         (current_user,))
                             rows = cur.fetchall()
 
@@ -348,7 +326,7 @@ def Bank_App():
 
             
                             username = input("Enter target username: ")
-                            amount = int(input("Enter amount: "))
+                            amount = utils.parse_amount(input("Enter amount: "), currency)
             
                         if current_user:
                             if amount > 0:
@@ -356,7 +334,7 @@ def Bank_App():
                                 try:
                                     # Fetch from_account_id for currency
                                     with conn.cursor() as cur:
-                                        cur.execute("SELECT account_id FROM Accounts WHERE user_id = %s AND currency_code = %s;", 
+                                        cur.execute("SELECT account_id FROM AccountDetails WHERE user_id = %s AND currency_code = %s;", 
                                                     (current_user, currency))
                                         rows = cur.fetchone()
                                     if rows:
@@ -369,7 +347,7 @@ def Bank_App():
                                         to_user_id = rows[0]
                                 
                                         # Fetch to_account_id
-                                        cur.execute("SELECT account_id FROM Accounts WHERE user_id = %s AND currency_code = %s;", 
+                                        cur.execute("SELECT account_id FROM AccountDetails WHERE user_id = %s AND currency_code = %s;", 
                                                     (to_user_id, currency))
                                         rows = cur.fetchone()
                                     if rows:
@@ -403,7 +381,7 @@ def Bank_App():
                     try:
                         conn = utils.connect_to_db()
                         with conn.cursor() as cur:
-                            cur.execute("SELECT DISTINCT currency_code FROM Accounts WHERE user_id = %s;", (current_user,))
+                            cur.execute("SELECT DISTINCT currency_code FROM AccountDetails WHERE user_id = %s;", (current_user,))
                             rows = cur.fetchall()
 
                             codes = list(row[0].strip(',') for row in rows)
@@ -440,7 +418,7 @@ def Bank_App():
                                 conn = utils.connect_to_db()
                                 with conn.cursor() as cur:
                                     print(currency)
-                                    cur.execute("SELECT balance FROM Accounts WHERE user_id = %s AND currency_code = %s;",
+                                    cur.execute("SELECT balance FROM AccountDetails WHERE user_id = %s AND currency_code = %s;",
                                                 (current_user, currency))
                                     rows = cur.fetchone()
 
@@ -521,6 +499,9 @@ def Bank_App():
                                 result = users.update_user_details(user_id, field, value)
                                 print(result)
 
+                                if user_id == current_user and field in current_profile and result and "successfully" in result:
+                                    current_profile[field] = value
+
                             else:
                                 print("Input the necessary details")
                         else:
@@ -571,9 +552,10 @@ def Bank_App():
                     
                     if current_user:
                         if from_currency and to_currency:   
-                            result = users.get_exchange_rate(to_currency, from_currency)
-
-                            print(result)
+                            try:
+                                print(users.get_exchange_rate(to_currency, from_currency))
+                            except rates.RateUnavailableError as e:
+                                print(f"Exchange rates are unavailable right now: {e}")
                         else:
                             print("Input the necessary details")
                     else:
@@ -623,16 +605,14 @@ def Bank_App():
                         else:
                             print("Unknown currency. Check your selection")
 
-                    input_amount = int(input("Enter amount to convert: "))
-
-                    if isinstance(input_amount, int):
-                        amount = input_amount
+                    amount = utils.parse_amount(input("Enter amount to convert: "), from_currency)
                     
                     if current_user:
                         if from_currency and to_currency and amount:   
-                            result = users.convert_currency(amount, from_currency, to_currency)
-
-                            print(result)
+                            try:
+                                print(users.convert_currency(amount, from_currency, to_currency))
+                            except rates.RateUnavailableError as e:
+                                print(f"Exchange rates are unavailable right now: {e}")
                         else:
                             print("Input the necessary details")
                     else:
@@ -664,7 +644,7 @@ def Bank_App():
 
                         # Fetches user's active currencies from DB
                         with conn.cursor() as cur:
-                            cur.execute("SELECT DISTINCT currency_code FROM Accounts WHERE user_id = %s AND is_active = TRUE", 
+                            cur.execute("SELECT DISTINCT currency_code FROM AccountDetails WHERE user_id = %s AND is_active = TRUE", 
                                         (current_user,))
                             rows = cur.fetchall()
 
@@ -711,7 +691,7 @@ def Bank_App():
 
                         # Fetches account_id for sender
                         with conn.cursor() as cur:
-                            cur.execute("SELECT account_id FROM Accounts WHERE user_id = %s AND currency_code = %s", 
+                            cur.execute("SELECT account_id FROM AccountDetails WHERE user_id = %s AND currency_code = %s", 
                                         (current_user, from_currency))
                             rows = cur.fetchone()
 
@@ -720,7 +700,7 @@ def Bank_App():
 
                         # Fetches account_id for receiver
                         with conn.cursor() as cur:
-                            cur.execute("SELECT account_id FROM Accounts WHERE user_id = %s AND currency_code = %s",
+                            cur.execute("SELECT account_id FROM AccountDetails WHERE user_id = %s AND currency_code = %s",
                                         (to_user_id, to_currency))
                             rows = cur.fetchone()
 
@@ -730,14 +710,26 @@ def Bank_App():
                                 print("Account doesn't exist")
                                 break
 
-                        input_amount = int(input("Enter amount to convert: "))
-
-                        if isinstance(input_amount, int):
-                            amount = input_amount
+                        amount = utils.parse_amount(input("Enter amount to convert: "), from_currency)
                     
                         if current_user:
                             if from_currency and to_currency and amount:   
-                                result = users.currency_exchange(from_account_id, to_account_id, to_user_id, current_user, amount)
+                                try:
+                                    quote = users.quote_exchange(from_account_id, to_account_id, to_user_id, current_user, amount)
+                                except rates.RateUnavailableError as e:
+                                    quote = f"Exchange rates are unavailable right now: {e}"
+
+                                if isinstance(quote, dict):
+                                    print(f"Rate: {quote['rate']}")
+                                    print(f"You will receive {utils.format_currency(quote['amount_received'], quote['to_currency'])}")
+                                    print(f"Quote valid until {quote['expires_at']:%H:%M:%S}")
+
+                                    if input("Accept quote? (y/n): ").lower() == "y":
+                                        result = users.execute_quote(quote["quote_id"], current_user)
+                                    else:
+                                        result = "Exchange cancelled"
+                                else:
+                                    result = quote
 
                                 logger.info(f"{result}")
                                 print(result)
@@ -804,66 +796,52 @@ def Bank_App():
                     
 
                     if analysis == "Spending History":
-                        try:
-                            conn = utils.connect_to_db()
-
-                            # Fetch currency codes
-                            with conn.cursor() as cur:
-                                cur.execute("SELECT DISTINCT account_id, currency_code FROM Accounts WHERE user_id = %s", (current_user,))
-                                rows = cur.fetchall()
+                        periods = list(users.SPENDING_PERIODS)
 
-                            if rows:
-                                currencies = list(row[1].strip(',') for row in rows)
-
-                            for i, code in enumerate(currencies):
-                                print(f"{i}. {code}")
-
-                            input_currency = input("Select a currency: ")
+                        for i, name in enumerate(periods):
+                            print(f"{i}. {name.title()}")
 
-                            # Checks if input_currency is digit and returns corresponding string
-                            if input_currency.isdigit():
-                                index = int(input_currency)
-                                
-                                if 0 <= index < len(currencies):
-                                    currency = currencies[index]
-                                    
-                            else:
-                                # If input_currency is in currencies, then return currency
-                                if input_currency in currencies:
-                                    # Converts analysis to upper case
-                                    currency = input_currency.upper()
-                                else:
-                                    print("Unknown string. Check your selection")
+                        input_period = input("Select a period: ")
 
-                            if currency:
-                                for row in rows:
-                                    if row[1] == currency:
-                                        account_id = row[0]
+                        # Checks if input_period is digit and returns corresponding period
+                        if input_period.isdigit() and 0 <= int(input_period) < len(periods):
+                            period = periods[int(input_period)]
+                        elif input_period.lower() in periods:
+                            period = input_period.lower()
+                        else:
+                            period = "daily"
+                            print("Unknown period. Showing daily spending")
 
-                            print("Please ensure that the start date is always before the end date else this function will not work")
-                            start_date = input("Enter start date in this format(YYYY-MM-DD): ")
-                            end_date = input("Enter end date in this format(YYYY-MM-DD): ")
-                            
-                            if current_user:
-                                if end_date >= start_date:
-                                    if account_id:
-                                        result = users.get_spending_history(account_id, current_user, start_date, end_date)
-                                        print(result)
+                        print("Please ensure that the start date is always before the end date else this function will not work")
+                        start_date = input("Enter start date in this format(YYYY-MM-DD): ")
+                        end_date = input("Enter end date in this format(YYYY-MM-DD): ")
+                        
+                        if current_user:
+                            if end_date >= start_date:
+                                try:
+                                    # One query covers every account of the user, or none with a local snapshot
+                                    frame = users.get_spending_frame(current_user, start_date, end_date,
+                                                                     snapshot=analytics.current_snapshot())
+                                except Exception as e:
+                                    logger.error(f"Unable to get spending history: {e}")
+                                    raise
 
-                                        data = pd.DataFrame(result)
-                                        data = data.set_index("Date")
-                                        print(data)
-                                    else:
-                                        print("Please choose an account")
+                                if frame.empty:
+                                    print("No transactions yet")
                                 else:
-                                   print("Please check your start date and end date")
+                                    data = users.resample_spending(frame, period)
+                                    for code in data.columns:
+                                        data[code] = data[code].map(lambda amount, code=code: utils.format_currency(amount, code))
+                                    print(data)
+
+                                    totals = users.spending_totals(frame)
+                                    totals["amount"] = [utils.format_currency(amount, code)
+                                                        for amount, code in zip(totals["amount"], totals["currency_code"])]
+                                    print(totals)
                             else:
-                                print("Please login")
-                        except Exception as e:
-                            logger.error(f"Unable to get spending history: {e}")
-                            raise
-                        finally:
-                            utils.release_conn(conn)
+                               print("Please check your start date and end date")
+                        else:
+                            print("Please login")
 
                     # Generate account statement
                     elif analysis == "Account Statement":
@@ -872,7 +850,7 @@ def Bank_App():
 
                             # Fetches details from accounts
                             with conn.cursor() as cur:
-                                cur.execute("SELECT DISTINCT account_id, currency_code FROM Accounts WHERE user_id = %s",
+                                cur.execute("SELECT DISTINCT account_id, currency_code FROM AccountDetails WHERE user_id = %s",
                                             (current_user,))
                                 rows = cur.fetchall()
 
@@ -911,7 +889,8 @@ def Bank_App():
                             if current_user:
                                 if end_date >= start_date:
                                     if account_id:
-                                        result = users.get_spending_history(account_id, current_user, start_date, end_date)
+                                        result = users.get_spending_history(account_id, current_user, start_date, end_date,
+                                                                            snapshot=analytics.current_snapshot())
                                         for history in result:
                                             x_values = list(history.keys())
 
@@ -937,7 +916,7 @@ def Bank_App():
 
                         # Fetch user's currencies from account
                         with conn.cursor() as cur:
-                            cur.execute("SELECT DISTINCT account_id, currency_code FROM Accounts WHERE user_id = %s",
+                            cur.execute("SELECT DISTINCT account_id, currency_code FROM AccountDetails WHERE user_id = %s",
                                         (current_user,))
                             rows = cur.fetchall()
 
@@ -985,6 +964,7 @@ def Bank_App():
 
                     if choice.lower() == "yes":
                         current_user = None
+                        current_profile = None
                     
 
                 # Quit the program
@@ -994,7 +974,69 @@ def Bank_App():
                     if choice.lower() == "yes":
                         sys.exit()         
 
+                # Metrics Summary
+                case "15":
+                    try:
+                        conn = utils.connect_to_db()
+
+                        # Fetches admin status from DB
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT is_admin FROM Users WHERE user_id = %s", (current_user,))
+                            rows = cur.fetchone()
+
+                        is_admin = rows[0] if rows else False
+                    except Exception as e:
+                        logger.error(f"Unable to fetch admin status: {e}")
+                        raise
+                    finally:
+                        utils.release_conn(conn)
+
+                    if is_admin:
+                        print(metrics.summary())
+
+                        path = metrics.write_prometheus()
+                        if path:
+                            print(f"Metrics written to {path}")
+                    else:
+                        print("You cannot access this menu")
+
+                # Net Worth
+                case "16":
+                    all_currencies = users.get_supported_currencies()
+                    currencies = list(code[0].strip(',') for code in all_currencies)
+
+                    for i, currency in enumerate(currencies):
+                        print(f"{i}. {currency}")
+
+                    input_currency = input("Select reporting currency: ")
+
+                    # Checks if input_currency is digit and returns corresponding code
+                    if input_currency.isdigit() and 0 <= int(input_currency) < len(currencies):
+                        reporting_currency = currencies[int(input_currency)]
+                    elif input_currency.upper() in currencies:
+                        reporting_currency = input_currency.upper()
+                    else:
+                        reporting_currency = None
+                        print("Unknown currency. Check your selection")
+
+                    if current_user and reporting_currency:
+                        try:
+                            valuation = users.get_portfolio_valuation(current_user, reporting_currency)
+                        except rates.RateUnavailableError as e:
+                            valuation = None
+                            print(f"Exchange rates are unavailable right now: {e}")
+
+                        if valuation:
+                            for account in valuation["accounts"]:
+                                print(f"{account['currency_code']}: {utils.format_currency(account['balance'], account['currency_code'])}"
+                                      f" @ {account['rate']:.6f} = {utils.format_currency(account['value'], reporting_currency)}")
+
+                            print(f"Total: {utils.format_currency(valuation['total'], reporting_currency)}"
+                                  f" as of {valuation['as_of']:%Y-%m-%d %H:%M}")
+
 if __name__ == "__main__":
+    metrics.start_metrics_server()
+    rates.start_refresher()
     Bank_App()
 
 # Godspeed
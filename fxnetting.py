@@ -0,0 +1,308 @@
+import collections
+import datetime
+import argparse
+import logging
+import rates
+import utils
+import time
+import os
+
+logger = logging.getLogger('banking_fxnetting')
+
+'''
+FX order netting engine
+
+Customers submit exchange orders with users.submit_exchange_order. Each run
+takes every pending order created up to the cutoff and fills them at one
+rate snapshot, fetched once for the whole batch.
+
+Orders are netted per currency pair against the bank's pool accounts, the
+Accounts rows of the treasury user. Instead of every order moving money in
+and out of the pools on its own, each pool gets one net ledger row per pair
+and one balance update per currency. Customer accounts with several orders
+are also updated once with their net change.
+
+A run is one transaction: claim the orders, lock the customer and pool
+balances, then post everything with one set-based statement. Orders a pool
+can't pay out are rejected, so pools never go negative.
+
+Usage:
+    python fxnetting.py --treasury-user-id 1 --every 60
+'''
+
+# Writes and rate lookups of routing one order through the pools on its own:
+# debit and credit the customer, credit and debit the two pools, one rate lookup
+PER_ORDER_BALANCE_UPDATES = 4
+PER_ORDER_LEDGER_ROWS = 4
+
+_POST_BATCH = """
+    WITH filled (order_id, user_id, from_account_id, to_user_id, to_account_id,
+                 from_currency, to_currency, amount, received, rate) AS (
+        SELECT * FROM unnest(%(order_ids)s::integer[], %(user_ids)s::integer[], %(from_accounts)s::integer[],
+                             %(to_users)s::integer[], %(to_accounts)s::integer[], %(from_currencies)s::varchar[],
+                             %(to_currencies)s::varchar[], %(amounts)s::bigint[], %(received)s::bigint[],
+                             %(rates)s::bigint[])),
+    pool (account_id, currency_code, delta) AS (
+        SELECT * FROM unnest(%(pool_accounts)s::integer[], %(pool_currencies)s::varchar[],
+                             %(pool_deltas)s::bigint[])),
+    deltas AS (
+        SELECT account_id, SUM(delta) AS delta FROM (
+            SELECT from_account_id AS account_id, -amount AS delta FROM filled
+            UNION ALL
+            SELECT to_account_id, received FROM filled
+            UNION ALL
+            SELECT account_id, delta FROM pool) flows
+        GROUP BY account_id),
+    balances AS (
+        UPDATE Accounts a SET balance = a.balance + d.delta
+        FROM deltas d
+        WHERE a.account_id = d.account_id AND d.delta <> 0
+        RETURNING 1),
+    ledger AS (
+        INSERT INTO Transactions (tx_time, tx_id, type_id, from_user_id, from_account_id,
+                                  to_user_id, to_account_id, amount, currency_id)
+        SELECT %(tx_time)s, uuid_v7(), %(conversion)s, f.user_id, f.from_account_id,
+               NULL, NULL, f.amount, c.currency_id
+        FROM filled f JOIN Currencies c ON c.currency_code = f.from_currency
+        UNION ALL
+        SELECT %(tx_time)s, uuid_v7(), %(conversion)s, NULL, NULL,
+               f.to_user_id, f.to_account_id, f.received, c.currency_id
+        FROM filled f JOIN Currencies c ON c.currency_code = f.to_currency
+        UNION ALL
+        SELECT %(tx_time)s, uuid_v7(), %(fx_net)s,
+               CASE WHEN p.delta < 0 THEN %(treasury)s END, CASE WHEN p.delta < 0 THEN p.account_id END,
+               CASE WHEN p.delta > 0 THEN %(treasury)s END, CASE WHEN p.delta > 0 THEN p.account_id END,
+               abs(p.delta), c.currency_id
+        FROM pool p JOIN Currencies c ON c.currency_code = p.currency_code
+        WHERE p.delta <> 0
+        RETURNING 1),
+    orders AS (
+        UPDATE FxOrders o SET status = 'filled', batch_id = %(batch_id)s, rate = f.rate,
+                              amount_received = f.received, filled_at = %(tx_time)s
+        FROM filled f
+        WHERE o.order_id = f.order_id
+        RETURNING 1),
+    rejected AS (
+        UPDATE FxOrders SET status = 'rejected', batch_id = %(batch_id)s
+        WHERE order_id = ANY(%(rejected)s::integer[])
+        RETURNING 1)
+    SELECT (SELECT COUNT(*) FROM balances), (SELECT COUNT(*) FROM ledger),
+           (SELECT COUNT(*) FROM orders), (SELECT COUNT(*) FROM rejected)"""
+
+
+def _pool_accounts(treasury_user_id):
+    '''Gets the treasury's active account per currency'''
+    conn = utils.connect_to_db()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT currency_code, account_id FROM AccountDetails WHERE user_id = %s AND is_active",
+                        (treasury_user_id,))
+            pools = {code.strip(): account_id for code, account_id in cur.fetchall()}
+        conn.commit()
+    finally:
+        utils.release_conn(conn)
+
+    return pools
+
+
+def _cover_pools(filled, balances, pools):
+    '''
+    Drops fills until every pool can pay out its currency's net outflow
+
+    The latest fills paying out a short currency go first. Dropping one also
+    takes away what it paid into the other pool, which can leave that one
+    short in turn, so short currencies are worked through until none are.
+
+    Returns:
+        Tuple of (fills kept, order_ids dropped)
+    '''
+    available = {code: balances.get(account_id, (0, False))[0] for code, account_id in pools.items()}
+    payouts = collections.defaultdict(list)
+
+    for i, row in enumerate(filled):
+        available[row[5]] += row[7]
+        available[row[6]] -= row[8]
+        payouts[row[6]].append(i)
+
+    dropped = set()
+    short = [code for code, balance in available.items() if balance < 0]
+
+    while short:
+        code = short.pop()
+        while available[code] < 0 and payouts[code]:
+            i = payouts[code].pop()
+            if i in dropped:
+                continue
+
+            dropped.add(i)
+            row = filled[i]
+            available[code] += row[8]
+            available[row[5]] -= row[7]
+            if available[row[5]] < 0:
+                short.append(row[5])
+
+    return [row for i, row in enumerate(filled) if i not in dropped], [filled[i][0] for i in sorted(dropped)]
+
+
+def _fill(orders, balances, snapshot, pools):
+    '''
+    Decides which orders fill and nets the pools per pair
+
+    Orders of an account are rejected together when the account is closed or
+    can't cover their total. Orders are also rejected when a pool can't pay
+    out its currency's net outflow.
+
+    Returns:
+        Tuple of (filled order rows, rejected order_ids, pool rows, per pair report)
+    '''
+    debits = collections.Counter()
+    for order in orders:
+        debits[order[2]] += order[7]
+
+    pair_rates = {}
+    filled, rejected = [], []
+
+    for order in orders:
+        order_id, _, from_account_id, _, to_account_id, from_currency, to_currency, amount = order
+        from_balance, from_active = balances.get(from_account_id, (0, False))
+        _, to_active = balances.get(to_account_id, (0, False))
+
+        if not (from_active and to_active) or debits[from_account_id] > from_balance:
+            rejected.append(order_id)
+            continue
+
+        # One rate per pair for the whole batch
+        if (to_currency, from_currency) not in pair_rates:
+            pair_rates[to_currency, from_currency] = snapshot.rate(to_currency, from_currency)
+        rate = pair_rates[to_currency, from_currency]
+        received = utils.convert_minor(amount, rate, from_currency, to_currency)
+        filled.append((*order, received, rate))
+
+    filled, short = _cover_pools(filled, balances, pools)
+    if short:
+        logger.warning(f"Rejected {len(short)} FX orders the pool accounts can't cover")
+    rejected.extend(short)
+
+    net = collections.defaultdict(collections.Counter)
+    pairs = collections.Counter()
+
+    for row in filled:
+        from_currency, to_currency, amount, received = row[5], row[6], row[7], row[8]
+
+        # The pool takes in what the customer pays and pays out what they receive
+        pair = "/".join(sorted((from_currency, to_currency)))
+        net[pair][from_currency] += amount
+        net[pair][to_currency] -= received
+        pairs[pair] += 1
+
+    pool_rows = [(pools[code], code, delta) for pair, deltas in net.items() for code, delta in deltas.items()]
+    report = {pair: {"orders": pairs[pair], "pool_net": dict(net[pair])} for pair in pairs}
+
+    return filled, rejected, pool_rows, report
+
+
+def net_orders(treasury_user_id, cutoff=None):
+    '''
+    Fills every pending order created up to cutoff in one netted batch
+
+    Args:
+        treasury_user_id: Owner of the bank's pool accounts, one per currency
+        cutoff: Latest created_on to include. Defaults to now
+
+    Returns:
+        Dictionary with the batch_id, orders filled and rejected, per pair
+        netting and the writes and rate lookups compared to routing every
+        order through the pools on its own
+    '''
+    cutoff = cutoff or datetime.datetime.now()
+    pools = _pool_accounts(treasury_user_id)
+
+    if not pools:
+        raise ValueError(f"User {treasury_user_id} has no active pool accounts")
+
+    # Fetched before the transaction so no network I/O happens while rows are locked
+    snapshot_time, fixed = rates.fetch_snapshot(set(pools) - {"USD"})
+    snapshot = rates.RateSnapshot(snapshot_time, fixed)
+    rates.record_snapshot(snapshot_time, fixed)
+    codes = list(pools)
+    conn = utils.connect_to_db()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT order_id, user_id, from_account_id, to_user_id, to_account_id, " \
+                        "from_currency, to_currency, amount FROM FxOrders " \
+                        "WHERE status = 'pending' AND created_on <= %s " \
+                        "AND from_currency = ANY(%s) AND to_currency = ANY(%s) " \
+                        "ORDER BY order_id FOR UPDATE SKIP LOCKED", (cutoff, codes, codes))
+            orders = cur.fetchall()
+
+            if not orders:
+                conn.commit()
+                return {"batch_id": None, "orders": 0, "rejected": 0}
+
+            # Pools are locked with the customers so their balances can't change before the post
+            accounts = {row[2] for row in orders} | {row[4] for row in orders} | set(pools.values())
+            cur.execute("SELECT account_id, balance, is_active FROM Accounts " \
+                        "WHERE account_id = ANY(%s) ORDER BY account_id FOR UPDATE", (list(accounts),))
+            balances = {account_id: (balance, is_active) for account_id, balance, is_active in cur.fetchall()}
+
+            filled, rejected, pool_rows, pairs = _fill(orders, balances, snapshot, pools)
+
+            cur.execute("INSERT INTO FxBatches DEFAULT VALUES RETURNING batch_id")
+            batch_id = cur.fetchone()[0]
+
+            columns = list(zip(*filled)) or [()] * 10
+            pool_columns = list(zip(*pool_rows)) or [()] * 3
+            cur.execute(_POST_BATCH, {
+                "order_ids": list(columns[0]), "user_ids": list(columns[1]),
+                "from_accounts": list(columns[2]), "to_users": list(columns[3]),
+                "to_accounts": list(columns[4]), "from_currencies": list(columns[5]),
+                "to_currencies": list(columns[6]), "amounts": list(columns[7]),
+                "received": list(columns[8]), "rates": list(columns[9]),
+                "pool_accounts": list(pool_columns[0]), "pool_currencies": list(pool_columns[1]),
+                "pool_deltas": list(pool_columns[2]),
+                "rejected": rejected, "batch_id": batch_id, "treasury": treasury_user_id,
+                "conversion": utils.TX_TYPES["Conversion"], "fx_net": utils.TX_TYPES["FX Net"],
+                "tx_time": datetime.datetime.now(),
+            })
+            balance_updates, ledger_rows, filled_count, rejected_count = cur.fetchone()
+
+            cur.execute("UPDATE FxBatches SET orders = %s, rejected = %s, balance_updates = %s, ledger_rows = %s " \
+                        "WHERE batch_id = %s", (filled_count, rejected_count, balance_updates, ledger_rows, batch_id))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Failed to net FX orders: {e}")
+        raise
+    finally:
+        utils.release_conn(conn)
+
+    result = {
+        "batch_id": batch_id,
+        "orders": filled_count,
+        "rejected": rejected_count,
+        "pairs": pairs,
+        "balance_updates": {"per_order": filled_count * PER_ORDER_BALANCE_UPDATES, "netted": balance_updates},
+        "ledger_rows": {"per_order": filled_count * PER_ORDER_LEDGER_ROWS, "netted": ledger_rows},
+        "rate_lookups": {"per_order": filled_count, "netted": 1},
+    }
+    logger.info(f"Netted FX batch {batch_id}: {result}")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Net and fill pending FX orders against the pool accounts")
+    parser.add_argument("--treasury-user-id", type=int, default=os.getenv("TREASURY_USER_ID"), required=not os.getenv("TREASURY_USER_ID"))
+    parser.add_argument("--every", type=float, default=None, help="Seconds between batches. Runs once when not given")
+    args = parser.parse_args()
+
+    utils.create_tables()
+
+    while True:
+        print(net_orders(int(args.treasury_user_id)))
+        if not args.every:
+            break
+        time.sleep(args.every)
+
+# Godspeed
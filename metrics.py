@@ -0,0 +1,300 @@
+import http.server
+import functools
+import threading
+import logging
+import time
+import os
+
+logger = logging.getLogger('banking_metrics')
+
+'''
+Per-operation metrics
+
+Records call count, errors, latency histogram, database round trips and
+rows fetched for every instrumented function. Round trips and rows are
+reported by the cursor in utils and attributed to every operation running
+on the current thread, so nested calls are counted inclusively like latency.
+'''
+
+# Latency histogram bucket bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class OperationStats():
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.round_trips = 0
+        self.rows_fetched = 0
+
+    def observe(self, seconds, failed):
+        '''Adds one finished call to the stats'''
+        self.calls += 1
+        self.latency_sum += seconds
+        self.latency_max = max(self.latency_max, seconds)
+
+        if failed:
+            self.errors += 1
+
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, fraction):
+        '''
+        Estimates a latency percentile from the histogram
+
+        Args:
+            fraction: Percentile as a fraction, e.g 0.95
+
+        Returns:
+            Upper bound of the bucket holding the percentile, in seconds
+        '''
+        if not self.calls:
+            return 0.0
+
+        target = fraction * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= target:
+                return min(bound, self.latency_max)
+        return self.latency_max
+
+
+_lock = threading.Lock()
+_stats = {}
+_active = threading.local()
+_gauges = {}
+
+
+def _get_stats(name):
+    stats = _stats.get(name)
+    if stats is None:
+        stats = _stats.setdefault(name, OperationStats(name))
+    return stats
+
+
+def _active_operations():
+    if not hasattr(_active, "stack"):
+        _active.stack = []
+    return _active.stack
+
+
+def instrument(name):
+    '''
+    Decorator that records metrics for a function
+
+    Args:
+        name: Operation name used in the metrics output
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = _active_operations()
+            stack.append(name)
+            failed = False
+            started = time.perf_counter()
+
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                stack.pop()
+                with _lock:
+                    _get_stats(name).observe(elapsed, failed)
+        return wrapper
+    return decorator
+
+
+def record_round_trip(count=1):
+    '''Called by the cursor for every statement sent to the database'''
+    stack = _active_operations()
+    if not stack:
+        return
+
+    with _lock:
+        for name in set(stack):
+            _get_stats(name).round_trips += count
+
+
+def record_rows(count):
+    '''Called by the cursor with the number of rows fetched'''
+    stack = _active_operations()
+    if not stack or not count:
+        return
+
+    with _lock:
+        for name in set(stack):
+            _get_stats(name).rows_fetched += count
+
+
+def register_gauge(name, help_text, func):
+    '''
+    Adds a gauge read when the metrics are rendered
+
+    Args:
+        name: Prometheus metric name
+        help_text: Description for the HELP line
+        func: Called with no arguments, returns the current value
+    '''
+    with _lock:
+        _gauges[name] = (help_text, func)
+
+
+def reset():
+    '''Clears all recorded metrics'''
+    with _lock:
+        _stats.clear()
+
+
+def render_prometheus():
+    '''
+    Renders the metrics in Prometheus text exposition format
+
+    Returns:
+        String with all metrics
+    '''
+    with _lock:
+        stats = sorted(_stats.values(), key=lambda s: s.name)
+        lines = [
+            "# HELP bank_operation_calls_total Number of calls per operation",
+            "# TYPE bank_operation_calls_total counter",
+        ]
+        lines += [f'bank_operation_calls_total{{operation="{s.name}"}} {s.calls}' for s in stats]
+
+        lines += [
+            "# HELP bank_operation_errors_total Number of calls that raised",
+            "# TYPE bank_operation_errors_total counter",
+        ]
+        lines += [f'bank_operation_errors_total{{operation="{s.name}"}} {s.errors}' for s in stats]
+
+        lines += [
+            "# HELP bank_operation_latency_seconds Operation latency",
+            "# TYPE bank_operation_latency_seconds histogram",
+        ]
+        for s in stats:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, s.buckets):
+                cumulative += count
+                lines.append(f'bank_operation_latency_seconds_bucket{{operation="{s.name}",le="{bound}"}} {cumulative}')
+            lines.append(f'bank_operation_latency_seconds_bucket{{operation="{s.name}",le="+Inf"}} {s.calls}')
+            lines.append(f'bank_operation_latency_seconds_sum{{operation="{s.name}"}} {s.latency_sum:.6f}')
+            lines.append(f'bank_operation_latency_seconds_count{{operation="{s.name}"}} {s.calls}')
+
+        lines += [
+            "# HELP bank_operation_db_round_trips_total Statements sent to the database",
+            "# TYPE bank_operation_db_round_trips_total counter",
+        ]
+        lines += [f'bank_operation_db_round_trips_total{{operation="{s.name}"}} {s.round_trips}' for s in stats]
+
+        lines += [
+            "# HELP bank_operation_rows_fetched_total Rows fetched from the database",
+            "# TYPE bank_operation_rows_fetched_total counter",
+        ]
+        lines += [f'bank_operation_rows_fetched_total{{operation="{s.name}"}} {s.rows_fetched}' for s in stats]
+
+        gauges = sorted(_gauges.items())
+
+    for name, (help_text, func) in gauges:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {func()}"]
+
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path=None):
+    '''
+    Writes the metrics to a file for the node exporter textfile collector
+
+    Args:
+        path: Destination file. Defaults to the METRICS_FILE env variable
+
+    Returns:
+        Path written to or None if no path is configured
+    '''
+    path = path or os.getenv("METRICS_FILE")
+    if not path:
+        return None
+
+    # Write then rename so the collector never reads a half written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+    return path
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=None):
+    '''
+    Serves /metrics over HTTP on a daemon thread
+
+    Args:
+        port: Port to listen on. Defaults to the METRICS_PORT env variable
+
+    Returns:
+        The server or None if no port is configured
+    '''
+    port = port or os.getenv("METRICS_PORT")
+    if not port:
+        return None
+
+    server = http.server.ThreadingHTTPServer(("", int(port)), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    logger.info(f"Metrics server listening on port {port}")
+    return server
+
+
+def summary():
+    '''
+    Builds a readable table of the metrics
+
+    Returns:
+        String with one line per operation
+    '''
+    header = f"{'Operation':<32}{'Calls':>8}{'Errors':>8}{'Avg ms':>10}{'p95 ms':>10}{'Max ms':>10}{'Queries':>10}{'Rows':>10}"
+    lines = [header, "-" * len(header)]
+
+    with _lock:
+        for s in sorted(_stats.values(), key=lambda s: s.name):
+            avg = (s.latency_sum / s.calls * 1000) if s.calls else 0
+            lines.append(f"{s.name:<32}{s.calls:>8}{s.errors:>8}{avg:>10.2f}"
+                         f"{s.percentile(0.95) * 1000:>10.1f}{s.latency_max * 1000:>10.2f}"
+                         f"{s.round_trips:>10}{s.rows_fetched:>10}")
+
+    if len(lines) == 2:
+        lines.append("No operations recorded yet")
+
+    with _lock:
+        gauges = sorted(_gauges.items())
+
+    for name, (_, func) in gauges:
+        lines.append(f"{name}: {func()}")
+    return "\n".join(lines)
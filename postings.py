@@ -0,0 +1,209 @@
+import calendar
+import datetime
+import argparse
+import logging
+import utils
+import json
+import time
+
+logger = logging.getLogger('banking_postings')
+
+'''
+Interest and fee posting engine
+
+Applies a rate schedule per currency to all eligible Accounts rows. Every
+chunk of account_ids is posted with one statement that claims the chunk
+in PostingRuns, updates the balances and writes the matching Transactions
+rows, and commits on its own. Only accounts the update actually changed
+get a Transactions row.
+
+Each (run_date, kind, chunk) can only be claimed once, so rerunning a
+failed or interrupted run posts only the chunks that are missing.
+
+Usage:
+    python postings.py --run-date 2026-09-30 --schedule schedule.json
+'''
+
+# Annual interest in basis points and monthly fee in minor units, per currency
+DEFAULT_SCHEDULE = {
+    "USD": {"interest_bps": 150, "monthly_fee": 200},
+    "EUR": {"interest_bps": 100, "monthly_fee": 200},
+    "GBP": {"interest_bps": 125, "monthly_fee": 150},
+    "JPY": {"interest_bps": 10, "monthly_fee": 300},
+}
+
+KINDS = ("interest", "fee")
+
+# Interest is rounded half away from zero to whole minor units
+_INTEREST_DUE = """
+    SELECT a.account_id, a.user_id, a.currency_id,
+           round(a.balance::numeric * r.interest_bps * %(days)s / 3650000)::bigint AS delta
+    FROM Accounts a JOIN rates r ON r.currency_id = a.currency_id
+    WHERE a.account_id BETWEEN %(chunk_start)s AND %(chunk_end)s
+    AND a.is_active AND a.balance > 0 AND r.interest_bps > 0
+    AND EXISTS (SELECT 1 FROM run)"""
+
+_FEE_DUE = """
+    SELECT a.account_id, a.user_id, a.currency_id, -r.monthly_fee AS delta
+    FROM Accounts a JOIN rates r ON r.currency_id = a.currency_id
+    WHERE a.account_id BETWEEN %(chunk_start)s AND %(chunk_end)s
+    AND a.is_active AND r.monthly_fee > 0 AND a.balance >= r.monthly_fee
+    AND EXISTS (SELECT 1 FROM run)"""
+
+_POST_CHUNK = """
+    WITH run AS (
+        INSERT INTO PostingRuns (run_date, kind, chunk_start, chunk_end)
+        VALUES (%(run_date)s, %(kind)s, %(chunk_start)s, %(chunk_end)s)
+        ON CONFLICT DO NOTHING
+        RETURNING run_date),
+    rates (currency_id, interest_bps, monthly_fee) AS (
+        SELECT * FROM unnest(%(currency_ids)s::smallint[], %(interest)s::integer[], %(fees)s::bigint[])),
+    due AS ({due}),
+    posted AS (
+        UPDATE Accounts a SET balance = a.balance + d.delta
+        FROM due d
+        WHERE a.account_id = d.account_id AND d.delta <> 0
+        -- due read the snapshot balance, recheck against the row actually
+        -- updated so a concurrent withdrawal can't be driven negative by a fee
+        AND a.is_active AND a.balance + d.delta >= 0
+        RETURNING a.account_id, a.user_id, a.currency_id, d.delta),
+    ledger AS (
+        INSERT INTO Transactions (tx_time, tx_id, type_id, from_user_id, from_account_id,
+                                  to_user_id, to_account_id, amount, currency_id)
+        SELECT %(tx_time)s, uuid_v7(), %(tx_type)s,
+               CASE WHEN delta < 0 THEN user_id END, CASE WHEN delta < 0 THEN account_id END,
+               CASE WHEN delta > 0 THEN user_id END, CASE WHEN delta > 0 THEN account_id END,
+               abs(delta), currency_id
+        FROM posted
+        RETURNING 1)
+    SELECT (SELECT COUNT(*) FROM run), (SELECT COUNT(*) FROM ledger)"""
+
+
+def load_schedule(path=None):
+    '''
+    Loads the rate schedule
+
+    Args:
+        path: JSON file like {"USD": {"interest_bps": 150, "monthly_fee": 200}}.
+            Uses DEFAULT_SCHEDULE when not given
+
+    Returns:
+        Dictionary of currency_code to its rates
+    '''
+    if not path:
+        return DEFAULT_SCHEDULE
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def _check_chunk_size(cur, run_date, kind, chunk_size):
+    '''Refuses to resume a run with a different chunk size, which could post an account twice'''
+    cur.execute("SELECT chunk_end - chunk_start + 1 FROM PostingRuns WHERE run_date = %s AND kind = %s LIMIT 1",
+                (run_date, kind))
+    rows = cur.fetchone()
+
+    if rows and rows[0] != chunk_size:
+        raise ValueError(f"{kind} for {run_date} was started with chunk size {rows[0]}, not {chunk_size}")
+
+
+def post(run_date, schedule=None, kinds=KINDS, chunk_size=50000, accrual_days=None):
+    '''
+    Posts interest and fees for every eligible account
+
+    Args:
+        run_date: Date the postings are for. One run per date and kind
+        schedule: Rate schedule per currency. Defaults to DEFAULT_SCHEDULE
+        kinds: Which of interest and fee to post
+        chunk_size: account_ids per chunk. Must not change when resuming
+        accrual_days: Days of interest to accrue. Defaults to the days in run_date's month
+
+    Returns:
+        Dictionary per kind with chunks posted, chunks skipped and transactions written
+    '''
+    schedule = schedule or DEFAULT_SCHEDULE
+    accrual_days = accrual_days or calendar.monthrange(run_date.year, run_date.month)[1]
+    # Currencies the bank doesn't hold have no accounts to post to
+    utils.load_currency_table()
+    codes = [code for code in schedule if code in utils.currency_ids]
+
+    params = {
+        "run_date": run_date,
+        "days": accrual_days,
+        "currency_ids": [utils.currency_ids[code] for code in codes],
+        "interest": [int(schedule[code].get("interest_bps", 0)) for code in codes],
+        "fees": [int(schedule[code].get("monthly_fee", 0)) for code in codes],
+        "tx_time": datetime.datetime.combine(run_date, datetime.time(23, 59, 59)),
+    }
+    result = {}
+    conn = utils.open_connection()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(account_id), 0) FROM Accounts")
+            max_id = cur.fetchone()[0]
+
+        for kind in kinds:
+            if kind == "interest":
+                sql = _POST_CHUNK.format(due=_INTEREST_DUE)
+                params.update(kind=kind, tx_type=utils.TX_TYPES["Interest"])
+            elif kind == "fee":
+                sql = _POST_CHUNK.format(due=_FEE_DUE)
+                params.update(kind=kind, tx_type=utils.TX_TYPES["Fee"])
+            else:
+                raise ValueError(f"Unknown posting kind: {kind}")
+
+            with conn.cursor() as cur:
+                _check_chunk_size(cur, run_date, kind, chunk_size)
+            conn.commit()
+
+            started = time.perf_counter()
+            stats = {"chunks_posted": 0, "chunks_skipped": 0, "transactions": 0}
+
+            # Chunk boundaries are fixed multiples of chunk_size so reruns line up
+            for chunk_start in range(0, max_id + 1, chunk_size):
+                params.update(chunk_start=chunk_start, chunk_end=chunk_start + chunk_size - 1)
+
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute(sql, params)
+                        claimed, posted = cur.fetchone()
+
+                        if claimed:
+                            cur.execute("UPDATE PostingRuns SET posted = %s " \
+                                        "WHERE run_date = %s AND kind = %s AND chunk_start = %s",
+                                        (posted, run_date, kind, chunk_start))
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    logger.error(f"Failed to post {kind} chunk {chunk_start}: {e}")
+                    raise
+
+                if claimed:
+                    stats["chunks_posted"] += 1
+                    stats["transactions"] += posted
+                else:
+                    stats["chunks_skipped"] += 1
+
+            stats["seconds"] = round(time.perf_counter() - started, 2)
+            result[kind] = stats
+            logger.info(f"Posted {kind} for {run_date}: {stats}")
+    finally:
+        conn.close()
+
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Post interest and fees to all eligible accounts")
+    parser.add_argument("--run-date", type=datetime.date.fromisoformat, default=datetime.date.today())
+    parser.add_argument("--schedule", help="JSON rate schedule per currency")
+    parser.add_argument("--kinds", nargs="+", choices=KINDS, default=list(KINDS))
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    parser.add_argument("--accrual-days", type=int, default=None)
+    args = parser.parse_args()
+
+    utils.create_tables()
+    print(post(args.run_date, load_schedule(args.schedule), args.kinds, args.chunk_size, args.accrual_days))
+
+# Godspeed
@@ -0,0 +1,538 @@
+import requests.adapters
+import datetime
+import threading
+import requests
+import logging
+import metrics
+import bisect
+import utils
+import types
+import json
+import os
+
+logger = logging.getLogger('banking_rates')
+
+'''
+Exchange rate history
+
+Every snapshot of rates fetched from the API is stored in ExchangeRates as
+one row per currency, keyed by (snapshot_time, currency_code). Rates are
+kept per USD as fixed-point integers scaled by utils.RATE_SCALE, the same
+form the money helpers use.
+
+An in-memory index keeps one sorted series of times per currency, so
+"rate for a pair at time T" is a binary search instead of a query. It
+holds the last RATE_HISTORY_DAYS days; older as-of lookups query the table.
+
+Rates come from a provider chosen by RATE_PROVIDER: "http" for the live
+API, or "file" to read RATE_FILE for offline and test runs.
+
+A background thread refreshes the rates every RATE_REFRESH_SECONDS and
+swaps in a new immutable RateSnapshot, so converting money never waits
+on the provider.
+'''
+
+
+class RateUnavailableError(Exception):
+    '''Raised when a provider can't supply rates'''
+
+
+class RateProvider():
+    '''Source of per-USD exchange rates'''
+    def fetch(self, currencies=None):
+        '''
+        Fetches the latest rates
+
+        Args:
+            currencies: Currency codes needed. Fetches every available currency when not given
+
+        Returns:
+            Dictionary of currency_code to units per USD
+        '''
+        raise NotImplementedError
+
+
+class HttpRateProvider(RateProvider):
+    '''Fetches rates from freecurrencyapi over one keep-alive session'''
+    URL = "https://api.freecurrencyapi.com/v1/latest"
+
+    def __init__(self, api_key, timeout=10.0):
+        self.timeout = (min(timeout, 3.05), timeout)
+        self.session = requests.Session()
+        self.session.headers["apikey"] = api_key or ""
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=4, max_retries=1))
+
+    def fetch(self, currencies=None):
+        params = {}
+        if currencies:
+            params["currencies"] = ",".join(sorted(set(currencies) - {"USD"}))
+
+        try:
+            resp = self.session.get(self.URL, params=params, timeout=self.timeout)
+            resp.raise_for_status()
+            return resp.json()["data"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            raise RateUnavailableError(f"Rate API request failed: {e}") from e
+
+
+class FileRateProvider(RateProvider):
+    '''Reads rates from a JSON file shaped like the API response, {"data": {"EUR": 0.92}}'''
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self, currencies=None):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise RateUnavailableError(f"Can't read rate file {self.path}: {e}") from e
+
+        data = data.get("data", data)
+        if currencies:
+            data = {code: rate for code, rate in data.items() if code in currencies}
+        return data
+
+
+_provider = None
+
+
+def get_provider():
+    '''
+    Gets the configured rate provider
+
+    Returns:
+        FileRateProvider when RATE_PROVIDER=file, otherwise HttpRateProvider
+    '''
+    global _provider
+
+    if _provider is None:
+        kind = os.getenv("RATE_PROVIDER", "http")
+        if kind == "file":
+            _provider = FileRateProvider(os.getenv("RATE_FILE", "rates.json"))
+        elif kind == "http":
+            _provider = HttpRateProvider(os.getenv("API_KEY", os.getenv("api_key")),
+                                         float(os.getenv("RATE_TIMEOUT_SECONDS", "10")))
+        else:
+            raise ValueError(f"Unknown RATE_PROVIDER: {kind}")
+        logger.info(f"Using {type(_provider).__name__} for exchange rates")
+
+    return _provider
+
+
+def cross_rate_fixed(usd_rates, to_currency, from_currency):
+    '''
+    Cross rate between two currencies from one snapshot of per-USD rates
+
+    Args:
+        usd_rates: Dictionary of currency_code to fixed-point units per USD
+        to_currency: Currency you want to transfer to
+        from_currency: Currency you're transferring from
+
+    Returns:
+        Units of to_currency per unit of from_currency, times utils.RATE_SCALE
+    '''
+    to_rate = utils.RATE_SCALE if to_currency == "USD" else usd_rates[to_currency]
+    from_rate = utils.RATE_SCALE if from_currency == "USD" else usd_rates[from_currency]
+
+    return utils.round_div(to_rate * utils.RATE_SCALE, from_rate)
+
+
+# Days of snapshots the as-of index keeps in memory
+HISTORY_DAYS = float(os.getenv("RATE_HISTORY_DAYS", "30"))
+
+
+class RateHistory():
+    '''
+    As-of index of per-USD rates, one sorted series per currency
+
+    Args:
+        max_age: timedelta of history kept behind the newest snapshot. Keeps everything when None
+    '''
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        # Earliest time the index can answer for. None while it holds every stored snapshot
+        self.since = None
+        self._times = {}
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def covers(self, when):
+        '''Whether a lookup at when can be answered from memory'''
+        since = self.since
+        return since is None or when >= since
+
+    def add(self, snapshot_time, usd_rates):
+        '''
+        Adds one snapshot to the index
+
+        Args:
+            snapshot_time: When the rates were fetched
+            usd_rates: Dictionary of currency_code to fixed-point units per USD
+        '''
+        with self._lock:
+            for currency_code, rate in usd_rates.items():
+                times = self._times.setdefault(currency_code, [])
+                rates = self._rates.setdefault(currency_code, [])
+
+                # Snapshots nearly always arrive in order, so this is an append
+                i = bisect.bisect_right(times, snapshot_time)
+                if i and times[i - 1] == snapshot_time:
+                    rates[i - 1] = rate
+                else:
+                    times.insert(i, snapshot_time)
+                    rates.insert(i, rate)
+
+            if self.max_age is not None:
+                self._trim(snapshot_time - self.max_age)
+
+    def _trim(self, cutoff):
+        '''Drops snapshots before cutoff, keeping the one in effect at cutoff'''
+        if self.since is not None and cutoff <= self.since:
+            return
+
+        for currency_code, times in self._times.items():
+            i = bisect.bisect_right(times, cutoff) - 1
+            if i > 0:
+                del times[:i]
+                del self._rates[currency_code][:i]
+        self.since = cutoff
+
+    def usd_rate_at(self, currency_code, when):
+        '''
+        Gets the per-USD rate of a currency in effect at a point in time
+
+        Returns:
+            Fixed-point units per USD from the latest snapshot at or before when
+        '''
+        if currency_code == "USD":
+            return utils.RATE_SCALE
+
+        with self._lock:
+            times = self._times.get(currency_code, [])
+            i = bisect.bisect_right(times, when)
+            if not i:
+                raise LookupError(f"No {currency_code} rate recorded at or before {when}")
+            return self._rates[currency_code][i - 1]
+
+    def rate_at(self, to_currency, from_currency, when):
+        '''
+        Gets the cross rate of a pair in effect at a point in time
+
+        Returns:
+            Units of to_currency per unit of from_currency, times utils.RATE_SCALE
+        '''
+        usd_rates = {code: self.usd_rate_at(code, when) for code in (to_currency, from_currency)}
+        return cross_rate_fixed(usd_rates, to_currency, from_currency)
+
+    def __len__(self):
+        with self._lock:
+            return max((len(times) for times in self._times.values()), default=0)
+
+
+history = RateHistory(datetime.timedelta(days=HISTORY_DAYS))
+_history_loaded = False
+_load_lock = threading.Lock()
+
+
+def record_snapshot(snapshot_time, fixed):
+    '''
+    Adds a snapshot to the in-memory index and stores it in ExchangeRates
+
+    Storing is best effort. A database outage is logged and the snapshot is
+    still used, so it can't stop rates from refreshing
+
+    Args:
+        snapshot_time: When the rates were fetched
+        fixed: Dictionary of currency_code to fixed-point units per USD
+
+    Returns:
+        True if the snapshot was stored, False if only the index has it
+    '''
+    history.add(snapshot_time, fixed)
+    conn = None
+
+    try:
+        conn = utils.connect_to_db()
+        with conn.cursor() as cur:
+            # One statement for the whole snapshot
+            cur.execute("""INSERT INTO ExchangeRates (snapshot_time, currency_code, rate)
+                           SELECT %s, * FROM unnest(%s::varchar[], %s::bigint[])
+                           ON CONFLICT DO NOTHING""",
+                        (snapshot_time, list(fixed), list(fixed.values())))
+        conn.commit()
+        logger.info(f"Recorded {len(fixed)} exchange rates at {snapshot_time}")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to record exchange rates taken at {snapshot_time}: {e}")
+        if conn:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        return False
+    finally:
+        utils.release_conn(conn)
+
+
+def load_history(since=None):
+    '''
+    Loads stored snapshots into the in-memory index
+
+    Args:
+        since: Only load snapshots in effect at or after this time. Loads all when not given
+
+    Returns:
+        Number of rates loaded
+    '''
+    conn = None
+    loaded = 0
+    since = since or datetime.datetime.min
+
+    try:
+        conn = utils.connect_to_db(read_only=True)
+        with conn.cursor() as cur:
+            # Starts from the last snapshot at or before since, which is the one in effect then
+            cur.execute("SELECT snapshot_time, array_agg(currency_code), array_agg(rate) FROM ExchangeRates " \
+                        "WHERE snapshot_time >= COALESCE((SELECT max(snapshot_time) FROM ExchangeRates " \
+                        "WHERE snapshot_time <= %s), %s) GROUP BY snapshot_time ORDER BY snapshot_time",
+                        (since, since))
+
+            for snapshot_time, codes, rates in cur:
+                history.add(snapshot_time, dict(zip(codes, rates)))
+                loaded += len(codes)
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Failed to load exchange rate history: {e}")
+        raise
+    finally:
+        utils.release_conn(conn)
+
+    if since > datetime.datetime.min and (history.since is None or since > history.since):
+        history.since = since
+
+    logger.info(f"Loaded {loaded} exchange rates into the as-of index")
+    return loaded
+
+
+def _stored_usd_rate(cur, currency_code, when):
+    '''Reads the per-USD rate in effect at when from ExchangeRates'''
+    if currency_code == "USD":
+        return utils.RATE_SCALE
+
+    cur.execute("SELECT rate FROM ExchangeRates WHERE currency_code = %s AND snapshot_time <= %s " \
+                "ORDER BY snapshot_time DESC LIMIT 1", (currency_code, when))
+    row = cur.fetchone()
+    if row is None:
+        raise LookupError(f"No {currency_code} rate recorded at or before {when}")
+    return row[0]
+
+
+def stored_rate_at(to_currency, from_currency, when):
+    '''
+    Gets the cross rate of a pair at a point in time from ExchangeRates
+
+    Used for lookups older than the in-memory index holds.
+
+    Returns:
+        Units of to_currency per unit of from_currency, times utils.RATE_SCALE
+    '''
+    conn = None
+    try:
+        conn = utils.connect_to_db(read_only=True)
+        with conn.cursor() as cur:
+            usd_rates = {code: _stored_usd_rate(cur, code, when) for code in (to_currency, from_currency)}
+        conn.commit()
+    finally:
+        utils.release_conn(conn)
+
+    return cross_rate_fixed(usd_rates, to_currency, from_currency)
+
+
+def rate_at(to_currency, from_currency, when):
+    '''
+    Gets the rate a pair was converted at, at a point in time
+
+    Loads the last RATE_HISTORY_DAYS of stored history on first use and
+    answers from memory. Older points in time are read from ExchangeRates.
+
+    Args:
+        to_currency: Currency you want to transfer to
+        from_currency: Currency you're transferring from
+        when: Point in time, e.g a transaction's tx_time
+
+    Returns:
+        Units of to_currency per unit of from_currency, times utils.RATE_SCALE
+    '''
+    global _history_loaded
+
+    if not _history_loaded:
+        with _load_lock:
+            if not _history_loaded:
+                load_history(datetime.datetime.now() - history.max_age if history.max_age else None)
+                _history_loaded = True
+
+    if not history.covers(when):
+        return stored_rate_at(to_currency, from_currency, when)
+    return history.rate_at(to_currency, from_currency, when)
+
+
+def fetch_snapshot(currencies=None):
+    '''
+    Fetches rates from the configured provider. The caller records them with
+    record_snapshot once they are in use
+
+    Args:
+        currencies: Currency codes needed. Fetches every available currency when not given
+
+    Returns:
+        Tuple of (snapshot_time, dictionary of currency_code to fixed-point units per USD)
+    '''
+    try:
+        usd_rates = get_provider().fetch(currencies)
+    except RateUnavailableError as e:
+        logger.error(f"Failed to fetch exchange rates: {e}")
+        raise
+
+    missing = set(currencies or ()) - set(usd_rates) - {"USD"}
+    if missing:
+        logger.warning(f"Provider has no rate for {', '.join(sorted(missing))}")
+
+    return datetime.datetime.now(), {code: utils.rate_to_fixed(rate) for code, rate in usd_rates.items()}
+
+
+class RateSnapshot():
+    '''One set of per-USD rates, never changed after it is built'''
+    def __init__(self, taken_at, usd_rates):
+        self.taken_at = taken_at
+        self.usd_rates = types.MappingProxyType(dict(usd_rates))
+
+    def rate(self, to_currency, from_currency):
+        '''
+        Gets the cross rate of a pair from this snapshot
+
+        Returns:
+            Units of to_currency per unit of from_currency, times utils.RATE_SCALE
+        '''
+        try:
+            return cross_rate_fixed(self.usd_rates, to_currency, from_currency)
+        except KeyError as e:
+            raise RateUnavailableError(f"No rate for {e.args[0]} in the snapshot taken at {self.taken_at}") from e
+
+    def age(self):
+        '''Seconds since the snapshot was taken'''
+        return (datetime.datetime.now() - self.taken_at).total_seconds()
+
+
+# Replaced as a whole by the refresher. Readers take the reference once and use it without locking
+_snapshot = None
+_refresher = None
+_refresher_lock = threading.Lock()
+
+REFRESH_SECONDS = float(os.getenv("RATE_REFRESH_SECONDS", "60"))
+
+# Snapshots older than this are refused, so a provider outage stops quoting instead of trading at old rates
+MAX_AGE_SECONDS = float(os.getenv("RATE_MAX_AGE_SECONDS", "900"))
+
+
+def refresh():
+    '''
+    Fetches rates for every supported currency and swaps in a new snapshot
+
+    Returns:
+        The new RateSnapshot
+    '''
+    global _snapshot
+
+    currencies = set(utils.load_currency_table()) - {"USD"}
+    snapshot_time, fixed = fetch_snapshot(currencies)
+    snapshot = RateSnapshot(snapshot_time, fixed)
+    _snapshot = snapshot
+    logger.info(f"Swapped in exchange rate snapshot taken at {snapshot.taken_at}")
+
+    # Stored after the swap, a database outage must not hold back fresh rates
+    record_snapshot(snapshot_time, fixed)
+    return snapshot
+
+
+class RateRefresher(threading.Thread):
+    '''Daemon thread that refreshes the rate snapshot every interval seconds'''
+    def __init__(self, interval):
+        super().__init__(name="rate-refresher", daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                refresh()
+            except Exception as e:
+                # Keep serving the previous snapshot and try again next interval
+                logger.error(f"Failed to refresh exchange rates: {e}")
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_refresher(interval=None):
+    '''
+    Takes a first snapshot and starts refreshing it in the background
+
+    Args:
+        interval: Seconds between refreshes. Defaults to RATE_REFRESH_SECONDS
+
+    Returns:
+        The running RateRefresher
+    '''
+    global _refresher
+
+    with _refresher_lock:
+        if _refresher is not None:
+            return _refresher
+
+        try:
+            refresh()
+        except Exception as e:
+            logger.error(f"Failed to take the first exchange rate snapshot: {e}")
+
+        _refresher = RateRefresher(interval or REFRESH_SECONDS)
+        _refresher.start()
+        return _refresher
+
+
+def current(max_age=None):
+    '''
+    Gets the current rate snapshot without blocking on the provider
+
+    Starts the refresher on first use when nothing started it.
+
+    Args:
+        max_age: Oldest snapshot accepted, in seconds. Defaults to RATE_MAX_AGE_SECONDS, 0 accepts any age
+
+    Returns:
+        The current RateSnapshot
+
+    Raises:
+        RateUnavailableError: No snapshot yet, or the refresher hasn't replaced it within max_age
+    '''
+    snapshot = _snapshot
+    if snapshot is None:
+        start_refresher()
+        snapshot = _snapshot
+        if snapshot is None:
+            raise RateUnavailableError("No exchange rates have been fetched yet")
+
+    max_age = MAX_AGE_SECONDS if max_age is None else max_age
+    age = snapshot.age()
+    if max_age and age > max_age:
+        raise RateUnavailableError(f"Exchange rates are {age:.0f} seconds old, the limit is {max_age:.0f}")
+    return snapshot
+
+
+def snapshot_age():
+    '''Seconds since the current snapshot was taken, or NaN when there is none'''
+    snapshot = _snapshot
+    return snapshot.age() if snapshot else float("nan")
+
+
+metrics.register_gauge("bank_rate_snapshot_age_seconds",
+                       "Seconds since the exchange rate snapshot in use was taken", snapshot_age)
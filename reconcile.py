@@ -0,0 +1,219 @@
+import multiprocessing
+import numpy as np
+import datetime
+import argparse
+import psycopg2
+import logging
+import archive
+import utils
+import time
+import csv
+
+logger = logging.getLogger('banking_reconcile')
+
+'''
+Balance reconciliation job
+
+Checks that every Accounts.balance equals the net of its transactions.
+Accounts are split into fixed account_id ranges and handed to a process
+pool. Each worker streams its range's transactions in chunks and sums the
+flows per account with np.add.at in exact int64, then compares them to the stored
+balances read in the same REPEATABLE READ snapshot.
+
+Runs are incremental. ReconcileRanges keeps, per range, the net flow of
+every account over all transactions with a tx_id below its high water
+mark, so the next run only streams newer tx_ids. tx_ids are UUIDv7 stamped
+at insert time, and the mark trails the snapshot by --grace-seconds so a
+transaction that got its id earlier but committed later is not skipped.
+
+Bulk loads with backdated ids, like seed_data.py or utils.migrate_tx_ids,
+land below the mark. Run with --full after them.
+
+Usage:
+    python reconcile.py --workers 8 --report mismatches.csv
+'''
+
+# Rows fetched per round trip from the server-side cursor
+FETCH_SIZE = 100000
+
+REPORT_COLUMNS = ["account_id", "balance", "expected", "difference"]
+
+_RANGE_FLOWS = """
+    SELECT account_id, amount, settled FROM (
+        SELECT to_account_id AS account_id, amount, tx_id < %(new_high_water)s AS settled
+        FROM Transactions
+        WHERE to_account_id BETWEEN %(first_id)s AND %(last_id)s
+        AND (%(high_water)s::uuid IS NULL OR tx_id >= %(high_water)s)
+        UNION ALL
+        SELECT from_account_id, -amount, tx_id < %(new_high_water)s
+        FROM Transactions
+        WHERE from_account_id BETWEEN %(first_id)s AND %(last_id)s
+        AND (%(high_water)s::uuid IS NULL OR tx_id >= %(high_water)s)) flows"""
+
+
+def _accumulate(totals, offsets, amounts):
+    '''Adds amounts into totals per offset in int64. np.bincount sums float64 weights, which round past 2**53'''
+    np.add.at(totals, offsets, np.asarray(amounts, dtype=np.int64))
+
+
+def _reconcile_range(task):
+    '''
+    Worker: reconciles accounts first_id..last_id
+
+    Returns:
+        Tuple of (first_id, accounts checked, transactions streamed, mismatch rows)
+    '''
+    first_id, last_id, full, grace_seconds = task
+    size = last_id - first_id + 1
+    conn = utils.open_connection()
+
+    try:
+        with conn.cursor() as cur:
+            # Balances and transactions from one snapshot, so in-flight transfers can't show as drift
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cur.execute("SELECT now()")
+            snapshot_time = cur.fetchone()[0]
+
+            cur.execute("SELECT high_water, nets FROM ReconcileRanges WHERE first_id = %s AND last_id = %s FOR UPDATE",
+                        (first_id, last_id))
+            state = cur.fetchone()
+
+            if state and not full:
+                high_water = str(state[0])
+                settled = np.frombuffer(bytes(state[1]), dtype=np.int64).copy()
+            else:
+                # Archived transactions are only read on a full run, later runs carry them in the nets
+                high_water = None
+                settled = np.zeros(size, dtype=np.int64)
+                account_ids, amounts = archive.account_flows(cur, first_id, last_id)
+                if len(account_ids):
+                    _accumulate(settled, np.asarray(account_ids) - first_id, amounts)
+
+            new_high_water = utils.tx_id_floor(snapshot_time - datetime.timedelta(seconds=grace_seconds))
+            if high_water and new_high_water < high_water:
+                new_high_water = high_water
+
+            cur.execute("SELECT account_id, balance FROM Accounts WHERE account_id BETWEEN %s AND %s",
+                        (first_id, last_id))
+            accounts = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+
+        pending = np.zeros(size, dtype=np.int64)
+        streamed = 0
+
+        with conn.cursor(name=f"reconcile_{first_id}") as cur:
+            cur.itersize = FETCH_SIZE
+            cur.execute(_RANGE_FLOWS, {"first_id": first_id, "last_id": last_id,
+                                       "high_water": high_water, "new_high_water": new_high_water})
+
+            while True:
+                batch = cur.fetchmany(FETCH_SIZE)
+                if not batch:
+                    break
+
+                chunk = np.array(batch, dtype=np.int64)
+                offsets, amounts, is_settled = chunk[:, 0] - first_id, chunk[:, 1], chunk[:, 2].astype(bool)
+                _accumulate(settled, offsets[is_settled], amounts[is_settled])
+                _accumulate(pending, offsets[~is_settled], amounts[~is_settled])
+                streamed += len(batch)
+
+        with conn.cursor() as cur:
+            cur.execute("INSERT INTO ReconcileRanges (first_id, last_id, high_water, nets, updated_at) " \
+                        "VALUES (%s, %s, %s, %s, %s) ON CONFLICT (first_id) DO UPDATE " \
+                        "SET last_id = EXCLUDED.last_id, high_water = EXCLUDED.high_water, " \
+                        "nets = EXCLUDED.nets, updated_at = EXCLUDED.updated_at",
+                        (first_id, last_id, new_high_water, psycopg2.Binary(settled.tobytes()), snapshot_time))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Failed to reconcile accounts {first_id}-{last_id}: {e}")
+        raise
+    finally:
+        conn.close()
+
+    expected = (settled + pending)[accounts[:, 0] - first_id]
+    drift = np.flatnonzero(accounts[:, 1] != expected)
+    mismatches = [(int(accounts[i, 0]), int(accounts[i, 1]), int(expected[i]), int(accounts[i, 1] - expected[i]))
+                  for i in drift]
+
+    return first_id, len(accounts), streamed, mismatches
+
+
+def reconcile(workers=4, range_size=100000, full=False, grace_seconds=300, report=None):
+    '''
+    Reconciles every account's balance with its transactions
+
+    Args:
+        workers: Number of worker processes
+        range_size: account_ids per range. Changing it starts every range afresh
+        full: Ignores the high water marks and recomputes every range
+        grace_seconds: How far the new high water mark trails the snapshot
+        report: CSV path for the mismatched accounts
+
+    Returns:
+        Dictionary with accounts checked, transactions streamed, mismatches
+        and the largest differences
+    '''
+    conn = utils.connect_to_db()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(account_id), 0) FROM Accounts")
+            max_id = cur.fetchone()[0]
+        conn.commit()
+    finally:
+        utils.release_conn(conn)
+
+    # Range boundaries are fixed multiples of range_size so the saved nets line up between runs
+    tasks = [(first, first + range_size - 1, full, grace_seconds) for first in range(0, max_id + 1, range_size)]
+
+    started = time.perf_counter()
+    checked = streamed = 0
+    mismatches = []
+
+    with multiprocessing.Pool(workers) as pool:
+        for _, accounts, rows, drift in pool.imap_unordered(_reconcile_range, tasks):
+            checked += accounts
+            streamed += rows
+            mismatches.extend(drift)
+            print(f"\rAccounts {checked:,}  transactions {streamed:,}  mismatches {len(mismatches):,}",
+                  end="", flush=True)
+    print()
+
+    mismatches.sort(key=lambda row: -abs(row[3]))
+
+    if report:
+        with open(report, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(REPORT_COLUMNS)
+            writer.writerows(mismatches)
+
+    result = {
+        "ranges": len(tasks),
+        "accounts": checked,
+        "transactions_streamed": streamed,
+        "full": full,
+        "mismatches": len(mismatches),
+        "largest": [dict(zip(REPORT_COLUMNS, row)) for row in mismatches[:10]],
+        "seconds": round(time.perf_counter() - started, 2),
+    }
+
+    if mismatches:
+        logger.warning(f"Reconciliation found {len(mismatches)} accounts whose balance doesn't match: {result}")
+    else:
+        logger.info(f"Reconciliation clean: {result}")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check account balances against their transactions")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--range-size", type=int, default=100000)
+    parser.add_argument("--full", action="store_true", help="Recompute every range from scratch")
+    parser.add_argument("--grace-seconds", type=float, default=300)
+    parser.add_argument("--report", help="CSV file for the mismatched accounts")
+    args = parser.parse_args()
+
+    utils.create_tables()
+    print(reconcile(args.workers, args.range_size, args.full, args.grace_seconds, args.report))
+
+# Godspeed
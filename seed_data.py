@@ -0,0 +1,374 @@
+import multiprocessing
+import datetime
+import argparse
+import logging
+import random
+import utils
+import time
+import io
+
+logger = logging.getLogger('banking_seed')
+
+'''
+Synthetic data generator
+
+Seeds Users, Accounts and Transactions with realistic volume for scale
+testing. Every chunk gets its own random generator derived from the seed,
+so the output is the same no matter how many workers load it.
+
+Usage:
+    python seed_data.py --users 1000000 --transactions 100000000 --workers 8
+'''
+
+# Currencies ordered by popularity, with the weight of being a user's home currency
+CURRENCY_WEIGHTS = [
+    ('USD', 40),
+    ('EUR', 25),
+    ('GBP', 15),
+    ('JPY', 8),
+    ('CAD', 5),
+    ('AUD', 4),
+    ('CHF', 3),
+]
+CURRENCIES = [code for code, _ in CURRENCY_WEIGHTS]
+MAX_ACCOUNTS_PER_USER = 4
+
+# Transaction mix
+TX_TYPES = ['Deposit', 'Withdraw', 'Transfer']
+TX_WEIGHTS = [40, 35, 25]
+
+# Share of activity per hour of day, busiest during working hours
+HOUR_WEIGHTS = [1, 1, 1, 1, 1, 2, 4, 6, 8, 9, 9, 9, 10, 9, 9, 8, 8, 8, 7, 6, 5, 4, 2, 1]
+
+# All synthetic users share this password
+SEED_PASSWORD = "password123"
+
+
+def _mix(value):
+    '''
+    Cheap deterministic integer hash (splitmix64 finaliser)
+
+    Args:
+        value: Integer to hash
+
+    Returns:
+        64 bit integer
+    '''
+    value = (value + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return value ^ (value >> 31)
+
+
+def _home_currency_index(user_id, seed):
+    '''Picks the home currency of a user from the popularity weights'''
+    total = sum(weight for _, weight in CURRENCY_WEIGHTS)
+    point = _mix(user_id * 31 + seed) % total
+
+    for i, (_, weight) in enumerate(CURRENCY_WEIGHTS):
+        if point < weight:
+            return i
+        point -= weight
+    return 0
+
+
+def account_layout(user_id, seed):
+    '''
+    Gets the accounts owned by a user.
+
+    The layout is a pure function of user_id and seed so that every worker
+    can find a user's accounts without a lookup. Account ids are
+    slot-based: (user_id - 1) * MAX_ACCOUNTS_PER_USER + slot + 1
+
+    Args:
+        user_id: ID of the user
+        seed: Generator seed
+
+    Returns:
+        Dictionary of currency code to account_id
+    '''
+    # Most users hold one or two currencies
+    count = min(1 + (_mix(user_id + seed) % 8) // 3, MAX_ACCOUNTS_PER_USER)
+    home = _home_currency_index(user_id, seed)
+
+    accounts = {}
+    for slot in range(count):
+        code = CURRENCIES[(home + slot) % len(CURRENCIES)]
+        accounts[code] = (user_id - 1) * MAX_ACCOUNTS_PER_USER + slot + 1
+    return accounts
+
+
+def _minor_units(value, currency_code):
+    '''Turns a generated major unit amount into integer minor units, at least 1'''
+    exponent, _ = utils.DEFAULT_CURRENCIES.get(currency_code, (utils.DEFAULT_EXPONENT, ''))
+    return max(round(value * 10 ** exponent), 1)
+
+
+def _skewed_user(rng, num_users, skew):
+    '''
+    Picks a user with a heavy-tailed activity distribution.
+
+    Low ranks are picked far more often. The rank is scattered over the
+    id space with a multiplicative permutation, so the busy users aren't
+    all clustered at the lowest ids.
+    '''
+    rank = int(num_users * (rng.random() ** skew))
+    rank = min(rank, num_users - 1)
+    return (rank * 2654435761) % num_users + 1
+
+
+def _skewed_time(rng, start, days, growth):
+    '''
+    Picks a timestamp with more activity in recent days and
+    during working hours
+    '''
+    # growth < 1 pushes mass towards the end of the window
+    day = int(days * (rng.random() ** growth))
+    day = min(day, days - 1)
+    hour = rng.choices(range(24), weights=HOUR_WEIGHTS)[0]
+    second = rng.randrange(3600)
+    return start + datetime.timedelta(days=day, hours=hour, seconds=second)
+
+
+def _copy(table, columns, buffer):
+    '''
+    Loads a tab separated buffer into the given table with COPY
+
+    Args:
+        table: Table to load into
+        columns: Column names matching the buffer
+        buffer: StringIO containing the rows
+
+    Returns:
+        Number of rows loaded
+    '''
+    conn = utils.open_connection()
+    buffer.seek(0)
+
+    try:
+        with conn.cursor() as cur:
+            cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+            rows = cur.rowcount
+        conn.commit()
+        return rows
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error copying into {table}: {e}")
+        raise
+    finally:
+        conn.close()
+
+
+def _load_users(task):
+    '''Worker: generates and loads users first_id..last_id'''
+    first_id, last_id, seed, start, days = task
+    rng = random.Random(f"{seed}-users-{first_id}")
+    password = utils.secure_password(SEED_PASSWORD)
+
+    buffer = io.StringIO()
+    for user_id in range(first_id, last_id + 1):
+        created_on = start + datetime.timedelta(seconds=rng.randrange(days * 86400))
+        buffer.write(f"{user_id}\tuser{user_id:08d}\t{password}\tuser{user_id:08d}@example.com\t"
+                     f"Seed User {user_id}\t{created_on}\tf\t0\t\\N\n")
+
+    columns = ("user_id", "username", "password", "email", "fullname",
+               "created_on", "is_admin", "failed_login_attempts", "last_login")
+    return _copy("Users", columns, buffer)
+
+
+def _load_accounts(task):
+    '''Worker: generates and loads the accounts of users first_id..last_id'''
+    first_id, last_id, seed, start, days, currency_ids = task
+
+    buffer = io.StringIO()
+    for user_id in range(first_id, last_id + 1):
+        for code, account_id in account_layout(user_id, seed).items():
+            created_on = start + datetime.timedelta(seconds=_mix(account_id + seed) % (days * 86400))
+            buffer.write(f"{user_id}\t{account_id}\t{currency_ids[code]}\t0\t{created_on}\tt\n")
+
+    columns = ("user_id", "account_id", "currency_id", "balance", "created_on", "is_active")
+    return _copy("Accounts", columns, buffer)
+
+
+def _load_transactions(task):
+    '''Worker: generates and loads one chunk of transactions'''
+    chunk, count, seed, num_users, start, days, skew, growth, currency_ids = task
+    rng = random.Random(f"{seed}-transactions-{chunk}")
+
+    buffer = io.StringIO()
+    for _ in range(count):
+        user_id = _skewed_user(rng, num_users, skew)
+        accounts = account_layout(user_id, seed)
+        code = rng.choice(list(accounts))
+        account_id = accounts[code]
+
+        tx_type = rng.choices(TX_TYPES, weights=TX_WEIGHTS)[0]
+        tx_time = _skewed_time(rng, start, days, growth)
+        tx_id = utils.new_tx_id(tx_time, rng)
+
+        # Deposits run larger than withdrawals so balances drift upwards
+        if tx_type == "Deposit":
+            amount = _minor_units(rng.lognormvariate(4.5, 1.0), code)
+            row = (None, None, user_id, account_id)
+        elif tx_type == "Withdraw":
+            amount = _minor_units(rng.lognormvariate(3.5, 1.0), code)
+            row = (user_id, account_id, None, None)
+        else:
+            amount = _minor_units(rng.lognormvariate(3.5, 1.2), code)
+            to_user_id = _skewed_user(rng, num_users, skew)
+            to_account_id = account_layout(to_user_id, seed).get(code)
+
+            # Recipient has no account in this currency, so money leaves the bank
+            if to_account_id is None or to_user_id == user_id:
+                tx_type = "Withdraw"
+                row = (user_id, account_id, None, None)
+            else:
+                row = (user_id, account_id, to_user_id, to_account_id)
+
+        fields = [str(field) if field is not None else "\\N" for field in row]
+        buffer.write(f"{tx_time}\t{tx_id}\t{utils.TX_TYPES[tx_type]}\t{chr(9).join(fields)}\t{amount}\t"
+                     f"{currency_ids[code]}\n")
+
+    columns = ("tx_time", "tx_id", "type_id", "from_user_id", "from_account_id",
+               "to_user_id", "to_account_id", "amount", "currency_id")
+    return _copy("Transactions", columns, buffer)
+
+
+def _run_parallel(name, worker, tasks, workers):
+    '''Runs the tasks on a process pool and logs throughput'''
+    started = time.perf_counter()
+    loaded = 0
+
+    with multiprocessing.Pool(workers) as pool:
+        for rows in pool.imap_unordered(worker, tasks):
+            loaded += rows
+            elapsed = time.perf_counter() - started
+            print(f"\r{name}: {loaded:,} rows ({loaded / elapsed:,.0f} rows/s)", end="", flush=True)
+
+    print()
+    logger.info(f"Loaded {loaded} {name} in {time.perf_counter() - started:.1f}s")
+    return loaded
+
+
+def _prepare(truncate):
+    '''
+    Creates the schema, currencies and optionally clears old data
+
+    Returns:
+        Dictionary of currency_code to currency_id
+    '''
+    utils.create_tables()
+    conn = utils.open_connection()
+
+    try:
+        with conn.cursor() as cur:
+            if truncate:
+                cur.execute("TRUNCATE Transactions, Accounts, Users, ReconcileRanges RESTART IDENTITY CASCADE")
+
+            for code in CURRENCIES:
+                exponent, symbol = utils.DEFAULT_CURRENCIES.get(code, (utils.DEFAULT_EXPONENT, None))
+                cur.execute("INSERT INTO Currencies (currency_code, minor_unit, symbol) SELECT %s, %s, %s "
+                            "WHERE NOT EXISTS (SELECT 1 FROM Currencies WHERE currency_code = %s)",
+                            (code, exponent, symbol or None, code))
+
+            cur.execute("SELECT currency_code, currency_id FROM Currencies")
+            currency_ids = {code.strip(): currency_id for code, currency_id in cur.fetchall()}
+        conn.commit()
+        return currency_ids
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error preparing database: {e}")
+        raise
+    finally:
+        conn.close()
+
+
+def _finalise():
+    '''Sets account balances from their transactions and moves the id sequences past the seeded ids'''
+    conn = utils.open_connection()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""WITH flows AS (
+                            SELECT to_account_id AS account_id, amount FROM Transactions WHERE to_account_id IS NOT NULL
+                            UNION ALL
+                            SELECT from_account_id, -amount FROM Transactions WHERE from_account_id IS NOT NULL)
+                        UPDATE Accounts a SET balance = f.net
+                        FROM (SELECT account_id, SUM(amount) AS net FROM flows GROUP BY 1) f
+                        WHERE a.account_id = f.account_id""")
+            cur.execute("SELECT setval(pg_get_serial_sequence('Users', 'user_id'), COALESCE(MAX(user_id), 1)) FROM Users")
+            cur.execute("SELECT setval(pg_get_serial_sequence('Accounts', 'account_id'), COALESCE(MAX(account_id), 1)) FROM Accounts")
+            cur.execute("ANALYZE Users")
+            cur.execute("ANALYZE Accounts")
+            cur.execute("ANALYZE Transactions")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error finalising seed data: {e}")
+        raise
+    finally:
+        conn.close()
+
+
+def seed(num_users, num_transactions, seed=42, workers=4, chunk_size=100000,
+         days=365, skew=3.0, growth=0.7, end_date=None, truncate=False):
+    '''
+    Generates and loads the synthetic dataset
+
+    Args:
+        num_users: Number of users to create
+        num_transactions: Number of transactions to create
+        seed: Seed that makes the dataset reproducible
+        workers: Number of loader processes
+        chunk_size: Rows per COPY
+        days: Length of the history in days
+        skew: Activity skew. Higher means a few users do most transactions
+        growth: Time skew. Lower means more recent activity
+        end_date: Last day of the history. Defaults to today. Fix it to
+            reproduce a dataset exactly on another day
+        truncate: Clears Users, Accounts and Transactions first
+
+    Returns:
+        Dictionary with the number of rows loaded per table
+    '''
+    currency_ids = _prepare(truncate)
+
+    end_date = end_date or datetime.date.today()
+    start = datetime.datetime.combine(end_date, datetime.time()) - datetime.timedelta(days=days)
+
+    user_tasks = [(first, min(first + chunk_size - 1, num_users), seed, start, days)
+                  for first in range(1, num_users + 1, chunk_size)]
+    account_tasks = [(*task, currency_ids) for task in user_tasks]
+
+    chunks = [(chunk, min(chunk_size, num_transactions - chunk * chunk_size), seed, num_users, start, days, skew, growth,
+               currency_ids)
+              for chunk in range((num_transactions + chunk_size - 1) // chunk_size)]
+
+    result = {
+        "Users": _run_parallel("Users", _load_users, user_tasks, workers),
+        "Accounts": _run_parallel("Accounts", _load_accounts, account_tasks, workers),
+        "Transactions": _run_parallel("Transactions", _load_transactions, chunks, workers),
+    }
+    _finalise()
+
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed the bank with synthetic data")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--transactions", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--skew", type=float, default=3.0)
+    parser.add_argument("--growth", type=float, default=0.7)
+    parser.add_argument("--end-date", type=datetime.date.fromisoformat, default=None)
+    parser.add_argument("--truncate", action="store_true")
+    args = parser.parse_args()
+
+    print(seed(args.users, args.transactions, args.seed, args.workers, args.chunk_size,
+               args.days, args.skew, args.growth, args.end_date, args.truncate))
+
+# Godspeed
@@ -0,0 +1,457 @@
+import psycopg2.pool
+import urllib.parse
+import http.server
+import threading
+import datetime
+import argparse
+import logging
+import secrets
+import metrics
+import rates
+import users
+import utils
+import json
+import time
+import re
+import os
+
+logger = logging.getLogger('banking_server')
+
+'''
+HTTP/JSON API over the banking operations
+
+Requests run on a thread each and share utils' thread-safe connection
+pool. At most API_MAX_IN_FLIGHT requests use the database at once. A
+request that can't get a slot within API_QUEUE_TIMEOUT_SECONDS, or finds
+the pool exhausted, gets 503 with Retry-After instead of piling up behind
+the pool. Refused operations, like a withdrawal without the funds, get 422
+with the reason in "error".
+
+Log in with POST /login and send the token as "Authorization: Bearer
+<token>". Amounts are integer minor units, dates are YYYY-MM-DD.
+
+    GET  /health
+    POST /login                          {"username", "password"}
+    GET  /profile
+    GET  /accounts
+    GET  /accounts/<id>/history          ?start=&end=
+    GET  /accounts/<id>/statement        ?start=&end=
+    POST /deposit                        {"account_id", "amount", "idempotency_key"}
+    POST /withdraw                       {"account_id", "amount", "idempotency_key"}
+    POST /transfer                       {"from_account_id", "to_account_id", "to_user_id", "amount", "idempotency_key"}
+    POST /exchange/quote                 {"from_account_id", "to_account_id", "amount", "to_user_id"}
+    POST /exchange/execute               {"quote_id"}
+    POST /exchange/orders                {"from_account_id", "to_account_id", "amount", "to_user_id"}
+    GET  /portfolio                      ?currency=USD
+    GET  /analytics/spending             ?start=&end=&period=daily
+
+Usage:
+    python server.py --port 8080
+'''
+
+API_MAX_IN_FLIGHT = int(os.getenv("API_MAX_IN_FLIGHT", "0")) or max(1, utils.DB_POOL_MAX - 2)
+API_QUEUE_TIMEOUT_SECONDS = float(os.getenv("API_QUEUE_TIMEOUT_SECONDS", "0.25"))
+API_SESSION_SECONDS = float(os.getenv("API_SESSION_SECONDS", "3600"))
+
+# Bodies above this are refused before being read
+MAX_BODY_BYTES = 64 * 1024
+
+
+class ApiError(Exception):
+    '''Ends a request with an HTTP status and message'''
+    def __init__ (self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+# Token to (expires_at, profile). Guarded by _sessions_lock
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Background threads like the rate refresher keep using the pool, so fewer slots than connections
+_slots = threading.BoundedSemaphore(API_MAX_IN_FLIGHT)
+_in_flight = 0
+_rejected = 0
+_counter_lock = threading.Lock()
+
+
+def _prune_sessions(now):
+    '''Drops expired tokens. Call with _sessions_lock held'''
+    for token in [token for token, (expires_at, _) in _sessions.items() if expires_at < now]:
+        del _sessions[token]
+
+
+def _session(token):
+    now = time.monotonic()
+
+    with _sessions_lock:
+        session = _sessions.get(token)
+        if session is None or session[0] < now:
+            _sessions.pop(token, None)
+            raise ApiError(401, "Login required")
+        return session[1]
+
+
+def _field(body, name, kind=int, required=True):
+    '''Gets a typed field from a JSON body'''
+    value = body.get(name)
+
+    if value is None:
+        if required:
+            raise ApiError(400, f"Missing field: {name}")
+        return None
+
+    # bool is an int to isinstance, but never a valid amount or id
+    if not isinstance(value, kind) or isinstance(value, bool):
+        raise ApiError(400, f"{name} must be {'an integer' if kind is int else 'a string'}")
+    return value
+
+
+def _date(query, name):
+    value = query.get(name, [None])[0]
+    if value is None:
+        raise ApiError(400, f"Missing query parameter: {name}")
+
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise ApiError(400, f"{name} must be YYYY-MM-DD")
+
+
+def _owned_account(user_id, account_id):
+    '''Refuses accounts of other users for reads that don't check the owner themselves'''
+    conn = None
+    try:
+        conn = utils.connect_to_db(read_only=True)
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM Accounts WHERE account_id = %s AND user_id = %s", (account_id, user_id))
+            rows = cur.fetchone()
+        conn.commit()
+    finally:
+        utils.release_conn(conn)
+
+    if not rows:
+        raise ApiError(404, f"Account {account_id} not found")
+
+
+def _result(value, failure_status=422):
+    '''Wraps a users function's result. Strings say why the operation was refused'''
+    if isinstance(value, str):
+        return failure_status, {"error": value}
+    return 200, value
+
+
+def _message(message, succeeded):
+    '''Wraps a users function that returns a message either way, so failures still get a 4xx'''
+    if succeeded:
+        return 200, {"result": message}
+    return 422, {"error": message}
+
+
+# Route handlers take (handler, user_id, body, query, match) and return (status, payload)
+
+def _health(handler, user_id, body, query, match):
+    return 200, {"status": "ok", "in_flight": _in_flight}
+
+
+def _login(handler, user_id, body, query, match):
+    username = _field(body, "username", str)
+    password = _field(body, "password", str)
+
+    user = users.User(1, username, 1, "email@example.com", username, datetime.datetime.now())
+    result = user.login(username, utils.secure_password(password), source=handler.client_address[0])
+    if not isinstance(result, dict):
+        raise ApiError(401, result)
+
+    token = secrets.token_urlsafe(32)
+    now = time.monotonic()
+    with _sessions_lock:
+        _prune_sessions(now)
+        _sessions[token] = (now + API_SESSION_SECONDS, result)
+
+    return 200, {"token": token, "expires_in": API_SESSION_SECONDS, "profile": result}
+
+
+def _profile(handler, user_id, body, query, match):
+    return 200, handler.profile
+
+
+def _accounts(handler, user_id, body, query, match):
+    account = users.Account(user_id, None, True)
+    rows = account.get_accounts(user_id)
+    columns = ["user_id", "account_id", "currency_code", "balance", "created_on", "is_active"]
+    return 200, [dict(zip(columns, row)) for row in rows]
+
+
+def _history(handler, user_id, body, query, match):
+    account_id = int(match.group(1))
+    _owned_account(user_id, account_id)
+
+    start = _date(query, "start") if "start" in query else None
+    end = _date(query, "end") if "end" in query else None
+    rows = users.get_transaction_history(account_id, start, end) or []
+
+    columns = ["tx_time", "tx_id", "type", "from_user_id", "from_account_id", "to_user_id", "to_account_id",
+               "amount", "currency_code"]
+    return 200, [dict(zip(columns, row)) for row in rows]
+
+
+def _statement(handler, user_id, body, query, match):
+    account_id = int(match.group(1))
+    start, end = _date(query, "start"), _date(query, "end")
+    if end < start:
+        raise ApiError(400, "end must not be before start")
+    _owned_account(user_id, account_id)
+
+    return _result(users.generate_account_statement(account_id, user_id, start, end), failure_status=404)
+
+
+# Money movements return a message either way. Successes end like "Deposit of $5.00 successful"
+
+def _deposit(handler, user_id, body, query, match):
+    message = users.deposit(user_id, _field(body, "account_id"), _field(body, "amount"),
+                            idempotency_key=_field(body, "idempotency_key", str, required=False))
+    return _message(message, message.endswith("successful"))
+
+
+def _withdraw(handler, user_id, body, query, match):
+    message = users.withdraw(user_id, _field(body, "account_id"), _field(body, "amount"),
+                             idempotency_key=_field(body, "idempotency_key", str, required=False))
+    return _message(message, message.endswith("successful"))
+
+
+def _transfer(handler, user_id, body, query, match):
+    message = users.transfer(_field(body, "from_account_id"), _field(body, "to_account_id"), user_id,
+                             _field(body, "to_user_id"), _field(body, "amount"),
+                             idempotency_key=_field(body, "idempotency_key", str, required=False))
+    return _message(message, message.endswith("successful"))
+
+
+def _quote(handler, user_id, body, query, match):
+    to_user_id = _field(body, "to_user_id", required=False) or user_id
+    return _result(users.quote_exchange(_field(body, "from_account_id"), _field(body, "to_account_id"),
+                                        to_user_id, user_id, _field(body, "amount")))
+
+
+def _execute(handler, user_id, body, query, match):
+    message = users.execute_quote(_field(body, "quote_id", str), user_id)
+    return _message(message, message.startswith("Successfully"))
+
+
+def _order(handler, user_id, body, query, match):
+    to_user_id = _field(body, "to_user_id", required=False) or user_id
+    order_id = users.submit_exchange_order(_field(body, "from_account_id"), _field(body, "to_account_id"),
+                                           to_user_id, user_id, _field(body, "amount"))
+    return _result(order_id if isinstance(order_id, str) else {"order_id": order_id})
+
+
+def _portfolio(handler, user_id, body, query, match):
+    currency = query.get("currency", ["USD"])[0].upper()
+
+    # An unknown code is the caller's mistake, not a missing rate, so it must not turn into a 503
+    try:
+        utils.get_currency_id(currency)
+    except ValueError:
+        raise ApiError(400, f"Unknown currency: {currency}")
+    return _result(users.get_portfolio_valuation(user_id, currency))
+
+
+def _spending(handler, user_id, body, query, match):
+    start, end = _date(query, "start"), _date(query, "end")
+    period = query.get("period", ["daily"])[0]
+    if period not in users.SPENDING_PERIODS:
+        raise ApiError(400, f"period must be one of {', '.join(users.SPENDING_PERIODS)}")
+
+    frame = users.get_spending_frame(user_id, start, end)
+    if frame.empty:
+        return 200, {"periods": {}, "accounts": []}
+
+    data = users.resample_spending(frame, period)
+    totals = users.spending_totals(frame).reset_index()
+    return 200, {
+        "periods": {day.date().isoformat(): {code: int(amount) for code, amount in row.items()}
+                    for day, row in data.iterrows()},
+        "accounts": [{key: (value.item() if hasattr(value, "item") else value) for key, value in record.items()}
+                     for record in totals.to_dict("records")],
+    }
+
+
+# (method, path pattern, handler, needs login)
+ROUTES = [
+    ("GET", re.compile(r"^/health$"), _health, False),
+    ("POST", re.compile(r"^/login$"), _login, False),
+    ("GET", re.compile(r"^/profile$"), _profile, True),
+    ("GET", re.compile(r"^/accounts$"), _accounts, True),
+    ("GET", re.compile(r"^/accounts/(\d+)/history$"), _history, True),
+    ("GET", re.compile(r"^/accounts/(\d+)/statement$"), _statement, True),
+    ("POST", re.compile(r"^/deposit$"), _deposit, True),
+    ("POST", re.compile(r"^/withdraw$"), _withdraw, True),
+    ("POST", re.compile(r"^/transfer$"), _transfer, True),
+    ("POST", re.compile(r"^/exchange/quote$"), _quote, True),
+    ("POST", re.compile(r"^/exchange/execute$"), _execute, True),
+    ("POST", re.compile(r"^/exchange/orders$"), _order, True),
+    ("GET", re.compile(r"^/portfolio$"), _portfolio, True),
+    ("GET", re.compile(r"^/analytics/spending$"), _spending, True),
+]
+
+
+class BankRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''Dispatches JSON requests to the route handlers'''
+    # Keep-alive, so clients don't pay a TCP handshake per request
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes, which Nagle would hold back for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            raise ApiError(413, "Request body too large")
+        if not length:
+            return {}
+
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            raise ApiError(400, "Body must be JSON")
+        if not isinstance(body, dict):
+            raise ApiError(400, "Body must be a JSON object")
+        return body
+
+    def _send(self, status, payload, headers=None):
+        data = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, method):
+        global _in_flight, _rejected
+
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        started = time.perf_counter()
+        status = 500
+
+        try:
+            # Read the body first so an error response leaves the connection usable
+            body = self._read_body() if method == "POST" else {}
+
+            for route_method, pattern, route, needs_login in ROUTES:
+                match = pattern.match(url.path)
+                if match and route_method == method:
+                    break
+            else:
+                raise ApiError(404, f"No route for {method} {url.path}")
+
+            user_id = None
+            if needs_login:
+                token = self.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+                self.profile = _session(token)
+                user_id = self.profile["user_id"]
+
+            if route is _health:
+                status, payload = route(self, user_id, body, query, match)
+            else:
+                if not _slots.acquire(timeout=API_QUEUE_TIMEOUT_SECONDS):
+                    raise psycopg2.pool.PoolError("No free request slot")
+
+                with _counter_lock:
+                    _in_flight += 1
+                try:
+                    status, payload = route(self, user_id, body, query, match)
+                finally:
+                    with _counter_lock:
+                        _in_flight -= 1
+                    _slots.release()
+
+            self._send(status, payload)
+        except ApiError as e:
+            status = e.status
+            self._send(status, {"error": e.message})
+        except psycopg2.pool.PoolError:
+            status = 503
+            with _counter_lock:
+                _rejected += 1
+            self._send(status, {"error": "Server busy, retry shortly"}, {"Retry-After": "1"})
+        except rates.RateUnavailableError as e:
+            status = 503
+            self._send(status, {"error": f"Exchange rates are unavailable right now: {e}"}, {"Retry-After": "30"})
+        except ValueError as e:
+            # e.g an idempotency key reused for a different request
+            status = 422
+            self._send(status, {"error": str(e)})
+        except Exception as e:
+            status = 500
+            logger.error(f"{method} {url.path} failed: {e}")
+            self._send(status, {"error": "Internal error"})
+        finally:
+            logger.info(f"{method} {url.path} {status} {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    def log_message(self, format, *args):
+        # Requests are logged by _dispatch through the queued logger, not to stderr
+        pass
+
+
+class BankServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def in_flight_requests():
+    '''Requests using the database right now'''
+    return _in_flight
+
+
+def rejected_requests():
+    '''Requests turned away with 503 since start'''
+    return _rejected
+
+
+metrics.register_gauge("bank_api_in_flight_requests", "API requests using the database right now", in_flight_requests)
+metrics.register_gauge("bank_api_rejected_requests", "API requests rejected with 503 because the pool was busy",
+                       rejected_requests)
+
+
+def serve(host="127.0.0.1", port=8080):
+    '''
+    Runs the API until interrupted
+
+    Args:
+        host: Address to bind
+        port: Port to listen on
+    '''
+    utils.create_tables()
+    rates.start_refresher()
+
+    server = BankServer((host, port), BankRequestHandler)
+    logger.info(f"API listening on {host}:{port} with {API_MAX_IN_FLIGHT} request slots "
+                f"over {utils.DB_POOL_MAX} connections")
+    print(f"Listening on http://{host}:{port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the banking operations over HTTP/JSON")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    serve(args.host, args.port)
+
+# Godspeed
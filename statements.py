@@ -0,0 +1,234 @@
+import multiprocessing
+import datetime
+import argparse
+import logging
+import archive
+import heapq
+import utils
+import json
+import gzip
+import time
+import csv
+import os
+
+logger = logging.getLogger('banking_statements')
+
+'''
+Month-end statement batch job
+
+Splits Accounts into account_id ranges and hands them to a process pool.
+Each worker streams the transactions of its range with a server-side cursor
+and writes every statement in the range to one gzipped CSV file.
+
+Months moved out by archive.py are read back from the archive, both for
+the opening balance and for the month's own transactions.
+
+A partition's file is written under a .part name and renamed when complete,
+so a rerun with the same output directory skips finished partitions and
+resumes after a failure.
+
+Usage:
+    python statements.py --month 2026-09 --output statements/2026-09 --workers 8
+'''
+
+STATEMENT_COLUMNS = ["record", "account_id", "user_id", "currency_code", "tx_time", "type",
+                     "from_user_id", "from_account_id", "to_user_id", "to_account_id", "amount", "balance"]
+
+# Rows fetched per round trip from the server-side cursor
+FETCH_SIZE = 5000
+
+
+def month_bounds(month):
+    '''
+    Gets the first moment of a month and of the month after
+
+    Args:
+        month: String in YYYY-MM format
+
+    Returns:
+        Tuple of (start, end) datetimes
+    '''
+    start = datetime.datetime.strptime(month, "%Y-%m")
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return start, end
+
+
+def partition_path(output_dir, first_id, last_id):
+    return os.path.join(output_dir, f"statements_{first_id:010d}_{last_id:010d}.csv.gz")
+
+
+def _write_partition(task):
+    '''
+    Worker: writes the statements of accounts first_id..last_id
+
+    Returns:
+        Tuple of (first_id, number of statements written)
+    '''
+    first_id, last_id, start, end, output_dir = task
+    path = partition_path(output_dir, first_id, last_id)
+    tmp_path = path + ".part"
+    conn = utils.open_connection()
+
+    try:
+        with conn.cursor() as cur:
+            # One snapshot, so a month archived mid-run is read from either Transactions or the archive, not both
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cur.execute("SELECT account_id, user_id, currency_code FROM AccountDetails " \
+                        "WHERE account_id BETWEEN %s AND %s ORDER BY account_id", (first_id, last_id))
+            accounts = cur.fetchall()
+
+            # Opening balance is the net of everything before the month
+            cur.execute("""SELECT account_id, SUM(amount)::bigint FROM (
+                            SELECT to_account_id AS account_id, amount FROM Transactions
+                            WHERE to_account_id BETWEEN %s AND %s AND tx_time < %s
+                            UNION ALL
+                            SELECT from_account_id, -amount FROM Transactions
+                            WHERE from_account_id BETWEEN %s AND %s AND tx_time < %s) flows
+                        GROUP BY 1""", (first_id, last_id, start, first_id, last_id, start))
+            opening = dict(cur.fetchall())
+
+            # Archived months hold what moved out of Transactions, before and within the month
+            for account_id, amount in zip(*archive.account_flows(cur, first_id, last_id, before=start)):
+                opening[int(account_id)] = (opening.get(int(account_id)) or 0) + int(amount)
+            archived = archive.range_rows(cur, first_id, last_id, start, end)
+
+        # Named cursor streams the month's transactions instead of loading them all
+        with conn.cursor(name=f"statements_{first_id}") as cur, \
+                gzip.open(tmp_path, "wt", newline="") as f:
+            cur.itersize = FETCH_SIZE
+            cur.execute("""SELECT account_id, tx_time, type_id, from_user_id, from_account_id,
+                                  to_user_id, to_account_id, amount FROM (
+                            SELECT to_account_id AS account_id, tx_time, type_id, from_user_id, from_account_id,
+                                   to_user_id, to_account_id, amount
+                            FROM Transactions
+                            WHERE to_account_id BETWEEN %s AND %s AND tx_time >= %s AND tx_time < %s
+                            UNION ALL
+                            SELECT from_account_id, tx_time, type_id, from_user_id, from_account_id,
+                                   to_user_id, to_account_id, -amount
+                            FROM Transactions
+                            WHERE from_account_id BETWEEN %s AND %s AND tx_time >= %s AND tx_time < %s) tx
+                        ORDER BY account_id, tx_time""",
+                        (first_id, last_id, start, end, first_id, last_id, start, end))
+
+            writer = csv.writer(f)
+            writer.writerow(STATEMENT_COLUMNS)
+            rows = heapq.merge(cur, archived, key=lambda row: (row[0], row[1]))
+            row = next(rows, None)
+
+            # Merge the sorted account list with the sorted transaction stream
+            for account_id, user_id, currency_code in accounts:
+                balance = opening.get(account_id) or 0
+                writer.writerow(["OPEN", account_id, user_id, currency_code, start, None,
+                                 None, None, None, None, None, balance])
+
+                while row is not None and row[0] < account_id:
+                    row = next(rows, None)
+
+                while row is not None and row[0] == account_id:
+                    balance += row[7]
+                    writer.writerow(["TX", account_id, user_id, currency_code, row[1],
+                                     utils.TX_TYPE_NAMES.get(row[2], row[2]), *row[3:], balance])
+                    row = next(rows, None)
+
+                writer.writerow(["CLOSE", account_id, user_id, currency_code, end, None,
+                                 None, None, None, None, None, balance])
+
+        conn.commit()
+        os.replace(tmp_path, path)
+        return first_id, len(accounts)
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Failed to write statements {first_id}-{last_id}: {e}")
+        raise
+    finally:
+        conn.close()
+
+
+def _partitions(range_size):
+    '''Splits the account_id space into ranges of range_size ids'''
+    conn = utils.open_connection()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT MIN(account_id), MAX(account_id), COUNT(*) FROM Accounts")
+            low, high, count = cur.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+
+    if count == 0:
+        return [], 0
+
+    # Fixed boundaries aligned to range_size, so a resumed run finds the same
+    # partition files even if accounts were opened since the first attempt
+    start = low - low % range_size
+    return [(first, first + range_size - 1) for first in range(start, high + 1, range_size)], count
+
+
+def generate_statements(month, output_dir, workers=4, range_size=10000):
+    '''
+    Generates statements for every account for one month
+
+    Args:
+        month: Month in YYYY-MM format
+        output_dir: Directory for the statement files. Reuse it to resume
+        workers: Number of worker processes
+        range_size: account_ids per partition
+
+    Returns:
+        Dictionary with statements written, partitions skipped and statements per second
+    '''
+    start, end = month_bounds(month)
+    os.makedirs(output_dir, exist_ok=True)
+
+    partitions, total_accounts = _partitions(range_size)
+    pending = [(first, last, start, end, output_dir) for first, last in partitions
+               if not os.path.exists(partition_path(output_dir, first, last))]
+    skipped = len(partitions) - len(pending)
+
+    if skipped:
+        logger.info(f"Resuming {month}: {skipped} of {len(partitions)} partitions already done")
+        print(f"Resuming: {skipped} of {len(partitions)} partitions already done")
+
+    started = time.perf_counter()
+    written = 0
+    done = 0
+
+    with multiprocessing.Pool(workers) as pool:
+        for _, count in pool.imap_unordered(_write_partition, pending):
+            written += count
+            done += 1
+            rate = written / (time.perf_counter() - started)
+            print(f"\rPartitions {done + skipped}/{len(partitions)}  statements {written:,}  "
+                  f"{rate:,.0f}/s", end="", flush=True)
+    print()
+
+    elapsed = time.perf_counter() - started
+    result = {
+        "month": month,
+        "accounts": total_accounts,
+        "statements_written": written,
+        "partitions": len(partitions),
+        "partitions_skipped": skipped,
+        "seconds": round(elapsed, 2),
+        "statements_per_second": round(written / elapsed, 1) if elapsed else 0,
+    }
+
+    with open(os.path.join(output_dir, "summary.json"), "w") as f:
+        json.dump(result, f, indent=2)
+
+    logger.info(f"Statements for {month}: {result}")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate month-end statements for all accounts")
+    parser.add_argument("--month", required=True, help="YYYY-MM")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--range-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    print(generate_statements(args.month, args.output, args.workers, args.range_size))
+
+# Godspeed
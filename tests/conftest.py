@@ -0,0 +1,22 @@
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+
+'''
+Shared fixtures
+
+The modules under test are imported from the repository root. Nothing here
+connects to PostgreSQL, tests that need currencies get DEFAULT_CURRENCIES
+in place of the Currencies table.
+'''
+
+
+@pytest.fixture
+def currencies(monkeypatch):
+    '''Serves utils.DEFAULT_CURRENCIES as the loaded currency table'''
+    monkeypatch.setattr(utils, "currency_table", dict(utils.DEFAULT_CURRENCIES))
+    monkeypatch.setattr(utils, "currency_ids", {code: i + 1 for i, code in enumerate(utils.DEFAULT_CURRENCIES)})
+    return utils.currency_table
@@ -0,0 +1,94 @@
+import datetime
+import pytest
+import json
+import os
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+import analytics
+
+USD, EUR = 1, 2
+
+# tx_time, account_id, user_id, signed amount, type_id, currency_id, sorted by tx_time
+ROWS = [
+    ("2026-09-01T10:00", 10, 1, 10000, 1, USD),
+    ("2026-09-02T09:00", 10, 1, -2500, 2, USD),
+    ("2026-09-02T18:00", 10, 1, -500, 3, USD),
+    ("2026-09-02T18:00", 20, 2, 500, 3, USD),
+    ("2026-09-03T08:00", 11, 1, -300, 2, EUR),
+    ("2026-09-05T12:00", 10, 1, -1000, 2, USD),
+]
+
+
+def _write_snapshot(path, user_id=None):
+    for i, (name, dtype) in enumerate(analytics.COLUMNS.items()):
+        np.save(os.path.join(path, f"{name}.npy"), np.array([row[i] for row in ROWS], dtype=dtype))
+
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"user_id": user_id, "rows": len(ROWS), "exported_at": "2026-09-06T00:00:00",
+                   "currency_codes": {str(USD): "USD", str(EUR): "EUR"}}, f)
+    return analytics.Snapshot(str(path))
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    return _write_snapshot(tmp_path)
+
+
+def test_snapshot_loads_read_only_columns(snapshot):
+    assert len(snapshot) == len(ROWS)
+    assert snapshot.currency_codes == {USD: "USD", EUR: "EUR"}
+    assert isinstance(snapshot.amount, np.memmap)
+    assert not snapshot.amount.flags.writeable
+
+
+def test_covers(tmp_path, snapshot):
+    own = tmp_path / "own"
+    own.mkdir()
+    user_snapshot = _write_snapshot(own, user_id=1)
+
+    assert snapshot.covers(1) and snapshot.covers(2)
+    assert user_snapshot.covers(1)
+    assert not user_snapshot.covers(2)
+
+    with pytest.raises(ValueError):
+        user_snapshot.spending_frame(2, datetime.date(2026, 9, 1), datetime.date(2026, 9, 30))
+
+
+def test_window_includes_whole_end_date(snapshot):
+    assert snapshot.window() == slice(0, len(ROWS))
+    assert snapshot.window(datetime.date(2026, 9, 2), datetime.date(2026, 9, 3)) == slice(1, 5)
+    assert snapshot.window(datetime.date(2026, 9, 4), datetime.date(2026, 9, 4)) == slice(5, 5)
+
+
+def test_spending_frame_sums_debits_per_day_and_account(snapshot):
+    frame = snapshot.spending_frame(1, datetime.date(2026, 9, 2), datetime.date(2026, 9, 3))
+
+    assert list(frame.columns) == ["date", "account_id", "currency_code", "amount", "transactions"]
+    assert frame["date"].dt.date.tolist() == [datetime.date(2026, 9, 2), datetime.date(2026, 9, 3)]
+    assert frame["account_id"].tolist() == [10, 11]
+    assert frame["currency_code"].tolist() == ["USD", "EUR"]
+    assert frame["amount"].tolist() == [3000, 300]
+    assert frame["transactions"].tolist() == [2, 1]
+
+
+def test_spending_frame_is_empty_without_spending(snapshot):
+    frame = snapshot.spending_frame(2, datetime.date(2026, 9, 1), datetime.date(2026, 9, 30))
+
+    assert frame.empty
+    assert list(frame.columns) == ["date", "account_id", "currency_code", "amount", "transactions"]
+
+
+def test_spending_history(snapshot):
+    history = snapshot.spending_history(10, 1, datetime.date(2026, 9, 1), datetime.date(2026, 9, 30))
+
+    assert history == [{"Date": datetime.date(2026, 9, 2), "Amount": 3000},
+                       {"Date": datetime.date(2026, 9, 5), "Amount": 1000}]
+    assert snapshot.spending_history(20, 2, datetime.date(2026, 9, 1), datetime.date(2026, 9, 30)) \
+        == "No transactions yet"
+
+
+def test_net_flows(snapshot):
+    assert snapshot.net_flows() == {10: 6000, 11: -300, 20: 500}
+    assert snapshot.net_flows(datetime.date(2026, 9, 2), datetime.date(2026, 9, 2)) == {10: -3000, 20: 500}
+    assert snapshot.net_flows(datetime.date(2026, 9, 4), datetime.date(2026, 9, 4)) == {}
@@ -0,0 +1,90 @@
+import fxnetting
+import datetime
+import pytest
+import rates
+import utils
+
+USD_POOL, EUR_POOL = 900, 901
+POOLS = {"USD": USD_POOL, "EUR": EUR_POOL}
+
+
+@pytest.fixture
+def snapshot(currencies):
+    # Half a euro per dollar, so USD -> EUR halves and EUR -> USD doubles
+    return rates.RateSnapshot(datetime.datetime.now(), {"EUR": utils.RATE_SCALE // 2})
+
+
+def _order(order_id, from_account_id, to_account_id, from_currency, to_currency, amount):
+    return (order_id, 1, from_account_id, 2, to_account_id, from_currency, to_currency, amount)
+
+
+def _balances(pool_usd=100000, pool_eur=100000, **accounts):
+    balances = {USD_POOL: (pool_usd, True), EUR_POOL: (pool_eur, True)}
+    balances.update({int(name[1:]): value for name, value in accounts.items()})
+    return balances
+
+
+def test_fill_nets_the_pools_per_pair(snapshot):
+    orders = [_order(1, 10, 20, "USD", "EUR", 1000), _order(2, 30, 40, "EUR", "USD", 200)]
+    balances = _balances(a10=(5000, True), a20=(0, True), a30=(5000, True), a40=(0, True))
+
+    filled, rejected, pool_rows, report = fxnetting._fill(orders, balances, snapshot, POOLS)
+
+    assert rejected == []
+    assert [row[8] for row in filled] == [500, 400]
+    assert sorted(pool_rows) == [(USD_POOL, "USD", 600), (EUR_POOL, "EUR", -300)]
+    assert report == {"EUR/USD": {"orders": 2, "pool_net": {"USD": 600, "EUR": -300}}}
+
+
+def test_fill_rejects_all_orders_of_an_account_that_cant_cover_them(snapshot):
+    orders = [_order(1, 10, 20, "USD", "EUR", 1000), _order(2, 10, 20, "USD", "EUR", 1000),
+              _order(3, 30, 20, "USD", "EUR", 1000)]
+    balances = _balances(a10=(1500, True), a20=(0, True), a30=(1000, True))
+
+    filled, rejected, _, _ = fxnetting._fill(orders, balances, snapshot, POOLS)
+
+    assert rejected == [1, 2]
+    assert [row[0] for row in filled] == [3]
+
+
+def test_fill_rejects_closed_and_unknown_accounts(snapshot):
+    orders = [_order(1, 10, 20, "USD", "EUR", 100), _order(2, 30, 40, "USD", "EUR", 100),
+              _order(3, 50, 20, "USD", "EUR", 100)]
+    balances = _balances(a10=(1000, True), a20=(0, False), a30=(1000, False), a40=(0, True))
+
+    filled, rejected, pool_rows, report = fxnetting._fill(orders, balances, snapshot, POOLS)
+
+    assert filled == [] and pool_rows == [] and report == {}
+    assert rejected == [1, 2, 3]
+
+
+def test_fill_rejects_the_latest_orders_a_pool_cant_pay_out(snapshot):
+    orders = [_order(1, 10, 20, "USD", "EUR", 500), _order(2, 30, 40, "USD", "EUR", 500)]
+    balances = _balances(pool_usd=0, pool_eur=300, a10=(500, True), a20=(0, True), a30=(500, True), a40=(0, True))
+
+    filled, rejected, pool_rows, _ = fxnetting._fill(orders, balances, snapshot, POOLS)
+
+    assert [row[0] for row in filled] == [1]
+    assert rejected == [2]
+    assert sorted(pool_rows) == [(USD_POOL, "USD", 500), (EUR_POOL, "EUR", -250)]
+
+
+def test_cover_pools_follows_a_drop_into_the_other_pool():
+    # a pays 100 EUR in and 200 USD out, b pays 150 USD in and 80 EUR out
+    a = (1, 1, 10, 2, 20, "EUR", "USD", 100, 200, 0)
+    b = (2, 1, 30, 2, 40, "USD", "EUR", 150, 80, 0)
+    balances = {USD_POOL: (40, True), EUR_POOL: (0, True)}
+
+    # USD is 10 short, dropping a fixes it but leaves EUR 80 short, which drops b
+    kept, dropped = fxnetting._cover_pools([a, b], balances, POOLS)
+
+    assert kept == []
+    assert dropped == [1, 2]
+
+
+def test_cover_pools_keeps_fills_the_pools_can_pay():
+    a = (1, 1, 10, 2, 20, "EUR", "USD", 100, 200, 0)
+    b = (2, 1, 30, 2, 40, "USD", "EUR", 150, 80, 0)
+    balances = {USD_POOL: (60, True), EUR_POOL: (0, True)}
+
+    assert fxnetting._cover_pools([a, b], balances, POOLS) == ([a, b], [])
@@ -0,0 +1,92 @@
+import pytest
+import utils
+
+
+@pytest.mark.parametrize("text, currency_code, expected", [
+    ("12.5", "USD", 1250),
+    ("12.50", "USD", 1250),
+    ("1,000", "USD", 100000),
+    (".07", "EUR", 7),
+    ("3.", "GBP", 300),
+    ("1500", "JPY", 1500),
+    ("1.234", "BHD", 1234),
+    ("0.1", "KWD", 100),
+])
+def test_parse_amount(currencies, text, currency_code, expected):
+    assert utils.parse_amount(text, currency_code) == expected
+
+
+@pytest.mark.parametrize("text, currency_code", [
+    ("12.345", "USD"),
+    ("1.5", "JPY"),
+    ("-5", "USD"),
+    ("1e3", "USD"),
+    ("", "USD"),
+    ("abc", "EUR"),
+])
+def test_parse_amount_rejects(currencies, text, currency_code):
+    with pytest.raises(ValueError):
+        utils.parse_amount(text, currency_code)
+
+
+def test_parse_amount_never_goes_through_float(currencies):
+    # 0.29 * 100 is 28.999999999999996 as a float
+    assert utils.parse_amount("0.29", "USD") == 29
+    assert utils.parse_amount("90071992547409.93", "USD") == 9007199254740993
+
+
+@pytest.mark.parametrize("numerator, denominator, expected", [
+    (10, 4, 2),
+    (14, 4, 4),
+    (6, 4, 2),
+    (7, 4, 2),
+    (9, 4, 2),
+    (-10, 4, -2),
+    (-14, 4, -4),
+    (-7, 4, -2),
+    (8, 4, 2),
+    (0, 3, 0),
+])
+def test_round_div_is_half_to_even(numerator, denominator, expected):
+    assert utils.round_div(numerator, denominator) == expected
+
+
+def test_rate_to_fixed():
+    assert utils.rate_to_fixed(1.0) == utils.RATE_SCALE
+    assert utils.rate_to_fixed(0.9123456789) == 912345679
+
+
+@pytest.mark.parametrize("amount, rate, from_currency, to_currency, expected", [
+    # 10.00 USD at 150 JPY per USD
+    (1000, 150 * utils.RATE_SCALE, "USD", "JPY", 1500),
+    # 1500 JPY at 1/150 USD per JPY
+    (1500, utils.RATE_SCALE // 150, "JPY", "USD", 1000),
+    # 1.00 EUR at 0.125 GBP, half a cent rounds to even
+    (100, utils.RATE_SCALE // 8, "EUR", "GBP", 12),
+    # One cent is ten fils
+    (1, utils.RATE_SCALE, "USD", "BHD", 10),
+])
+def test_convert_minor(currencies, amount, rate, from_currency, to_currency, expected):
+    assert utils.convert_minor(amount, rate, from_currency, to_currency) == expected
+
+
+@pytest.mark.parametrize("amount, currency_code, expected", [
+    (1250, "USD", "$12.50"),
+    (5, "EUR", "E0.05"),
+    (-1250, "GBP", "-P12.50"),
+    (1500, "JPY", "Y1500"),
+    (1234, "BHD", "1.234"),
+])
+def test_format_currency(currencies, amount, currency_code, expected):
+    assert utils.format_currency(amount, currency_code) == expected
+
+
+@pytest.mark.parametrize("amount, valid", [
+    (1, True),
+    (0, False),
+    (-5, False),
+    (1.5, False),
+    ("10", False),
+])
+def test_validate_amount(amount, valid):
+    assert (utils.validate_amount(amount) is True) == valid
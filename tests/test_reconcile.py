@@ -0,0 +1,38 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+import reconcile
+
+
+def test_accumulate_sums_repeated_offsets():
+    totals = np.zeros(4, dtype=np.int64)
+
+    reconcile._accumulate(totals, [0, 2, 0, 3, 0], [100, -40, 250, 7, -50])
+
+    assert totals.tolist() == [300, 0, -40, 7]
+
+
+def test_accumulate_adds_to_existing_totals():
+    totals = np.array([10, 20], dtype=np.int64)
+
+    reconcile._accumulate(totals, np.array([1, 1]), np.array([5, -25]))
+
+    assert totals.tolist() == [10, 0]
+
+
+def test_accumulate_is_exact_past_float64_precision():
+    # float64 can't hold 2**53 + 1, np.bincount with weights would lose the odd unit
+    totals = np.zeros(1, dtype=np.int64)
+
+    reconcile._accumulate(totals, [0, 0, 0], [2 ** 53, 1, 1])
+
+    assert int(totals[0]) == 2 ** 53 + 2
+    assert np.bincount([0, 0, 0], weights=[2 ** 53, 1, 1])[0] != 2 ** 53 + 2
+
+
+def test_accumulate_with_nothing_to_add():
+    totals = np.zeros(3, dtype=np.int64)
+
+    reconcile._accumulate(totals, np.array([], dtype=np.intp), [])
+
+    assert totals.tolist() == [0, 0, 0]
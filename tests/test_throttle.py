@@ -0,0 +1,236 @@
+import throttle
+import pytest
+import types
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeCursor():
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        if self.conn.error:
+            raise self.conn.error
+        self.conn.executed.append((sql, params))
+
+    def fetchall(self):
+        return self.conn.rows
+
+
+class FakeConnection():
+    '''Stands in for a pooled connection, recording what is executed on it'''
+    def __init__(self, rows=(), error=None):
+        self.rows = list(rows)
+        self.error = error
+        self.executed = []
+        self.committed = self.rolled_back = self.released = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+@pytest.fixture
+def database(monkeypatch):
+    '''Routes the throttle's connections to one FakeConnection'''
+    db = types.SimpleNamespace(conn=FakeConnection())
+
+    def release_conn(conn):
+        if conn:
+            conn.released = True
+
+    monkeypatch.setattr(throttle.utils, "connect_to_db", lambda *args, **kwargs: db.conn)
+    monkeypatch.setattr(throttle.utils, "release_conn", release_conn)
+    return db
+
+
+def _throttle(**kwargs):
+    options = dict(max_failures=3, burst=2, rate_per_minute=60, source_max_failures=5, window_seconds=60)
+    options.update(kwargs)
+    return throttle.LoginThrottle(**options)
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = throttle.TokenBucket(2, 0.5, 0)
+
+    assert bucket.take(0) and bucket.take(0)
+    assert not bucket.take(0)
+    assert not bucket.take(1)
+    assert bucket.take(2)
+    assert not bucket.full(2)
+    assert bucket.full(6)
+
+
+def test_sliding_window_forgets_old_events():
+    window = throttle.SlidingWindow(10)
+    window.add(0)
+    window.add(5)
+
+    assert window.count(9) == 2
+    assert window.count(10) == 1
+    assert window.count(15) == 0
+
+
+def test_check_limits_bursts_per_username_and_source(clock):
+    limiter = _throttle()
+
+    assert limiter.check("alice", "10.0.0.1") is None
+    assert limiter.check("alice", "10.0.0.1") is None
+    assert limiter.check("alice", "10.0.0.2") == throttle.RATE_LIMITED
+    assert limiter.check("bob", "10.0.0.1") == throttle.RATE_LIMITED
+    assert limiter.rejected["rate"] == 2
+
+    clock.now += 1
+    assert limiter.check("alice", "10.0.0.3") is None
+
+
+def test_consecutive_failures_lock_the_username(clock):
+    limiter = _throttle(burst=10)
+
+    assert [limiter.record_failure("alice", "10.0.0.1") for _ in range(3)] == [1, 2, 3]
+    assert limiter.check("alice", "10.0.0.9") == throttle.LOCKED
+    assert limiter.check("bob", "10.0.0.9") is None
+    assert limiter.rejected["locked"] == 1
+
+
+def test_failures_continue_from_the_stored_count(clock):
+    limiter = _throttle()
+
+    assert limiter.record_failure("alice", "10.0.0.1", stored_failures=2) == 3
+    assert limiter.dirty == {"alice"}
+
+
+def test_source_failures_are_capped_across_usernames(clock):
+    limiter = _throttle(burst=10)
+
+    for i in range(5):
+        limiter.record_failure(f"user{i}", "10.0.0.1")
+    assert limiter.record_failure(None, "10.0.0.1") == 0
+
+    assert limiter.check("someone", "10.0.0.1") == throttle.RATE_LIMITED
+    assert limiter.rejected["source_failures"] == 1
+
+    clock.now += 60
+    assert limiter.check("someone", "10.0.0.1") is None
+
+
+def test_success_clears_failures(clock):
+    limiter = _throttle()
+    limiter.record_failure("alice", "10.0.0.1")
+    limiter.dirty.clear()
+
+    limiter.record_success("alice")
+
+    assert limiter.failures["alice"] == 0
+    assert limiter.dirty == {"alice"}
+
+
+def test_persisted_success_during_a_flush_is_written_again(clock):
+    limiter = _throttle()
+    limiter.record_failure("alice", "10.0.0.1")
+    limiter.record_failure("bob", "10.0.0.1")
+    limiter.flushing = {"alice"}
+    limiter.dirty.clear()
+
+    limiter.record_success("alice", persisted=True)
+    limiter.record_success("bob", persisted=True)
+
+    assert limiter.failures == {"alice": 0}
+    assert limiter.dirty == {"alice"}
+
+
+def test_remember_lockout_keeps_the_higher_count():
+    limiter = _throttle()
+    limiter.remember_lockout("alice", 4)
+    limiter.remember_lockout("alice", 2)
+
+    assert limiter.failures["alice"] == 4
+
+
+def test_flush_writes_changed_counts_in_one_statement(clock, database):
+    limiter = _throttle()
+    limiter.record_failure("alice", "10.0.0.1")
+    limiter.record_failure("alice", "10.0.0.1")
+    limiter.record_failure("bob", "10.0.0.1")
+
+    assert limiter.flush() == 2
+
+    (sql, (usernames, failures)), = database.conn.executed
+    assert dict(zip(usernames, failures)) == {"alice": 2, "bob": 1}
+    assert database.conn.committed and database.conn.released
+    assert limiter.dirty == set() and limiter.flushing == set()
+    assert limiter.flush() == 0
+
+
+def test_failed_flush_is_retried(clock, database):
+    limiter = _throttle()
+    limiter.record_failure("alice", "10.0.0.1")
+    database.conn = FakeConnection(error=RuntimeError("connection lost"))
+
+    with pytest.raises(RuntimeError):
+        limiter.flush()
+
+    assert database.conn.rolled_back and database.conn.released
+    assert limiter.dirty == {"alice"} and limiter.flushing == set()
+
+
+def test_refresh_lockouts_lifts_resets_made_in_the_database(clock, database):
+    limiter = _throttle()
+    limiter.remember_lockout("alice", 3)
+    limiter.remember_lockout("bob", 5)
+    database.conn = FakeConnection(rows=[("alice", 0), ("bob", 5)])
+
+    assert limiter.refresh_lockouts() == 1
+
+    assert limiter.failures == {"alice": 0, "bob": 5}
+    assert limiter.check("alice", "10.0.0.1") is None
+    assert limiter.check("bob", "10.0.0.1") == throttle.LOCKED
+
+
+def test_refresh_lockouts_skips_unflushed_usernames(clock, database):
+    limiter = _throttle(burst=10)
+    for _ in range(3):
+        limiter.record_failure("alice", "10.0.0.1")
+
+    assert limiter.refresh_lockouts() == 0
+    assert database.conn.executed == []
+
+
+def test_prune_keeps_only_live_state(clock):
+    limiter = _throttle(burst=10)
+    limiter.check("alice", "10.0.0.1")
+    limiter.record_failure("bob", "10.0.0.2")
+    limiter.record_success("carol", stored_failures=1)
+    limiter.dirty.discard("carol")
+
+    clock.now += 60
+    limiter.prune()
+
+    assert limiter.buckets == {}
+    assert limiter.source_failures == {}
+    assert limiter.failures == {"bob": 1}
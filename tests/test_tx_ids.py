@@ -0,0 +1,71 @@
+import datetime
+import random
+import utils
+import uuid
+
+
+def _ms(tx_id):
+    return uuid.UUID(tx_id).int >> 80
+
+
+def test_new_tx_id_is_a_uuid_v7():
+    tx_id = uuid.UUID(utils.new_tx_id())
+
+    assert tx_id.version == 7
+    assert tx_id.variant == uuid.RFC_4122
+
+
+def test_new_tx_id_increases_within_a_process():
+    ids = [utils.new_tx_id() for _ in range(10000)]
+
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+
+
+def test_new_tx_id_keeps_increasing_when_the_clock_stalls(monkeypatch):
+    now = utils.time.time_ns()
+    monkeypatch.setattr(utils, "_tx_id_last_ms", 0)
+    monkeypatch.setattr(utils.time, "time_ns", lambda: now)
+
+    # More ids than the 12-bit counter holds in one millisecond
+    ids = [utils.new_tx_id() for _ in range(5000)]
+
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+    assert _ms(ids[0]) == now // 1_000_000
+    assert _ms(ids[-1]) == now // 1_000_000 + 1
+
+
+def test_new_tx_id_keeps_increasing_when_the_clock_goes_back(monkeypatch):
+    first = utils.new_tx_id()
+    monkeypatch.setattr(utils.time, "time_ns", lambda: 0)
+
+    assert utils.new_tx_id() > first
+
+
+def test_backdated_tx_id_carries_its_time():
+    at = datetime.datetime(2026, 9, 30, 12, 0, 0, 250000, tzinfo=datetime.timezone.utc)
+
+    assert _ms(utils.new_tx_id(at=at)) == int(at.timestamp() * 1000)
+
+
+def test_seeded_tx_ids_are_reproducible():
+    at = datetime.datetime(2026, 9, 30, tzinfo=datetime.timezone.utc)
+
+    first = [utils.new_tx_id(at=at, rng=random.Random(7)) for _ in range(3)]
+    second = [utils.new_tx_id(at=at, rng=random.Random(7)) for _ in range(3)]
+
+    assert first == second
+
+
+def test_tx_id_floor_splits_ids_at_its_millisecond():
+    at = datetime.datetime(2026, 9, 30, 12, 0, 0, tzinfo=datetime.timezone.utc)
+    floor = utils.tx_id_floor(at)
+    before = at - datetime.timedelta(milliseconds=1)
+
+    for _ in range(200):
+        assert utils.new_tx_id(at=at) >= floor
+        assert utils.new_tx_id(at=at + datetime.timedelta(seconds=1)) > floor
+        assert utils.new_tx_id(at=before) < floor
+
+    assert uuid.UUID(floor).version == 7
@@ -0,0 +1,378 @@
+import collections
+import threading
+import logging
+import metrics
+import atexit
+import utils
+import time
+import os
+
+logger = logging.getLogger('banking_throttle')
+
+'''
+Login throttling
+
+Sits in front of User.login and turns away excess attempts before they
+reach the database:
+
+- a token bucket per username and per source caps the attempt rate
+- a sliding window per source caps failed attempts across usernames,
+  which stops one client from guessing many accounts
+- usernames with LOGIN_MAX_FAILURES consecutive failures are locked out
+
+Failure counts live in memory. A background thread writes the ones that
+changed to Users.failed_login_attempts every LOGIN_PERSIST_SECONDS in one
+statement, so a burst of wrong passwords is one write, not one per attempt.
+Locked usernames stay locked across restarts through that column, and the
+same thread re-reads it for usernames locked in memory, so a lockout support
+resets in the database is lifted here within LOGIN_PERSIST_SECONDS.
+'''
+
+LOGIN_MAX_FAILURES = int(os.getenv("LOGIN_MAX_FAILURES", "3"))
+LOGIN_BURST = float(os.getenv("LOGIN_BURST", "5"))
+LOGIN_RATE_PER_MINUTE = float(os.getenv("LOGIN_RATE_PER_MINUTE", "10"))
+LOGIN_SOURCE_MAX_FAILURES = int(os.getenv("LOGIN_SOURCE_MAX_FAILURES", "20"))
+LOGIN_WINDOW_SECONDS = float(os.getenv("LOGIN_WINDOW_SECONDS", "900"))
+LOGIN_PERSIST_SECONDS = float(os.getenv("LOGIN_PERSIST_SECONDS", "5"))
+
+RATE_LIMITED = "Too many login attempts. Please try again later"
+LOCKED = "Account is locked. Please contact support"
+
+
+class TokenBucket():
+    '''Allows bursts of capacity attempts, refilled at rate per second'''
+    def __init__ (self, capacity, rate, now):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class SlidingWindow():
+    '''Counts events in the last window seconds'''
+    def __init__ (self, window):
+        self.window = window
+        self.events = collections.deque()
+
+    def _expire(self, now):
+        while self.events and self.events[0] <= now - self.window:
+            self.events.popleft()
+
+    def add(self, now):
+        self._expire(now)
+        self.events.append(now)
+
+    def count(self, now):
+        self._expire(now)
+        return len(self.events)
+
+
+class LoginThrottle():
+    '''
+    In-process login throttle
+
+    Args:
+        max_failures: Consecutive failures that lock a username
+        burst: Attempts a username or source can make at once
+        rate_per_minute: Attempts per minute a username or source regains
+        source_max_failures: Failures a source may have within window_seconds
+        window_seconds: Length of the source failure window
+    '''
+    def __init__ (self, max_failures=LOGIN_MAX_FAILURES, burst=LOGIN_BURST, rate_per_minute=LOGIN_RATE_PER_MINUTE,
+                  source_max_failures=LOGIN_SOURCE_MAX_FAILURES, window_seconds=LOGIN_WINDOW_SECONDS):
+        self.max_failures = max_failures
+        self.burst = burst
+        self.rate = rate_per_minute / 60
+        self.source_max_failures = source_max_failures
+        self.window_seconds = window_seconds
+
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.source_failures = {}
+        # Consecutive failures per username, and the ones not written to Users yet
+        self.failures = {}
+        self.dirty = set()
+        # Usernames whose counts a flush is writing right now
+        self.flushing = set()
+        self.rejected = collections.Counter()
+
+
+    def _bucket(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.burst, self.rate, now)
+        return bucket
+
+
+    def check(self, username, source):
+        '''
+        Decides whether an attempt may go to the database
+
+        Args:
+            username: Username being logged into
+            source: Where the attempt comes from, e.g a client address
+
+        Returns:
+            None when allowed, otherwise the message to reject it with
+        '''
+        now = time.monotonic()
+
+        with self.lock:
+            if self.failures.get(username, 0) >= self.max_failures:
+                self.rejected["locked"] += 1
+                return LOCKED
+
+            window = self.source_failures.get(source)
+            if window and window.count(now) >= self.source_max_failures:
+                self.rejected["source_failures"] += 1
+                return RATE_LIMITED
+
+            # Both buckets are charged, so neither key can be used to spare the other
+            allowed_user = self._bucket(("user", username), now).take(now)
+            allowed_source = self._bucket(("source", source), now).take(now)
+            if not (allowed_user and allowed_source):
+                self.rejected["rate"] += 1
+                return RATE_LIMITED
+
+        return None
+
+
+    def record_failure(self, username, source, stored_failures=0):
+        '''
+        Counts a failed attempt
+
+        Args:
+            username: Username that failed, or None when it doesn't exist
+            source: Where the attempt came from
+            stored_failures: failed_login_attempts read from Users
+
+        Returns:
+            The username's consecutive failures
+        '''
+        now = time.monotonic()
+
+        with self.lock:
+            window = self.source_failures.get(source)
+            if window is None:
+                window = self.source_failures[source] = SlidingWindow(self.window_seconds)
+            window.add(now)
+
+            if username is None:
+                return 0
+
+            failures = max(self.failures.get(username, 0), stored_failures or 0) + 1
+            self.failures[username] = failures
+            self.dirty.add(username)
+
+        if failures >= self.max_failures:
+            logger.warning(f"User {username} locked out after {failures} failed logins")
+        return failures
+
+
+    def record_success(self, username, stored_failures=0, persisted=False):
+        '''
+        Clears a username's failures after a good password
+
+        Args:
+            username: Username that logged in
+            stored_failures: failed_login_attempts read from Users
+            persisted: The caller already reset failed_login_attempts
+        '''
+        with self.lock:
+            if persisted and username not in self.flushing:
+                self.failures.pop(username, None)
+                self.dirty.discard(username)
+            elif persisted:
+                # A flush in flight may write the old count over the reset, so write 0 again after it
+                self.failures[username] = 0
+                self.dirty.add(username)
+            elif self.failures.pop(username, 0) or stored_failures:
+                self.failures[username] = 0
+                self.dirty.add(username)
+
+
+    def remember_lockout(self, username, stored_failures):
+        '''Keeps a lockout read from Users so later attempts don't reach the database'''
+        with self.lock:
+            if stored_failures > self.failures.get(username, 0):
+                self.failures[username] = stored_failures
+
+
+    def flush(self):
+        '''
+        Writes the changed failure counts to Users in one statement
+
+        Returns:
+            Number of usernames written
+        '''
+        with self.lock:
+            pending = {username: self.failures.get(username, 0) for username in self.dirty}
+            self.dirty = set()
+            self.flushing = set(pending)
+
+        if not pending:
+            return 0
+
+        conn = None
+        try:
+            conn = utils.connect_to_db()
+            with conn.cursor() as cur:
+                cur.execute("UPDATE Users u SET failed_login_attempts = v.failures " \
+                            "FROM unnest(%s::varchar[], %s::integer[]) AS v(username, failures) " \
+                            "WHERE u.username = v.username", (list(pending), list(pending.values())))
+            conn.commit()
+        except Exception as e:
+            if conn:
+                conn.rollback()
+            logger.error(f"Failed to persist login failures: {e}")
+
+            # Retried on the next flush unless newer counts replaced them
+            with self.lock:
+                self.dirty |= set(pending)
+            raise
+        finally:
+            with self.lock:
+                self.flushing = set()
+            utils.release_conn(conn)
+
+        return len(pending)
+
+
+    def refresh_lockouts(self):
+        '''
+        Lifts lockouts held in memory that were reset in Users
+
+        Returns:
+            Number of usernames unlocked
+        '''
+        with self.lock:
+            locked = {username: failures for username, failures in self.failures.items()
+                      if failures >= self.max_failures and username not in self.dirty}
+
+        if not locked:
+            return 0
+
+        conn = None
+        try:
+            # The primary, since a lagging replica could show a count from before the lockout
+            conn = utils.connect_to_db()
+            with conn.cursor() as cur:
+                cur.execute("SELECT username, failed_login_attempts FROM Users WHERE username = ANY(%s)",
+                            (list(locked),))
+                stored = dict(cur.fetchall())
+            conn.commit()
+        finally:
+            utils.release_conn(conn)
+
+        unlocked = 0
+        with self.lock:
+            for username, failures in stored.items():
+                # Skipped when an attempt changed the count while the column was read
+                if (failures or 0) < self.max_failures and self.failures.get(username) == locked[username] \
+                        and username not in self.dirty:
+                    self.failures[username] = failures or 0
+                    unlocked += 1
+
+        if unlocked:
+            logger.info(f"Lifted {unlocked} login lockouts reset in the database")
+        return unlocked
+
+
+    def prune(self):
+        '''Drops full buckets, empty windows and cleared failure counts that are already persisted'''
+        now = time.monotonic()
+
+        with self.lock:
+            self.buckets = {key: bucket for key, bucket in self.buckets.items() if not bucket.full(now)}
+            self.source_failures = {source: window for source, window in self.source_failures.items()
+                                    if window.count(now)}
+            self.failures = {username: failures for username, failures in self.failures.items()
+                             if failures or username in self.dirty}
+
+
+class ThrottleFlusher(threading.Thread):
+    '''Daemon thread that persists, refreshes and prunes the throttle every interval seconds'''
+    def __init__(self, throttle, interval):
+        super().__init__(name="login-throttle-flusher", daemon=True)
+        self.throttle = throttle
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.throttle.flush()
+                self.throttle.refresh_lockouts()
+                self.throttle.prune()
+            except Exception as e:
+                logger.error(f"Failed to flush the login throttle: {e}")
+
+    def stop(self):
+        self.stopped.set()
+
+
+_throttle = None
+_flusher = None
+_throttle_lock = threading.Lock()
+
+
+def get_throttle():
+    '''
+    Gets the process-wide LoginThrottle
+
+    Starts the flusher on first use and flushes once more at exit.
+
+    Returns:
+        The LoginThrottle
+    '''
+    global _throttle, _flusher
+
+    if _throttle is not None:
+        return _throttle
+
+    with _throttle_lock:
+        if _throttle is None:
+            throttle = LoginThrottle()
+            _flusher = ThrottleFlusher(throttle, LOGIN_PERSIST_SECONDS)
+            _flusher.start()
+            atexit.register(_flush_at_exit, throttle)
+            _throttle = throttle
+
+    return _throttle
+
+
+def _flush_at_exit(throttle):
+    try:
+        throttle.flush()
+    except Exception:
+        pass
+
+
+def rejected_attempts():
+    '''Login attempts turned away before reaching the database'''
+    return sum(_throttle.rejected.values()) if _throttle else 0
+
+
+def locked_usernames():
+    '''Usernames locked out in this process'''
+    if _throttle is None:
+        return 0
+    return sum(1 for failures in list(_throttle.failures.values()) if failures >= _throttle.max_failures)
+
+
+metrics.register_gauge("bank_login_rejected_attempts",
+                       "Login attempts rejected by the throttle before reaching the database", rejected_attempts)
+metrics.register_gauge("bank_login_locked_usernames",
+                       "Usernames locked out after too many failed logins", locked_usernames)
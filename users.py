@@ -3,18 +3,35 @@ import pandas as pd
 import datetime
 import logging
 import psycopg2
+import throttle
+import archive
+import metrics
+import rates
 import utils
 import uuid
-import time
 import re
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='banking_system.log'
-)
 logger = logging.getLogger('banking_users')
 
+LOGIN_PROFILE_FIELDS = ["user_id", "username", "email", "fullname", "created_on", "is_admin",
+                        "last_login", "previous_login"]
+
+# Checks the password and lockout, and on success resets the failures and
+# sets last_login. Returns no row for an unknown username
+_LOGIN = """
+    WITH attempt AS (
+        SELECT user_id, password = %(password)s AS password_ok,
+               COALESCE(failed_login_attempts, 0) AS failures, last_login AS previous_login
+        FROM Users WHERE username = %(username)s),
+    login AS (
+        UPDATE Users u SET failed_login_attempts = 0, last_login = %(now)s
+        FROM attempt a
+        WHERE u.user_id = a.user_id AND a.password_ok AND a.failures < %(max_failures)s
+        RETURNING u.user_id, u.username, u.email, u.fullname, u.created_on, u.is_admin, u.last_login)
+    SELECT a.password_ok, a.failures, l.user_id, l.username, l.email, l.fullname, l.created_on,
+           l.is_admin, l.last_login, a.previous_login
+    FROM attempt a LEFT JOIN login l ON l.user_id = a.user_id"""
+
 class User():
     def __init__ (self, user_id, username, password, email, fullname, creation_date):
         email_pattern = r'^\w{1,50}@\w{1,50}\.(com|org|net)'
@@ -30,6 +47,7 @@ class User():
         self.creation_date = creation_date
 
     
+    @metrics.instrument("User.create_user")
     def create_user(self, username, password, email, fullname):
         '''
         Creates a user profile
@@ -85,7 +103,7 @@ class User():
                 # Update Users table with user's details
                 with conn.cursor() as cur:
                     cur.execute("""INSERT INTO Users(
-                                username, password, email, fullname, is_admin, failed_attempts, last_login)
+                                username, password, email, fullname, is_admin, failed_login_attempts, last_login)
                                 Values(%s, %s, %s, %s, %s, %s, %s) RETURNING user_id;""", user_data)
                     
                     rows = cur.fetchall()
@@ -109,75 +127,88 @@ class User():
 
 
 
-    def authenticate_user(self, username, password):
+    @metrics.instrument("User.login")
+    def login(self, username, password, source="local"):
         '''
-        Ensures that person trying to login is indeed the user
+        Logs a user in and returns their profile in one round trip
+
+        One statement checks the password and lockout, resets the failure
+        count, sets last_login and returns the profile. Attempts are checked
+        against the login throttle first, so rate limited and locked out
+        attempts never reach the database. Failures are counted by the
+        throttle and written to Users in batches.
 
         Args:
             username: Username of the user
             password: Hashed value of the password
+            source: Where the attempt comes from, e.g a client address
 
         Returns:
-            String detailing if login was successful or not
+            Dictionary with user_id, username, email, fullname, created_on,
+            is_admin, last_login and previous_login, or a string saying why
+            the login failed
         '''
+        login_throttle = throttle.get_throttle()
+        rejected = login_throttle.check(username, source)
+        if rejected:
+            logger.info(f"Login for {username} from {source} rejected by the throttle: {rejected}")
+            return rejected
+
         conn = None
         try:
             conn = utils.connect_to_db()
             with conn.cursor() as cur:
-                cur.execute("SELECT username, password, failed_attempts FROM Users WHERE username = %s;",
-                            (username,))
+                cur.execute(_LOGIN, {"username": username, "password": password,
+                                     "max_failures": throttle.LOGIN_MAX_FAILURES, "now": datetime.datetime.now()})
                 rows = cur.fetchone()
-                
+            conn.commit()
         except Exception as e:
-            logger.error(f"Couldn't fetch username and password: {e}")
+            if conn:
+                conn.rollback()
+            logger.error(f"Unable to log {username} in: {e}")
             raise
         finally:
-            cur.close()
             utils.release_conn(conn)
 
-        password_hash = rows[1]
-        failed_attempts = rows[2]
+        if not rows:
+            login_throttle.record_failure(None, source)
+            return "Account not found"
 
-        if failed_attempts and failed_attempts == 3:
-            logger.info(f"User {username} is locked out")
-            return "Account is locked. Please contact support"
-        
-        if rows[0] == username:
-            result = utils.verify_password(password_hash, password)
-            if result:
-                try:
-                    conn = utils.connect_to_db()
-                    with conn.cursor() as cur:
-                        cur.execute("UPDATE Users SET failed_attempts = 0 WHERE username = %s", (username,))
+        password_ok, failed_attempts, user_id = rows[:3]
 
-                        conn.commit()
-                        return "Login Successful"
-                except Exception as e:
-                    logger.error(f"Unable to update failed attempts: {e}")
-                finally:
-                    cur.close()
-                    utils.release_conn(conn)
-            else:
-                failed_attempts += 1
-                try:
-                    conn = utils.connect_to_db()
-                    with conn.cursor() as cur:
-                        cur.execute("UPDATE Users SET failed_attempts = %s WHERE username = %s",(failed_attempts, username))
-                
-                        conn.commit()
-                        return "Wrong password."
-                except Exception as e:
-                    if conn:
-                        conn.rollback()
-                    logger.error(f"Unable to update failed attempts: {e}")
-                    raise
-                finally:
-                    cur.close()
-                    utils.release_conn(conn)    
-        else:
-            return "Account not found"
+        if failed_attempts >= throttle.LOGIN_MAX_FAILURES:
+            login_throttle.remember_lockout(username, failed_attempts)
+            logger.info("User %s is locked out", username)
+            return throttle.LOCKED
+
+        if not password_ok:
+            login_throttle.record_failure(username, source, failed_attempts)
+            return "Wrong password."
+
+        # The statement already reset failed_login_attempts
+        login_throttle.record_success(username, persisted=True)
+        logger.info(f"{user_id} logged in")
+        return dict(zip(LOGIN_PROFILE_FIELDS, rows[2:]))
+
+
+    @metrics.instrument("User.authenticate_user")
+    def authenticate_user(self, username, password, source="local"):
+        '''
+        Ensures that person trying to login is indeed the user
+
+        Args:
+            username: Username of the user
+            password: Hashed value of the password
+            source: Where the attempt comes from, e.g a client address
+
+        Returns:
+            String detailing if login was successful or not
+        '''
+        result = self.login(username, password, source)
+        return "Login Successful" if isinstance(result, dict) else result
         
          
+    @metrics.instrument("User.get_user_details")
     def get_user_details(self, user_id):
         '''
         Gets users details
@@ -208,6 +239,7 @@ class User():
             return "User not found"
 
 
+@metrics.instrument("update_user_details")
 def update_user_details(user_id, field, value):
     '''
     ADMIN ONLY FUNCTION
@@ -240,7 +272,7 @@ def update_user_details(user_id, field, value):
                         cur.execute("UPDATE Users SET username = %s WHERE user_id = %s", (value, user_id))
                         conn.commit()
 
-                        logger.info(f"Updated {field} successfully")
+                        logger.info("Updated %s successfully", field)
                         return f"Username updated to {value} successfully"
                     except Exception as e:
                             if conn:
@@ -259,7 +291,7 @@ def update_user_details(user_id, field, value):
                             cur.execute("UPDATE Users SET email = %s WHERE user_id = %s", (value, user_id))
                             conn.commit()
 
-                            logger.info(f"Updated {value} successfully")
+                            logger.info("Updated %s successfully", value)
                             return f"Email updated to {value} successfully"
 
                         except Exception as e:
@@ -278,7 +310,7 @@ def update_user_details(user_id, field, value):
                         cur.execute("UPDATE Users SET fullname = %s WHERE user_id = %s", (value, user_id))
                         conn.commit()
                     
-                        logger.info(f"Updated {value} successfully")
+                        logger.info("Updated %s successfully", value)
                     
                     except Exception as e:
                         if conn:
@@ -304,6 +336,7 @@ class Account():
         self.is_active = is_active
         
 
+    @metrics.instrument("Account.create_account")
     def create_account(self, user_id, account_id, currency_code, initial_balance):
         '''
         Creates a currency account for a user
@@ -322,7 +355,7 @@ class Account():
         try:
             conn = utils.connect_to_db()
             with conn.cursor() as cur:
-                cur.execute("SELECT user_id, account_id, currency_code FROM Accounts WHERE user_id = %s;", (user_id,))
+                cur.execute("SELECT user_id, account_id, currency_code FROM AccountDetails WHERE user_id = %s;", (user_id,))
                 rows = cur.fetchall()
         except Exception as e:
             logger.error(f"Failed to get users: {e}")
@@ -344,19 +377,21 @@ class Account():
                         break
         
         if not account_exists:
+            # Looked up before checking out a connection, a cache miss takes one of its own
+            currency_id = utils.get_currency_id(currency_code)
             try:
                 conn = utils.connect_to_db()
                 account_data = (
                     user_id,
                     account_id,
-                    currency_code,
+                    currency_id,
                     initial_balance,
                     is_active
                     )
                 
                 with conn.cursor() as cur:
                     cur.execute("INSERT INTO Accounts(" \
-                                "user_id, account_id, currency_code, balance, is_active) " \
+                                "user_id, account_id, currency_id, balance, is_active) " \
                                 "Values(%s, %s, %s, %s, %s)", (account_data))
                 
                     conn.commit()
@@ -372,6 +407,7 @@ class Account():
             return "Account already exists"
         
 
+    @metrics.instrument("Account.get_accounts")
     def get_accounts(self, user_id):
         '''
         Gets all accounts owned by a user
@@ -382,21 +418,23 @@ class Account():
         Returns:
             Tuple containing lists of all accounts and their details
         '''        
-        conn = None
+        conn = cur = None
         try:
-            conn = utils.connect_to_db()
+            conn = utils.connect_to_db(read_only=True)
             with conn.cursor() as cur:
-                cur.execute("SELECT * FROM Accounts WHERE user_id = %s", (user_id))
-                rows = cur.fetchone()
+                cur.execute("SELECT * FROM AccountDetails WHERE user_id = %s ORDER BY account_id", (user_id,))
+                rows = cur.fetchall()
 
                 return rows
         except Exception as e:
             logger.error(f"Couldn't fetch accounts: {e}")
             raise
         finally:
-            cur.close()
+            if cur:
+                cur.close()
             utils.release_conn(conn)
 
+    @metrics.instrument("Account.close_account")
     def close_account(self, account_id, user_id):
         '''
         Deactivates account. Prevents it from participating in transactions
@@ -424,41 +462,121 @@ class Account():
             cur.close()
             utils.release_conn(conn)
 
-def deposit(user_id, account_id, amount):
-    
+def _claim_idempotency_key(cur, user_id, key, operation, request):
+    '''
+    Claims an idempotency key on the caller's transaction
+
+    A concurrent call with the same key waits on the unique index until the
+    first one commits or rolls back.
+
+    Args:
+        cur: Cursor of the transaction that moves the money
+        user_id: User making the request. Keys are unique per user
+        key: Caller supplied idempotency key
+        operation: Name of the money movement, e.g "deposit"
+        request: Tuple of the call's arguments, to catch a key reused for a different request
+
+    Returns:
+        None when the key is new, otherwise the result of the first call
+    '''
+    request = ":".join(str(arg) for arg in request)
+    cur.execute("INSERT INTO IdempotencyKeys (user_id, idempotency_key, operation, request, created_on) " \
+                "VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING RETURNING 1",
+                (user_id, key, operation, request, datetime.datetime.now()))
+    if cur.fetchone():
+        return None
+
+    return _stored_result(cur, user_id, key, operation, request)
+
+
+def _stored_result(cur, user_id, key, operation, request):
+    '''Gets the result stored for an idempotency key, or None when it hasn't been used'''
+    if not isinstance(request, str):
+        request = ":".join(str(arg) for arg in request)
+
+    cur.execute("SELECT operation, request, result FROM IdempotencyKeys WHERE user_id = %s AND idempotency_key = %s",
+                (user_id, key))
+    rows = cur.fetchone()
+
+    if not rows:
+        return None
+    if rows[0] != operation or rows[1] != request:
+        raise ValueError(f"Idempotency key {key} was already used for a different request")
+
+    logger.info(f"Returning stored result for idempotency key {key}")
+    return rows[2]
+
+
+def _save_result(cur, user_id, key, tx_id, result):
+    '''Stores the result of a money movement under its idempotency key, before commit'''
+    cur.execute("UPDATE IdempotencyKeys SET tx_id = %s, result = %s WHERE user_id = %s AND idempotency_key = %s",
+                (tx_id, result, user_id, key))
+
+
+@metrics.instrument("deposit")
+def deposit(user_id, account_id, amount, idempotency_key=None):
+    '''
+    Deposits amount into an account
+
+    The balance is credited relative to its current value, so concurrent
+    deposits, postings and FX batches on the same account all land.
+
+    Args:
+        user_id: Owner of the account
+        account_id: Account to credit
+        amount: Amount in integer minor units
+        idempotency_key: Optional key from the caller. A repeat call with the
+            same key returns the first call's result without depositing again
+
+    Returns:
+        Success or failure message
+    '''
     amt = utils.validate_amount(amount)
-    tx_type = "Deposit"
+    tx_type = utils.TX_TYPES["Deposit"]
     created_on = datetime.datetime.now()
-    tx_id = str(uuid.uuid4()) + str(int(time.time()) * 1000)
-    conn = None
+    tx_id = utils.new_tx_id()
+    conn = cur = None
 
     try:
         conn = utils.connect_to_db()
         with conn.cursor() as cur:
-            cur.execute("SELECT balance, currency_code, is_active FROM Accounts WHERE account_id = %s AND user_id = %s;", (account_id, user_id))
+            if idempotency_key:
+                stored = _claim_idempotency_key(cur, user_id, idempotency_key, "deposit", (account_id, amount))
+                if stored is not None:
+                    return stored
+
+            utils.execute_prepared(cur, "account_by_id", (account_id, user_id))
             rows = cur.fetchone()
-            balance = rows[0]
+
+            if not rows:
+                return "Account not found. Check account_id."
+
             currency_code = rows[1]
             is_active = rows[2]
-            
+            currency_id = rows[3]
+
             if is_active:
-                if account_id:
-                    if amt == True:
-                        new_balance = balance + amount
-                        symbol = utils.format_currency(amount, currency_code)
-
-                        cur.execute("UPDATE Accounts SET balance = %s WHERE account_id = %s;", (new_balance, account_id))
-                        cur.execute("INSERT INTO Transactions (tx_time, tx_id, type, from_user_id, from_account_id, to_user_id, to_account_id, amount, currency_code)" \
-                                    "Values(%s, %s, %s, %s, %s, %s, %s, %s, %s);",
-                                    (created_on, tx_id, tx_type, None, None, user_id, account_id, amount, currency_code))
-                    
-                        conn.commit()
-                        logger.info("Deposit successful")
-                        return f"Deposit of {symbol} successful"
-                    else:
-                        return "Amount Not valid"
+                if amt == True:
+                    symbol = utils.format_currency(amount, currency_code)
+
+                    # Only matches while the account is active, which may have changed since the read
+                    utils.execute_prepared(cur, "credit_balance", (amount, account_id))
+                    if not cur.fetchone():
+                        return "Account closed. Reach out to support to reopen."
+
+                    utils.execute_prepared(cur, "insert_transaction",
+                                           (created_on, tx_id, tx_type, None, None, user_id, account_id, amount,
+                                            currency_id))
+
+                    message = f"Deposit of {symbol} successful"
+                    if idempotency_key:
+                        _save_result(cur, user_id, idempotency_key, tx_id, message)
+
+                    conn.commit()
+                    logger.info("Deposit successful")
+                    return message
                 else:
-                    return "Account not found. Check account_id."
+                    return "Amount Not valid"
             else:
                 return "Account closed. Reach out to support to reopen."
     except Exception as e:
@@ -467,50 +585,75 @@ def deposit(user_id, account_id, amount):
         logger.error(f"Unable to complete deposit: {e}")
         raise 
     finally:
-        cur.close()
+        if cur:
+            cur.close()
         utils.release_conn(conn)
 
 
-def withdraw(user_id, account_id, amount):
-    
+@metrics.instrument("withdraw")
+def withdraw(user_id, account_id, amount, idempotency_key=None):
+    '''
+    Withdraws amount from an account
+
+    The balance check and the debit are one guarded statement, so concurrent
+    withdrawals can't overdraw the account or overwrite each other.
+
+    Args:
+        user_id: Owner of the account
+        account_id: Account to debit
+        amount: Amount in integer minor units
+        idempotency_key: Optional key from the caller. A repeat call with the
+            same key returns the first call's result without withdrawing again
+
+    Returns:
+        Success or failure message
+    '''
     amt = utils.validate_amount(amount)
     created_on = datetime.datetime.now()
-    tx_type = "Withdraw"
-    tx_id = str(uuid.uuid4()) + str(int(time.time()) * 1000)
-    conn = None
+    tx_type = utils.TX_TYPES["Withdraw"]
+    tx_id = utils.new_tx_id()
+    conn = cur = None
 
     try:
         conn = utils.connect_to_db()
         with conn.cursor() as cur:
-            cur.execute("SELECT balance, currency_code, is_active FROM Accounts WHERE account_id = %s AND user_id = %s;", (account_id, user_id))
+            if idempotency_key:
+                stored = _claim_idempotency_key(cur, user_id, idempotency_key, "withdraw", (account_id, amount))
+                if stored is not None:
+                    return stored
+
+            utils.execute_prepared(cur, "account_by_id", (account_id, user_id))
             rows = cur.fetchone()
 
-            balance = rows[0]
+            if not rows:
+                return "Account doesn't exist."
+
             currency_code = rows[1]
             is_active = rows[2]
+            currency_id = rows[3]
 
-        if is_active:  
-            if balance:
-                if amount < balance:
-                    new_balance = balance - amount
-                    symbol = utils.format_currency(amount, currency_code)
+            if not is_active:
+                return "Account is closed. Please reach out to support."
+            if amt is not True:
+                return "Amount Not valid"
 
-                    with conn.cursor() as cur:
-                        cur.execute("UPDATE Accounts SET balance = %s WHERE account_id = %s", (new_balance, account_id))
-                        cur.execute("INSERT INTO Transactions (tx_time, tx_id, type, from_user_id, from_account_id, to_user_id, to_account_id, amount, currency_code)" \
-                                    "Values(%s, %s, %s, %s, %s, %s, %s, %s, %s);",
-                                    (created_on, tx_id, tx_type, user_id, account_id, None, None, amount, currency_code))
+            symbol = utils.format_currency(amount, currency_code)
 
-                        conn.commit()
-                        logger.info("Withdrawal successful")                
-                    return f"Withdrawal of {symbol} successful"
-                else:
-                    return "Insufficient funds. Please deposit"
-            else:
-                return "Account doesn't exist."
-        else:
-            return "Account is closed. Please reach out to support."
-        
+            utils.execute_prepared(cur, "debit_balance", (amount, account_id, amount))
+            if not cur.fetchone():
+                return "Insufficient funds. Please deposit"
+
+            utils.execute_prepared(cur, "insert_transaction",
+                                   (created_on, tx_id, tx_type, user_id, account_id, None, None, amount,
+                                    currency_id))
+
+            message = f"Withdrawal of {symbol} successful"
+            if idempotency_key:
+                _save_result(cur, user_id, idempotency_key, tx_id, message)
+
+            conn.commit()
+            logger.info("Withdrawal successful")
+            return message
     except Exception as e:
         if conn:
             conn.rollback()
@@ -518,122 +661,122 @@ def withdraw(user_id, account_id, amount):
 
         raise e
     finally:
-        conn.close()
+        if cur:
+            cur.close()
+        utils.release_conn(conn)
 
 
-def transfer(source_account_id, target_account_id, from_user_id, to_user_id, amount):
+@metrics.instrument("transfer")
+def transfer(source_account_id, target_account_id, from_user_id, to_user_id, amount, idempotency_key=None):
     '''
     Transfers amount from one account to another in the same currency
 
+    Both accounts are locked in account_id order and moved with guarded
+    relative updates in one transaction, so concurrent transfers neither
+    lose updates nor deadlock on each other.
+
     Args:
         source_account_id: Sending account
         target_account_id: Recipient account
         from_user_id: User initiating transfer
         to_user_id: Recipient of transfer
-        amount: Amount of currency being transferred
+        amount: Amount of currency being transferred, in integer minor units
+        idempotency_key: Optional key from the caller. A repeat call with the
+            same key returns the first call's result without transferring again
 
     Returns:
         Success or failure message
     '''
     amt = utils.validate_amount(amount)
     created_on = datetime.datetime.now()
-    tx_type = "Transfer"
-    tx_id = str(uuid.uuid4()) + str(int(time.time()) * 1000)
-    conn = None
-    
+    tx_type = utils.TX_TYPES["Transfer"]
+    tx_id = utils.new_tx_id()
+    request = (source_account_id, target_account_id, to_user_id, amount)
+    conn = cur = None
+
     try:
-        # Get a connection
         conn = utils.connect_to_db()
-        
+
         with conn.cursor() as cur:
+            # A concurrent call with the same key waits here and then returns the first call's result
+            if idempotency_key:
+                stored = _claim_idempotency_key(cur, from_user_id, idempotency_key, "transfer", request)
+                if stored is not None:
+                    return stored
+
+            cur.execute("SELECT account_id FROM Accounts WHERE account_id = ANY(%s) ORDER BY account_id FOR UPDATE",
+                        ([source_account_id, target_account_id],))
+
             # Fetch source account details from Database
-            cur.execute("""SELECT balance, currency_code, is_active FROM Accounts WHERE account_id = %s AND user_id = %s""", 
-                        (source_account_id, from_user_id))
+            utils.execute_prepared(cur, "account_by_id", (source_account_id, from_user_id))
             from_rows = cur.fetchone()
-            
-            if from_rows:
-                from_balance = from_rows[0]
-                from_code = from_rows[1]
-                from_is_active = from_rows[2]
 
             # Fetch recipient account from Database
-            cur.execute("""SELECT balance, currency_code, is_active FROM Accounts WHERE account_id = %s AND user_id = %s""", 
-                        (target_account_id, to_user_id))
+            utils.execute_prepared(cur, "account_by_id", (target_account_id, to_user_id))
             to_rows = cur.fetchone()
-            
 
-            if to_rows:
-                to_balance = to_rows[0]
-                to_code = to_rows[1]
-                to_is_active = to_rows[2]
-    except Exception as e:
-        logger.error(f"Error fetching info from database: {e}")
-        raise
-    finally:
-        cur.close()
-        utils.release_conn(conn)
+            if not from_rows or not from_rows[2]:
+                return "Your account is closed"
+            if not to_rows or not to_rows[2]:
+                return "Target account is closed"
+            if from_rows[1] != to_rows[1]:
+                return "You can't transfer between two different currencies. Try Currency Exchange instead"
+            if amt is not True:
+                return "Amount Not valid"
 
-    if from_is_active:
-        if to_is_active:
-            if from_balance > amount:
-                if to_code == from_code:
-                    if amt:
-                        from_new_balance = from_balance - amount
-                        to_new_balance = to_balance + amount
-                        code = from_code
+            code = from_rows[1]
+            symbol = utils.format_currency(amount, code)
 
-                        symbol = utils.format_currency(amount, code)
+            # Debit account
+            utils.execute_prepared(cur, "debit_balance", (amount, source_account_id, amount))
+            if not cur.fetchone():
+                return "Insufficient balance. Please deposit"
 
-                        try:
-                            conn = utils.connect_to_db()
-                            with conn.cursor() as cur:
-                                # Debit account
-                                cur.execute("UPDATE Accounts SET balance = %s WHERE account_id = %s;", (from_new_balance, source_account_id))
-
-                                # Credit account
-                                cur.execute("UPDATE Accounts SET balance = %s WHERE account_id = %s", (to_new_balance, target_account_id))
-
-                                # Add transaction to db
-                                cur.execute("INSERT INTO Transactions (tx_time, tx_id, type, from_user_id, from_account_id, to_user_id, to_account_id, amount, currency_code)" \
-                                            "Values (%s, %s, %s, %s, %s, %s, %s, %s, %s);",
-                                            (created_on, tx_id, tx_type, from_user_id, source_account_id, target_account_id, amount, code))
-                    
-                                conn.commit()
+            # Credit account
+            utils.execute_prepared(cur, "credit_balance", (amount, target_account_id))
+            cur.fetchone()
 
-                                logger.info("Transfer complete")
-                                return f"Transfer of {symbol} successful"
-                        except Exception as e:
-                            if conn:
-                                conn.rollback()
-                            logger.error(f"Error completing transfer: {e}")
-                            raise 
-                        finally:
-                            cur.close()
-                            utils.release_conn(conn)
-                    else:
-                        return "You can't transfer between two different currencies. Try Currency Exchange instead"
-                else:
-                    return "Insufficient balance. Please deposit"
-            else:
-                return "Target account is closed"
-        else:
-            return "Your account is closed"
+            # Add transaction to db
+            utils.execute_prepared(cur, "insert_transaction",
+                                   (created_on, tx_id, tx_type, from_user_id, source_account_id, to_user_id, target_account_id, amount,
+                                    from_rows[3]))
+
+            message = f"Transfer of {symbol} successful"
+            if idempotency_key:
+                _save_result(cur, from_user_id, idempotency_key, tx_id, message)
+
+            conn.commit()
+
+            logger.info("Transfer complete")
+            return message
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Error completing transfer: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+        utils.release_conn(conn)
 
 
+@metrics.instrument("get_transaction_history")
 def get_transaction_history(account_id, startdate=None, enddate=None):
     '''
     Gets transaction history for select account
 
     Args:
         account_id: Currency account of user logged in
+        startdate: First date to include. Defaults to the first transaction
+        enddate: Last date to include. Defaults to the latest transaction
 
     Returns:
-        List containing transactions over time
+        List containing transactions over time, archived ones first
     
     '''
-    conn = None
+    conn = cur = None
     try:
-        conn = utils.connect_to_db()
+        conn = utils.connect_to_db(read_only=True)
 
         with conn.cursor() as cur:
             cur.execute("SELECT account_id FROM Accounts WHERE account_id = %s", (account_id,))
@@ -644,18 +787,25 @@ def get_transaction_history(account_id, startdate=None, enddate=None):
         logger.error(f"Error fetching data from Database: {e}")
         raise
     finally:
-        cur.close()
+        if cur:
+            cur.close()
         utils.release_conn(conn)
 
     if accounts:
         try:
-            conn = utils.connect_to_db()
+            conn = utils.connect_to_db(read_only=True)
             # Fetch account's transactions from database
             with conn.cursor() as cur:
-                cur.execute("SELECT * FROM Transactions WHERE from_account_id = %s OR to_account_id = %s", (account_id, account_id))
+                cur.execute("SELECT * FROM TransactionDetails WHERE (from_account_id = %s OR to_account_id = %s) " \
+                            "AND (%s::date IS NULL OR tx_time::date >= %s) AND (%s::date IS NULL OR tx_time::date <= %s) " \
+                            "ORDER BY tx_time", (account_id, account_id, startdate, startdate, enddate, enddate))
                 rows = cur.fetchall()
 
-                result = rows
+                # Months moved out of Transactions by archive.py
+                end = enddate + datetime.timedelta(days=1) if enddate else None
+                archived = archive.details(archive.account_rows(cur, account_id, startdate, end))
+
+                result = archived + rows
                 logger.info("Transactions successfully fetched")
                 return result
         except Exception as e:
@@ -667,6 +817,7 @@ def get_transaction_history(account_id, startdate=None, enddate=None):
 
 
 # Currency Operations start here
+@metrics.instrument("get_exchange_rate")
 def get_exchange_rate(to_currency, from_currency):
     '''
     Gets the exchange rate of the base currency respect to the quote currency
@@ -676,53 +827,132 @@ def get_exchange_rate(to_currency, from_currency):
         from_currency: Currency you're transferring from
 
     Returns:
-        The ratio of from_currency to to_currency
+        The ratio of from_currency to to_currency, for display
     '''
+    return get_exchange_rate_fixed(to_currency, from_currency) / utils.RATE_SCALE
 
-    resp = utils.fetch_exchange_rate()
-    
-    if to_currency  == "USD":
-        
-            usd_rate = resp["data"][from_currency]
 
-            rate = 1/usd_rate
-            return rate
-            
-    elif from_currency == "USD":
-        usd_rate = resp["data"][to_currency]
+@metrics.instrument("get_exchange_rate_fixed")
+def get_exchange_rate_fixed(to_currency, from_currency):
+    '''
+    Gets the exchange rate as a fixed-point integer for money arithmetic
 
-        rate = usd_rate
-        return rate
-        
-    else:
-        to_rate = resp["data"][to_currency]
-        from_rate = resp["data"][from_currency]
+    Args:
+        to_currency: Currency you want to transfer to
+        from_currency: Currency you're transferring from
 
-        rate = (to_rate / from_rate)
+    Returns:
+        Units of to_currency per unit of from_currency, times utils.RATE_SCALE
+    '''
+
+    return rates.current().rate(to_currency, from_currency)
 
-        return rate
 
+@metrics.instrument("get_exchange_rate_at")
+def get_exchange_rate_at(to_currency, from_currency, when):
+    '''
+    Gets the exchange rate that was in effect at a point in time
 
+    Args:
+        to_currency: Currency you want to transfer to
+        from_currency: Currency you're transferring from
+        when: Point in time, e.g a transaction's tx_time
+
+    Returns:
+        Units of to_currency per unit of from_currency, times utils.RATE_SCALE
+    '''
+    return rates.rate_at(to_currency, from_currency, when)
+
+
+@metrics.instrument("convert_currency")
 def convert_currency(amount, from_currency, to_currency):
     '''
     Converts from one currency to another. Does not store the value.
 
     Args:
-        amount: amount to be converted
+        amount: amount to be converted, in from_currency minor units
         from_currency: Currency to be converted from
         to_currency: Currency to be converted to
     
     Returns:
-        Success message including amount received and symbol
+        Amount received in to_currency minor units and a success message including amount received and symbol
     '''
-    rate = get_exchange_rate(to_currency, from_currency)
+    rate = get_exchange_rate_fixed(to_currency, from_currency)
 
     if amount > 0:
-        amount_received = (amount * rate)
+        amount_received = utils.convert_minor(amount, rate, from_currency, to_currency)
         symbol = utils.format_currency(amount_received, to_currency)
 
         return amount_received, f"You have received {symbol} in your account"
 
+@metrics.instrument("get_portfolio_valuation")
+def get_portfolio_valuation(user_id, reporting_currency):
+    '''
+    Values all of a user's active accounts in one currency
+
+    Reads every balance in one query and converts them with a single
+    snapshot of exchange rates, so all accounts are valued at the same rates.
+
+    Args:
+        user_id: Owner of the accounts
+        reporting_currency: Currency to value the holdings in
+
+    Returns:
+        Dictionary with currency, total (minor units), as_of and a list of
+        accounts with account_id, currency_code, balance, rate and value
+    '''
+    conn = None
+
+    try:
+        conn = utils.connect_to_db()
+        with conn.cursor() as cur:
+            cur.execute("SELECT account_id, currency_code, balance FROM AccountDetails " \
+                        "WHERE user_id = %s AND is_active = TRUE ORDER BY account_id", (user_id,))
+            rows = cur.fetchall()
+
+            logger.info("Fetched balances for valuation")
+    except Exception as e:
+        logger.error(f"Failed to fetch balances: {e}")
+        raise
+    finally:
+        utils.release_conn(conn)
+
+    snapshot = None
+    as_of = datetime.datetime.now()
+    accounts = []
+    total = 0
+
+    for account_id, currency_code, balance in rows:
+        currency_code = currency_code.strip()
+
+        if currency_code == reporting_currency:
+            rate = utils.RATE_SCALE
+            value = balance
+        else:
+            # Take the snapshot once so every account is valued at the same rates
+            if snapshot is None:
+                snapshot = rates.current()
+                as_of = snapshot.taken_at
+            rate = snapshot.rate(reporting_currency, currency_code)
+            value = utils.convert_minor(balance, rate, currency_code, reporting_currency)
+
+        total += value
+        accounts.append({
+            "account_id": account_id,
+            "currency_code": currency_code,
+            "balance": balance,
+            "rate": rate / utils.RATE_SCALE,
+            "value": value
+        })
+
+    return {
+        "currency": reporting_currency,
+        "total": total,
+        "as_of": as_of,
+        "accounts": accounts
+    }
+
+@metrics.instrument("get_supported_currencies")
 def get_supported_currencies():
     '''
     Fetches the currencies currently supported by the bank
@@ -739,23 +969,17 @@ def get_supported_currencies():
             rows = cur.fetchall()
 
             logger.info("Fetched list of currencies")
+        conn.commit()
     except Exception as e:
         logger.error(f"Error fetching currency list: {e}")
         raise
     finally:
-        cur.close()
+        # The connection goes back to the pool, so it must not be closed here
         utils.release_conn(conn)
 
-    if not rows == []:
-            currencies = list(rows)
-
-            conn.close()
-
-            return currencies
-    else:
-        currencies = []
-        return []
+    return list(rows)
 
+@metrics.instrument("add_currency_code")
 def add_currency_code(currency_code):
     '''
     ADMIN ONLY FUNCTION
@@ -769,11 +993,8 @@ def add_currency_code(currency_code):
         Success or failure string
     '''
     conn = None
-    resp = utils.fetch_exchange_rate()
-    
-    if resp:
-        codes = resp["data"].keys()
-    
+    codes = rates.get_provider().fetch().keys() | {"USD"}
+
     try:
         conn = utils.connect_to_db()
         with conn.cursor() as cur:
@@ -791,10 +1012,13 @@ def add_currency_code(currency_code):
         if currency_code in codes:
             try:
                 conn = utils.connect_to_db()
+                exponent, symbol = utils.DEFAULT_CURRENCIES.get(currency_code, (utils.DEFAULT_EXPONENT, None))
                 with conn.cursor() as cur:
-                    cur.execute("INSERT INTO Currencies (currency_code) Values(%s)", (currency_code,))
+                    cur.execute("INSERT INTO Currencies (currency_code, minor_unit, symbol) Values(%s, %s, %s)",
+                                (currency_code, exponent, symbol))
             
                 conn.commit()
+                utils.load_currency_table()
                 logger.info("Added currency successfully")
                 return f"Added {currency_code} successfully"
             except Exception as e:
@@ -811,95 +1035,284 @@ def add_currency_code(currency_code):
         return "Currency already added"
       
 
+# Seconds a quoted exchange rate stays valid
+FX_QUOTE_TTL_SECONDS = 30
+
+
+def _create_quote(cur, account_id_from, account_id_to, to_user_id, from_user_id, amount, ttl_seconds):
+    '''
+    Locks the current rate for an exchange and stores it in FxQuotes
+
+    Returns:
+        Dictionary describing the quote, or a string saying why it can't be quoted
+    '''
+    utils.execute_prepared(cur, "account_by_id", (account_id_from, from_user_id))
+    from_rows = cur.fetchone()
+
+    utils.execute_prepared(cur, "account_by_id", (account_id_to, to_user_id))
+    to_rows = cur.fetchone()
+
+    if not from_rows or not to_rows:
+        return "Account doesn't exist."
+
+    from_balance, from_currency, from_is_active, _ = from_rows
+    _, to_currency, to_is_active, _ = to_rows
+
+    if to_currency == from_currency:
+        return "Currencies must be different to be converted. Try Transfer instead"
+    if not from_is_active:
+        return "YOur account is closed"
+    if not to_is_active:
+        return "Target account is closed"
+    if amount > from_balance:
+        return "Insufficient funds. Please deposit"
+
+    # Rates come from the in-memory snapshot, never from the network
+    snapshot = rates.current()
+    rate = snapshot.rate(to_currency, from_currency)
+    amount_received = utils.convert_minor(amount, rate, from_currency, to_currency)
+
+    quote_id = str(uuid.uuid4())
+    created_on = datetime.datetime.now()
+    expires_at = created_on + datetime.timedelta(seconds=ttl_seconds)
+
+    cur.execute("INSERT INTO FxQuotes (quote_id, user_id, from_account_id, to_user_id, to_account_id, " \
+                "from_currency, to_currency, amount, amount_received, rate, snapshot_time, created_on, expires_at) " \
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                (quote_id, from_user_id, account_id_from, to_user_id, account_id_to, from_currency, to_currency,
+                 amount, amount_received, rate, snapshot.taken_at, created_on, expires_at))
+
+    return {
+        "quote_id": quote_id,
+        "from_currency": from_currency,
+        "to_currency": to_currency,
+        "amount": amount,
+        "amount_received": amount_received,
+        "rate": rate / utils.RATE_SCALE,
+        "expires_at": expires_at
+    }
+
+
+def _execute_quote(cur, quote_id, from_user_id):
+    '''
+    Posts both legs of a quoted exchange on the caller's transaction
+
+    Returns:
+        Success or failure string. The caller must roll back unless it starts with "Successfully"
+    '''
+    created_on = datetime.datetime.now()
+    debit_tx_id = utils.new_tx_id()
+    credit_tx_id = utils.new_tx_id()
+
+    # Claiming the quote makes a second execute of the same quote a no-op
+    cur.execute("UPDATE FxQuotes SET executed_at = %s, debit_tx_id = %s, credit_tx_id = %s " \
+                "WHERE quote_id = %s AND user_id = %s AND executed_at IS NULL AND expires_at > %s " \
+                "RETURNING from_account_id, to_user_id, to_account_id, from_currency, to_currency, amount, amount_received",
+                (created_on, debit_tx_id, credit_tx_id, quote_id, from_user_id, created_on))
+    rows = cur.fetchone()
+
+    if not rows:
+        return "Quote not found, expired or already used. Request a new quote"
+
+    account_id_from, to_user_id, account_id_to, from_currency, to_currency, amount, amount_received = rows
+
+    # Each leg takes its currency_id from the account it updates
+    utils.execute_prepared(cur, "debit_balance", (amount, account_id_from, amount))
+    debited = cur.fetchone()
+    if not debited:
+        return "Insufficient funds or account closed"
+
+    utils.execute_prepared(cur, "credit_balance", (amount_received, account_id_to))
+    credited = cur.fetchone()
+    if not credited:
+        return "Target account is closed"
+
+    # The quote row records both legs' tx_ids
+    utils.execute_prepared(cur, "insert_transaction",
+                           (created_on, debit_tx_id, utils.TX_TYPES["Conversion"], from_user_id, account_id_from,
+                            None, None, amount, debited[1]))
+    utils.execute_prepared(cur, "insert_transaction",
+                           (created_on, credit_tx_id, utils.TX_TYPES["Conversion"], None, None, to_user_id, account_id_to,
+                            amount_received, credited[1]))
+
+    from_symbol = utils.format_currency(amount, from_currency)
+    to_symbol = utils.format_currency(amount_received, to_currency)
+    return f"Successfully exchanged {from_symbol} to {to_symbol} complete"
+
+
+@metrics.instrument("quote_exchange")
+def quote_exchange(account_id_from, account_id_to, to_user_id, from_user_id, amount, ttl_seconds=FX_QUOTE_TTL_SECONDS):
+    '''
+    Quotes a currency exchange at a locked rate
+
+    Args:
+        account_id_from: Sender's account
+        account_id_to: Recipient's account
+        to_user_id: Recipient's ID
+        from_user_id: Sender's ID
+        amount: Amount exchanged, in integer minor units of the sender's currency
+        ttl_seconds: Seconds the quote can be executed for
+
+    Returns:
+        Dictionary with quote_id, currencies, amount, amount_received, rate and expires_at,
+        or a string saying why the exchange can't be quoted
+    '''
+    if utils.validate_amount(amount) is not True:
+        return "Amount Not valid"
+    conn = None
+
+    try:
+        conn = utils.connect_to_db()
+        with conn.cursor() as cur:
+            quote = _create_quote(cur, account_id_from, account_id_to, to_user_id, from_user_id, amount, ttl_seconds)
+
+        conn.commit()
+        if isinstance(quote, dict):
+            logger.info("Exchange quoted")
+        return quote
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Unable to quote exchange: {e}")
+        raise
+    finally:
+        utils.release_conn(conn)
+
+
+@metrics.instrument("execute_quote")
+def execute_quote(quote_id, from_user_id):
+    '''
+    Executes a quoted exchange at its locked rate. Posts both legs in one transaction
+
+    Args:
+        quote_id: Id returned by quote_exchange
+        from_user_id: Sender's ID. Must be the user the quote was made for
+
+    Returns:
+        Success or failure string
+    '''
+    conn = None
+
+    try:
+        conn = utils.connect_to_db()
+        with conn.cursor() as cur:
+            message = _execute_quote(cur, quote_id, from_user_id)
+
+        if message.startswith("Successfully"):
+            conn.commit()
+            logger.info("Exchange successful")
+        else:
+            conn.rollback()
+        return message
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Exchange failed: {e}")
+        raise
+    finally:
+        utils.release_conn(conn)
+
+
+@metrics.instrument("currency_exchange")
 def currency_exchange(account_id_from, account_id_to, to_user_id, from_user_id, amount):
     '''
     Converts from one currency to another and transfers to the user_given account
 
+    Quotes and executes in one transaction on one connection, at the rate
+    of the current snapshot.
+
     Args:
         account_id_from: Sender's account
         account_id_to: Recipient's account
         to_user_id: Recipient's ID
         from_user_id: Sender's ID
-        amount: Amount exchanged
+        amount: Amount exchanged, in integer minor units of the sender's currency
     
     Returns:
         Formatted string with amount received and symbol
 
     '''
-    conn = utils.connect_to_db()
-
-    created_on = datetime.datetime.now()
-    tx_type = "Conversion"
-    tx_id = str(uuid.uuid4()) + str(int(time.time()) * 1000)
+    if utils.validate_amount(amount) is not True:
+        return "Amount Not valid"
+    conn = None
 
     try:
+        conn = utils.connect_to_db()
         with conn.cursor() as cur:
-            cur.execute("SELECT balance, currency_code, is_active FROM Accounts WHERE account_id = %s AND user_id = %s", (account_id_from, from_user_id))
-            from_rows = cur.fetchone()
+            quote = _create_quote(cur, account_id_from, account_id_to, to_user_id, from_user_id, amount,
+                                  FX_QUOTE_TTL_SECONDS)
+            if not isinstance(quote, dict):
+                conn.rollback()
+                return quote
 
-            cur.execute("SELECT balance, currency_code, is_active FROM Accounts WHERE user_id = %s AND account_id = %s", (to_user_id, account_id_to))
-            to_rows = cur.fetchone()
+            message = _execute_quote(cur, quote["quote_id"], from_user_id)
+
+        if message.startswith("Successfully"):
+            conn.commit()
+            logger.info("Exchange successful")
+        else:
+            conn.rollback()
+        return message
     except Exception as e:
-        logger.error(f"Error fetching details from Database: {e}")
+        if conn:
+            conn.rollback()
+        logger.error(f"Exchange failed: {e}")
         raise
     finally:
-        cur.close()
         utils.release_conn(conn)
 
-    to_currency = to_rows[1]
-    from_currency = from_rows[1]
 
-    from_balance = from_rows[0]
-    to_balance = to_rows[0]
-
-    from_is_active = from_rows[2]
-    to_is_active = to_rows[2]
+@metrics.instrument("submit_exchange_order")
+def submit_exchange_order(account_id_from, account_id_to, to_user_id, from_user_id, amount):
+    '''
+    Queues a currency exchange for the next FX netting batch (see fxnetting.py)
 
-    if to_currency == from_currency:
-        return "Currencies must be different to be converted. Try Transfer instead"
-    else:
-        result, message = convert_currency(amount, to_currency, from_currency)
-        from_symbol = utils.format_currency(amount, from_currency)
-        to_symbol = utils.format_currency(result, to_currency)
+    Args:
+        account_id_from: Sender's account
+        account_id_to: Recipient's account
+        to_user_id: Recipient's ID
+        from_user_id: Sender's ID
+        amount: Amount exchanged, in integer minor units of the sender's currency
 
-        from_new_balance = from_balance - amount
-        to_new_balance = to_balance + result
+    Returns:
+        The order_id, or a string saying why the order can't be placed
+    '''
+    if utils.validate_amount(amount) is not True:
+        return "Amount Not valid"
+    conn = None
 
-    if from_is_active:
-        if to_is_active:
-            try:
-                conn = utils.connect_to_db()
-                with conn.cursor() as cur:
-                    cur.execute("UPDATE Accounts SET balance = %s WHERE account_id = %s", (from_new_balance, account_id_from))
+    try:
+        conn = utils.connect_to_db()
+        with conn.cursor() as cur:
+            # Inserts nothing unless both accounts belong to the given users and differ in currency
+            cur.execute("INSERT INTO FxOrders (user_id, from_account_id, to_user_id, to_account_id, " \
+                        "from_currency, to_currency, amount) " \
+                        "SELECT f.user_id, f.account_id, t.user_id, t.account_id, f.currency_code, t.currency_code, %s " \
+                        "FROM AccountDetails f, AccountDetails t " \
+                        "WHERE f.account_id = %s AND f.user_id = %s AND t.account_id = %s AND t.user_id = %s " \
+                        "AND f.currency_code <> t.currency_code AND f.is_active AND t.is_active " \
+                        "RETURNING order_id",
+                        (amount, account_id_from, from_user_id, account_id_to, to_user_id))
+            rows = cur.fetchone()
 
-                    cur.execute("UPDATE Accounts SET balance = %s WHERE account_id = %s AND user_id = %s", 
-                                (to_new_balance, account_id_to, to_user_id))
+        conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Unable to place exchange order: {e}")
+        raise
+    finally:
+        utils.release_conn(conn)
 
-                    cur.execute("INSERT INTO Transactions (tx_time, tx_id, type, from_user_id, from_account_id, to_user_id, to_account_id, amount, currency_code)" \
-                                "Values(%s, %s, %s, %s, %s, %s, %s, %s, %s)", (created_on, tx_id, tx_type, from_user_id, account_id_from, None, None, amount, from_currency))
-        
-                    cur.execute("INSERT INTO Transactions (tx_time, tx_id, type, from_user_id, from_account_id, to_user_id, to_account_id, amount, currency_code)" \
-                                "Values(%s, %s, %s, %s, %s, %s, %s, %s, %s)", (created_on, tx_id, tx_type, None, None, to_user_id, account_id_to, amount, to_currency))
-        
-                    conn.commit()
+    if not rows:
+        return "Accounts must exist, be open and hold different currencies"
 
-                    logger.info("Exchange successful")
-                    return f"Successfully exchanged {from_symbol} to {to_symbol} complete"
-            except Exception as e:
-                if conn:
-                    conn.rollback()
-                logger.error(f"Exchange failed: {e}")
-                raise 
-            finally:
-                cur.close()
-                utils.release_conn(conn)
-        else:
-            return "Target account is closed"
-    else:
-        return "YOur account is closed"
+    logger.info("Exchange order placed")
+    return rows[0]
 
 
 # Analytics and Reporting 
+@metrics.instrument("get_account_balance_history")
 def get_account_balance_history(account_id, user_id, period):
     '''
     
@@ -916,7 +1329,7 @@ def get_account_balance_history(account_id, user_id, period):
 
     # Fetch transactions for account
     try:
-        conn = utils.connect_to_db()
+        conn = utils.connect_to_db(read_only=True)
         with conn.cursor() as cur:
             cur.execute("SELECT * FROM Transactions WHERE (to_account_id = %s OR from_account_id = %s)" \
                         " AND (from_user_id = %s OR to_user_id = %s)", (account_id, account_id, user_id, user_id))
@@ -942,7 +1355,7 @@ def get_account_balance_history(account_id, user_id, period):
         current_day = datetime.date.today()
         result = {}
         result[current_day] = balance
-        conn = utils.connect_to_db()
+        conn = utils.connect_to_db(read_only=True)
 
         # Loop for monthly analysis
         if period == 'monthly':
@@ -955,12 +1368,12 @@ def get_account_balance_history(account_id, user_id, period):
                     
                     with conn.cursor() as cur:
                         cur.execute("""WITH deposits AS (
-                                    SELECT COALESCE(SUM(amount),0) AS amount_dep FROM Transactions 
+                                    SELECT COALESCE(SUM(amount),0)::bigint AS amount_dep FROM Transactions 
                                     WHERE to_account_id = %s AND to_user_id = %s 
                                     AND (tx_time::date) >= %s AND (tx_time::date) <= %s),
                                 
                                     withdrawals AS ( 
-                                    SELECT COALESCE(SUM(amount),0) as amt_with FROM Transactions 
+                                    SELECT COALESCE(SUM(amount),0)::bigint as amt_with FROM Transactions 
                                     WHERE from_account_id = %s AND from_user_id = %s 
                                     AND (tx_time::date) >= %s AND (tx_time::date) <= %s) 
                             
@@ -999,12 +1412,12 @@ def get_account_balance_history(account_id, user_id, period):
                 
                 with conn.cursor() as cur:
                     cur.execute("""WITH deposits AS (
-                                SELECT COALESCE(SUM(amount),0) AS amount_dep FROM Transactions 
+                                SELECT COALESCE(SUM(amount),0)::bigint AS amount_dep FROM Transactions 
                                 WHERE to_account_id = %s AND to_user_id = %s 
                                 AND (tx_time::date) >= %s AND (tx_time::date) <= %s),
                                     
                                 withdrawals AS ( 
-                                SELECT COALESCE(SUM(amount),0) as amt_with FROM Transactions 
+                                SELECT COALESCE(SUM(amount),0)::bigint as amt_with FROM Transactions 
                                 WHERE from_account_id = %s AND from_user_id = %s 
                                 AND (tx_time::date) >= %s AND (tx_time::date) <= %s) 
                             
@@ -1041,12 +1454,12 @@ def get_account_balance_history(account_id, user_id, period):
             try:
                 with conn.cursor() as cur:
                     cur.execute("""WITH deposits AS (
-                                SELECT COALESCE(SUM(amount),0) AS amount_dep FROM Transactions 
+                                SELECT COALESCE(SUM(amount),0)::bigint AS amount_dep FROM Transactions 
                                 WHERE to_account_id = %s AND to_user_id = %s 
                                 AND (tx_time::date) >= %s AND (tx_time::date) <= %s),
                                 
                                 withdrawals AS ( 
-                                SELECT COALESCE(SUM(amount),0) as amt_with FROM Transactions 
+                                SELECT COALESCE(SUM(amount),0)::bigint as amt_with FROM Transactions 
                                 WHERE from_account_id = %s AND from_user_id = %s 
                                 AND (tx_time::date) >= %s AND (tx_time::date) <= %s) 
                                 
@@ -1073,7 +1486,8 @@ def get_account_balance_history(account_id, user_id, period):
         sorted_result = dict(sorted(result.items()))
         return sorted_result
 
-def get_spending_history(account_id, user_id, start_date, end_date):
+@metrics.instrument("get_spending_history")
+def get_spending_history(account_id, user_id, start_date, end_date, snapshot=None):
     '''
     Gets the spending history of selected account
 
@@ -1082,48 +1496,147 @@ def get_spending_history(account_id, user_id, start_date, end_date):
         user_id: Owner of the account
         start_date: Date to begin calculations on
         end_date: Date to end calculations on
+        snapshot: analytics.Snapshot to read instead of the database, when it holds user_id
     
     Returns:
         A list of dictionaries containing Date and amount
     '''
+    if snapshot is not None and snapshot.covers(user_id):
+        return snapshot.spending_history(account_id, user_id, start_date, end_date)
     
-    conn = utils.connect_to_db()
+    conn = utils.connect_to_db(read_only=True)
 
     result = []
-    has_transactions = False
     
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM Transactions WHERE from_account_id = %s AND from_user_id = %s " \
-                        "AND (tx_time::date) >= %s AND (tx_time::date) <= %s", (account_id, user_id, start_date, end_date))
+            cur.execute("SELECT (tx_time::date) as Day, COALESCE(SUM(amount),0)::bigint FROM Transactions " \
+                        "WHERE from_account_id = %s AND from_user_id = %s " \
+                        "AND tx_time >= %s::date AND tx_time < %s::date + 1 " \
+                        "GROUP BY 1 ORDER BY 1 ASC", (account_id, user_id, start_date, end_date))
             rows = cur.fetchall()
 
-            if rows:
-                has_transactions = True
-        if has_transactions:
-            with conn.cursor() as cur:
-                cur.execute("SELECT (tx_time::date) as Day, COALESCE(SUM(amount),0) FROM Transactions " \
-                            "WHERE from_account_id = %s AND from_user_id = %s " \
-                            "AND (tx_time::date) >= %s AND (tx_time::date) <= %s " \
-                            "GROUP BY 1 ORDER BY 1 ASC", (account_id, user_id, start_date, end_date))
-                rows = cur.fetchall()
-
-            if rows:
-                for row in rows:
-                    result.append({
-                        "Date": row[0],
-                        "Amount": row[1]
-                    })                
+        if rows:
+            for row in rows:
+                result.append({
+                    "Date": row[0],
+                    "Amount": row[1]
+                })                
         else:
             return "No transactions yet"
 
     except Exception as e:
         raise e
     finally:
-        conn.close()
+        utils.release_conn(conn)
 
     return result
 
+
+# Resampling rules for spending analytics. Weeks start on Monday
+SPENDING_PERIODS = {
+    "daily": "D",
+    "weekly": "W-MON",
+    "monthly": "MS",
+}
+
+@metrics.instrument("get_spending_frame")
+def get_spending_frame(user_id, start_date, end_date, snapshot=None):
+    '''
+    Gets daily spending of all of a user's accounts in one query
+
+    The database pre-aggregates per day and account and returns each column
+    as one array, so the result loads into a DataFrame without building a
+    Python object per row.
+
+    Args:
+        user_id: Owner of the accounts
+        start_date: Date to begin calculations on
+        end_date: Date to end calculations on (inclusive)
+        snapshot: analytics.Snapshot to read instead of the database, when it holds user_id
+
+    Returns:
+        DataFrame with columns date, account_id, currency_code, amount
+        (minor units) and transactions. Empty if there was no spending
+    '''
+    if snapshot is not None and snapshot.covers(user_id):
+        return snapshot.spending_frame(user_id, start_date, end_date)
+
+    conn = None
+
+    try:
+        conn = utils.connect_to_db(read_only=True)
+        with conn.cursor() as cur:
+            cur.execute("""SELECT array_agg(day ORDER BY day, account_id),
+                                  array_agg(account_id ORDER BY day, account_id),
+                                  array_agg(currency_code ORDER BY day, account_id),
+                                  array_agg(amount ORDER BY day, account_id),
+                                  array_agg(transactions ORDER BY day, account_id)
+                        FROM (
+                            SELECT tx_time::date AS day, from_account_id AS account_id, currency_code,
+                                   SUM(amount)::bigint AS amount, COUNT(*) AS transactions
+                            FROM Transactions JOIN Currencies USING (currency_id)
+                            WHERE from_user_id = %s AND from_account_id IS NOT NULL
+                            AND tx_time >= %s::date AND tx_time < %s::date + 1
+                            GROUP BY 1, 2, 3) daily""",
+                        (user_id, start_date, end_date))
+            days, account_ids, codes, amounts, counts = cur.fetchone()
+
+            logger.info("Fetched spending columns")
+    except Exception as e:
+        logger.error(f"Failed to fetch spending: {e}")
+        raise
+    finally:
+        utils.release_conn(conn)
+
+    return pd.DataFrame({
+        "date": pd.to_datetime(pd.Series(days or [], dtype="object")),
+        "account_id": pd.Series(account_ids or [], dtype="int64"),
+        "currency_code": pd.Series(codes or [], dtype="object"),
+        "amount": pd.Series(amounts or [], dtype="int64"),
+        "transactions": pd.Series(counts or [], dtype="int64"),
+    })
+
+
+def resample_spending(frame, period="daily"):
+    '''
+    Resamples the output of get_spending_frame. Runs in memory only.
+
+    Args:
+        frame: DataFrame from get_spending_frame
+        period: daily, weekly or monthly
+
+    Returns:
+        DataFrame indexed by period start with one column of spending per
+        currency, in minor units. Periods without spending are 0
+    '''
+    rule = SPENDING_PERIODS.get(period)
+    if rule is None:
+        raise ValueError(f"Period must be one of {', '.join(SPENDING_PERIODS)}")
+
+    if frame.empty:
+        return pd.DataFrame()
+
+    pivot = frame.pivot_table(index="date", columns="currency_code", values="amount",
+                              aggfunc="sum", fill_value=0)
+    return pivot.resample(rule, label="left", closed="left").sum()
+
+
+def spending_totals(frame):
+    '''
+    Totals the output of get_spending_frame per account
+
+    Args:
+        frame: DataFrame from get_spending_frame
+
+    Returns:
+        DataFrame indexed by account_id with currency_code, amount
+        (minor units) and transactions
+    '''
+    return frame.groupby(["account_id", "currency_code"], as_index=False)[["amount", "transactions"]] \
+                .sum().set_index("account_id")
+
+@metrics.instrument("generate_account_statement")
 def generate_account_statement(account_id, user_id, start_date, end_date):
     '''
     Displays all transactions occurring within given time
@@ -1140,25 +1653,38 @@ def generate_account_statement(account_id, user_id, start_date, end_date):
     conn = None
 
     try:
-        conn = utils.connect_to_db()
+        conn = utils.connect_to_db(read_only=True)
         with conn.cursor() as cur:
+            # The opening balance below reads the account's transactions whoever owns it
+            cur.execute("SELECT 1 FROM Accounts WHERE account_id = %s AND user_id = %s", (account_id, user_id))
+            if not cur.fetchone():
+                utils.release_conn(conn)
+                return "Account not found"
+
             cur.execute("WITH net_tx AS (" \
-                        "SELECT SUM(amount) AS amount FROM Transactions " \
+                        "SELECT SUM(amount)::bigint AS amount FROM Transactions " \
                         "WHERE to_account_id = %s AND (tx_time::date) <= %s " \
                         "UNION ALL " \
-                        "SELECT SUM(-1 * (amount)) AS amount FROM Transactions " \
+                        "SELECT SUM(-1 * (amount))::bigint AS amount FROM Transactions " \
                         "WHERE from_account_id = %s AND (tx_time::date) <= %s)" \
                         " " \
-                        "SELECT SUM(amount) FROM net_tx", (account_id, start_date, account_id, start_date))
+                        "SELECT SUM(amount)::bigint FROM net_tx", (account_id, start_date, account_id, start_date))
+            rows = cur.fetchone()
+
+            # Months moved out of Transactions by archive.py
+            archived = archive.account_rows(cur, account_id, None, end_date + datetime.timedelta(days=1))
+            opening_end = datetime.datetime.combine(start_date + datetime.timedelta(days=1), datetime.time())
+            archived_net = sum(row[7] if row[6] == account_id else -row[7]
+                               for row in archived if row[0] < opening_end)
+            if archived_net:
+                rows = ((rows[0] or 0) + archived_net,)
         
-        rows = cur.fetchone()
         has_transactions = False
     except Exception as e:
+        # The connection is kept for the period query below only when this succeeds
+        utils.release_conn(conn)
         logger.error(f"Failed to check transactions: {e}")
         raise
-    finally:
-        cur.close
-        
 
     if rows:
         has_transactions = True
@@ -1179,30 +1705,36 @@ def generate_account_statement(account_id, user_id, start_date, end_date):
         try:
             with conn.cursor() as cur:
                 cur.execute("""WITH total_tx AS (
-                            SELECT tx_time, type, from_user_id, from_account_id, to_user_id, to_account_id, COALESCE(SUM(amount),0) AS amount 
+                            SELECT tx_time, type_id, from_user_id, from_account_id, to_user_id, to_account_id, COALESCE(SUM(amount),0)::bigint AS amount 
                             FROM Transactions 
                             WHERE to_account_id = %s AND to_user_id = %s 
                             AND (tx_time::date) >= %s AND (tx_time::date) <=%s
                             GROUP BY 1,2,3,4,5,6 
                             UNION ALL 
-                            SELECT tx_time, type, from_user_id, from_account_id, to_user_id, to_account_id, COALESCE(SUM(-1 *(amount)), 0) AS amount 
+                            SELECT tx_time, type_id, from_user_id, from_account_id, to_user_id, to_account_id, COALESCE(SUM(-1 *(amount)), 0)::bigint AS amount 
                             FROM Transactions 
                             WHERE from_account_id = %s AND from_user_id = %s 
                             AND (tx_time::date) >= %s AND (tx_time::date) <= %s
                             GROUP BY 1,2,3,4,5,6) 
                                 
-                            SELECT tx_time, type, from_user_id, from_account_id, to_user_id, to_account_id, SUM(amount) as amount 
+                            SELECT tx_time, type_id, from_user_id, from_account_id, to_user_id, to_account_id, SUM(amount)::bigint as amount 
                             FROM total_tx 
                             GROUP BY 1,2,3,4,5,6 ORDER BY 1 ASC""", 
                             (account_id, user_id, start_date, end_date, account_id, user_id, start_date, end_date))
                     
                 tx_rows = cur.fetchall()
+
+            period_start = datetime.datetime.combine(start_date, datetime.time())
+            tx_rows += [(row[0], *row[2:7], row[7] if row[6] == account_id else -row[7])
+                        for row in archived if row[0] >= period_start
+                        and user_id == (row[5] if row[6] == account_id else row[3])]
+            tx_rows.sort(key=lambda row: row[0])
                 
             if tx_rows:
                 for row in tx_rows:                    
                     result.append({
                         "Date": row[0],
-                        "Type": row[1],
+                        "Type": utils.TX_TYPE_NAMES.get(row[1], row[1]),
                         "From": row[2],
                         "From Account": row[3],
                         "To": row[4],
@@ -1210,16 +1742,16 @@ def generate_account_statement(account_id, user_id, start_date, end_date):
                         "Amount": (-1*row[6]) if row[4] is None else row[6],
                         "Balance": ((opening_balance + row[6]) if opening_balance is not None else (0 + row[6]))
                     })
-                logger.info("Result successfully gotten")
-                return result
+            logger.info("Result successfully gotten")
+            return result
         except Exception as e:
             logger.error(f"Failed to fetch results: {e}")
             raise
         finally:
-            cur.close
             utils.release_conn(conn)
     
     else:
+        utils.release_conn(conn)
         return "No transactions yet"
     
 
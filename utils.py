@@ -1,64 +1,662 @@
+import psycopg2.extensions
+import logging.handlers
 import psycopg2.pool
+import collections
+import threading
+import datetime
 import hashlib
 import logging
 import psycopg2
+import metrics
+import atexit
+import random
+import queue
+import json
+import time
+import uuid
+import re
 from dotenv import load_dotenv
 import os
 
+load_dotenv()
+
+'''
+Logging
+
+Records are put on a bounded in-memory queue by the calling thread and
+written as JSON lines to banking_system.log by a background listener, so
+disk latency stays off the request path.
+'''
+log_listener = None
+
+# Attributes every LogRecord has. Anything else was passed through extra= and is logged as a field
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    '''Formats records as one JSON object per line'''
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Keeps only a share of the INFO and DEBUG records of chosen loggers.
+
+    Warnings and errors are always kept.
+    '''
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+
+        rate = self.rates.get(record.name)
+        if rate is None:
+            return True
+        return random.random() < rate
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Queue handler that doesn't block the caller on INFO and below.
+
+    Those records are dropped and counted when the queue is full. Errors
+    wait up to error_timeout seconds for room and are written straight to
+    stderr if there still is none, so they are never lost. Formatting is
+    left to the listener thread.
+    '''
+
+    def __init__(self, log_queue, error_timeout=1.0):
+        super().__init__(log_queue)
+        self.error_timeout = error_timeout
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Resolve the message now since args may change after the call returns
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if record.levelno >= logging.ERROR:
+                self.queue.put(record, timeout=self.error_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.ERROR:
+                logging.lastResort.handle(record)
+            else:
+                self.dropped += 1
+
+
+class _LogListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room on shutdown so queued records are flushed, not lost
+        self.queue.put(self._sentinel)
+
+
+def parse_sample_rates(value):
+    '''
+    Parses LOG_SAMPLE_RATES
+
+    Args:
+        value: String like "banking_users=0.1,banking_cli=0.5"
+
+    Returns:
+        Dictionary of logger name to the share of INFO records kept
+    '''
+    rates = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, rate = item.split("=", 1)
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(filename=None, level=logging.INFO, sample_rates=None, queue_size=10000):
+    '''
+    Starts the queue-based JSON log pipeline. Safe to call more than once.
+
+    Args:
+        filename: Log file. Defaults to the LOG_FILE env variable or banking_system.log
+        level: Minimum level logged
+        sample_rates: Dictionary of logger name to the share of INFO records kept.
+            Defaults to the LOG_SAMPLE_RATES env variable
+        queue_size: Records buffered before new INFO and DEBUG records are dropped
+
+    Returns:
+        The running QueueListener
+    '''
+    global log_listener
+
+    if log_listener:
+        return log_listener
+
+    filename = filename or os.getenv("LOG_FILE", "banking_system.log")
+    if sample_rates is None:
+        sample_rates = parse_sample_rates(os.getenv("LOG_SAMPLE_RATES"))
+
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(JsonFormatter())
+
+    handler = AsyncQueueHandler(queue.Queue(queue_size))
+    handler.addFilter(SamplingFilter(sample_rates))
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='banking_system.log'
-)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+
+    log_listener = _LogListener(handler.queue, file_handler)
+    log_listener.start()
+    atexit.register(stop_logging)
+
+    return log_listener
+
+
+def dropped_log_records():
+    '''Records dropped by the log queue in this process because it was full'''
+    return sum(handler.dropped for handler in logging.getLogger().handlers if isinstance(handler, AsyncQueueHandler))
+
+
+def _restart_logging_in_child():
+    '''Forked worker processes don't inherit the listener thread, so they start their own'''
+    global log_listener
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, AsyncQueueHandler):
+            root.removeHandler(handler)
+
+    log_listener = None
+    setup_logging()
+
+
+def stop_logging():
+    '''Flushes the queued records and stops the listener'''
+    global log_listener
+
+    if log_listener:
+        log_listener.stop()
+        log_listener = None
+
+
+setup_logging()
+os.register_at_fork(after_in_child=_restart_logging_in_child)
+metrics.register_gauge("bank_log_dropped_records", "INFO and DEBUG records dropped because the log queue was full",
+                       dropped_log_records)
 logger = logging.getLogger('banking_utils')
 '''
 Database functions
 
 '''
-load_dotenv()
 connection_pool = None
 
-def init_connection_pool(min_conn=1, max_conn=10):
-    '''Initialize the database connection pool'''
+
+# Statements slower than this are logged, in milliseconds
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+
+# Share of slow read statements that also get an EXPLAIN (ANALYZE, BUFFERS) plan
+EXPLAIN_SAMPLE_RATE = float(os.getenv("EXPLAIN_SAMPLE_RATE", "0"))
+
+sql_logger = logging.getLogger('banking_sql')
+slow_queries = collections.deque(maxlen=100)
+
+
+def normalize_sql(query):
+    '''
+    Collapses a statement to one line with its literals replaced by ?
+
+    Args:
+        query: SQL string or bytes
+
+    Returns:
+        Normalized SQL string. Statements that differ only by literal
+        values normalize to the same string
+    '''
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+
+    query = re.sub(r"'(?:[^']|'')*'", "?", query)
+    query = re.sub(r"\b\d+(\.\d+)?\b", "?", query)
+    return re.sub(r"\s+", " ", query).strip()
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    '''
+    Cursor that times every statement and reports round trips and
+    fetched rows to metrics.
+
+    Statements over SLOW_QUERY_MS are logged to banking_sql with their
+    normalized SQL and parameters. A sample of the slow read statements is
+    re-run under EXPLAIN (ANALYZE, BUFFERS) and the plan is logged too.
+    '''
+
+    def execute(self, query, vars=None):
+        metrics.record_round_trip()
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        self._check_slow(query, vars, time.perf_counter() - started)
+        return result
+
+    def executemany(self, query, vars_list):
+        metrics.record_round_trip()
+        started = time.perf_counter()
+        result = super().executemany(query, vars_list)
+        self._check_slow(query, None, time.perf_counter() - started, explain=False)
+        return result
+
+    def copy_expert(self, sql, file, size=8192):
+        metrics.record_round_trip()
+        started = time.perf_counter()
+        result = super().copy_expert(sql, file, size)
+        self._check_slow(sql, None, time.perf_counter() - started, explain=False)
+        return result
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            metrics.record_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        metrics.record_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        metrics.record_rows(len(rows))
+        return rows
+
+    def _check_slow(self, query, vars, seconds, explain=True):
+        elapsed_ms = seconds * 1000
+        if elapsed_ms < SLOW_QUERY_MS:
+            return
+
+        statement = normalize_sql(query)
+        plan = None
+
+        if explain and EXPLAIN_SAMPLE_RATE and random.random() < EXPLAIN_SAMPLE_RATE:
+            plan = self._explain(query, vars, statement)
+
+        params = redact_params(vars)
+        slow_queries.append({
+            "time": datetime.datetime.now(),
+            "duration_ms": round(elapsed_ms, 2),
+            "sql": statement,
+            "params": params,
+            "plan": plan,
+        })
+        sql_logger.warning(f"Slow query ({elapsed_ms:.1f} ms): {statement} params={params!r}")
+
+        if plan:
+            seq_scans = [line.strip() for line in plan.splitlines() if "Seq Scan" in line]
+            if seq_scans:
+                sql_logger.warning(f"Sequential scans in slow query: {seq_scans}")
+            sql_logger.info(f"Plan for slow query:\n{plan}")
+
+    def _explain(self, query, vars, statement):
+        '''Gets the EXPLAIN (ANALYZE, BUFFERS) plan of a read statement'''
+        # ANALYZE executes the statement again so only reads are safe to explain
+        if not re.match(r"^(select|with)\b", statement, re.I) or \
+                re.search(r"\b(insert|update|delete)\b", statement, re.I):
+            return None
+
+        if self.connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            return None
+
+        # A savepoint keeps a failed EXPLAIN from aborting the caller's transaction
+        in_transaction = not self.connection.autocommit
+
+        with self.connection.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            try:
+                if in_transaction:
+                    cur.execute("SAVEPOINT explain_slow_query")
+                cur.execute(b"EXPLAIN (ANALYZE, BUFFERS) " + self._as_bytes(query), vars)
+                # Plans quote the interpolated parameters in their filters
+                plan = re.sub(r"'(?:[^']|'')*'", "'?'", "\n".join(row[0] for row in cur.fetchall()))
+                if in_transaction:
+                    cur.execute("RELEASE SAVEPOINT explain_slow_query")
+                return plan
+            except Exception as e:
+                if in_transaction:
+                    cur.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+                sql_logger.error(f"Unable to explain slow query: {e}")
+                return None
+
+    def _as_bytes(self, query):
+        return query if isinstance(query, bytes) else query.encode()
+
+
+def redact_params(vars):
+    '''
+    Replaces statement parameters with their type names
+
+    Parameters hold password hashes, emails and balances, so only their
+    shape is logged.
+
+    Args:
+        vars: Parameters passed to execute, a sequence, a dictionary or None
+
+    Returns:
+        The parameters with each value replaced by its type name
+    '''
+    if vars is None:
+        return None
+    if isinstance(vars, dict):
+        return {name: type(value).__name__ for name, value in vars.items()}
+    return [type(value).__name__ for value in vars]
+
+
+def get_slow_queries():
+    '''
+    Gets the most recent slow statements
+
+    Returns:
+        List of dictionaries with time, duration_ms, sql, params (type names
+        only) and plan
+    '''
+    return list(slow_queries)
+
+
+# Set PREPARE_STATEMENTS=0 behind a transaction-mode pooler like PgBouncer,
+# where server-side prepared statements don't survive between transactions
+USE_PREPARED = os.getenv("PREPARE_STATEMENTS", "1") != "0"
+
+# Hot statements prepared server-side on first use. Written with %s placeholders
+# so they can also run unprepared
+PREPARED_STATEMENTS = {
+    "account_by_id": "SELECT a.balance, c.currency_code, a.is_active, a.currency_id FROM Accounts a JOIN Currencies c USING (currency_id) "
+                     "WHERE a.account_id = %s AND a.user_id = %s",
+    "debit_balance": "UPDATE Accounts SET balance = balance - %s "
+                     "WHERE account_id = %s AND is_active AND balance >= %s RETURNING balance, currency_id",
+    "credit_balance": "UPDATE Accounts SET balance = balance + %s WHERE account_id = %s AND is_active "
+                      "RETURNING balance, currency_id",
+    "insert_transaction": "INSERT INTO Transactions (tx_time, tx_id, type_id, from_user_id, from_account_id, "
+                          "to_user_id, to_account_id, amount, currency_id) "
+                          "Values(%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+}
+
+
+class BankConnection(psycopg2.extensions.connection):
+    '''Connection that remembers which statements are prepared on its session'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.replica = False
+
+    def close(self):
+        self.prepared.clear()
+        super().close()
+
+
+def _to_positional(sql):
+    '''Turns %s placeholders into $1, $2 ... for PREPARE'''
+    parts = sql.split("%s")
+    return "".join(part + (f"${i + 1}" if i < len(parts) - 1 else "") for i, part in enumerate(parts))
+
+
+def execute_prepared(cur, name, params):
+    '''
+    Executes one of PREPARED_STATEMENTS, preparing it on the connection first if needed
+
+    Args:
+        cur: Cursor to execute on
+        name: Key in PREPARED_STATEMENTS
+        params: Tuple of parameters
+
+    Returns:
+        None. Fetch results from the cursor as usual
+    '''
+    conn = cur.connection
+    prepared = getattr(conn, "prepared", None)
+
+    if not USE_PREPARED or prepared is None:
+        cur.execute(PREPARED_STATEMENTS[name], params)
+        return
+
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {_to_positional(PREPARED_STATEMENTS[name])}")
+        prepared.add(name)
+
+    placeholders = ", ".join(["%s"] * len(params))
+    cur.execute(f"EXECUTE {name} ({placeholders})", params)
+
+
+def deallocate_prepared(conn):
+    '''
+    Drops the prepared statements of a connection
+
+    Args:
+        conn: Connection being recycled
+    '''
+    prepared = getattr(conn, "prepared", None)
+    if not prepared:
+        return
+
+    if not conn.closed:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("DEALLOCATE ALL")
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Unable to deallocate prepared statements: {e}")
+    prepared.clear()
+
+
+# Read-only replica for analytics. Set REPLICA_DSN to a libpq connection string
+replica_pool = None
+
+# Reads go to the primary when the replica is further behind than this
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "30"))
+REPLICA_LAG_CHECK_SECONDS = float(os.getenv("REPLICA_LAG_CHECK_SECONDS", "5"))
+replica_lag_checked_at = float("-inf")
+replica_lag_seconds = 0.0
+
+# Connections per pool. The pools are thread-safe, so background threads like the rate refresher share them
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+_pool_lock = threading.Lock()
+
+
+def init_connection_pool(min_conn=DB_POOL_MIN, max_conn=DB_POOL_MAX):
+    '''Initialize the database connection pool, shared by every thread of the process'''
     global connection_pool
 
     try:
-        connection_pool = psycopg2.pool.SimpleConnectionPool(
+        connection_pool = psycopg2.pool.ThreadedConnectionPool(
             min_conn,
             max_conn,
             host = os.getenv("HOST"),
             database = os.getenv("DBNAME"),
             user = os.getenv("USER"),
             password = os.getenv("PASSWORD"),
-            port = os.getenv("PORT")
+            port = os.getenv("PORT"),
+            cursor_factory = InstrumentedCursor,
+            connection_factory = BankConnection
         )
         logger.info("Connection pool created successfully")
     except Exception as e:
         logger.error(f"Error creating connection pool: {e}")
         raise
 
-def connect_to_db():
-    '''Gets a connection from the pool'''
+def open_connection():
+    '''
+    Opens a dedicated connection outside the pool.
+
+    Used by batch jobs and worker processes, which can't share the
+    pool of the parent process.
+    '''
+    try:
+        conn = psycopg2.connect(
+            host = os.getenv("HOST"),
+            database = os.getenv("DBNAME"),
+            user = os.getenv("USER"),
+            password = os.getenv("PASSWORD"),
+            port = os.getenv("PORT"),
+            cursor_factory = InstrumentedCursor,
+            connection_factory = BankConnection
+        )
+        conn.autocommit = False
+        return conn
+    except Exception as e:
+        logger.error(f"Error opening connection: {e}")
+        raise
+
+def init_replica_pool(min_conn=DB_POOL_MIN, max_conn=DB_POOL_MAX):
+    '''Initialize the read-only replica connection pool from REPLICA_DSN'''
+    global replica_pool
+
+    try:
+        replica_pool = psycopg2.pool.ThreadedConnectionPool(
+            min_conn,
+            max_conn,
+            os.getenv("REPLICA_DSN"),
+            cursor_factory = InstrumentedCursor,
+            connection_factory = BankConnection
+        )
+        logger.info("Replica connection pool created successfully")
+    except Exception as e:
+        logger.error(f"Error creating replica connection pool: {e}")
+        raise
+
+
+def replica_lag():
+    '''
+    Gets how far the replica is behind the primary, checking at most
+    once every REPLICA_LAG_CHECK_SECONDS
+
+    Returns:
+        Lag in seconds. 0 when the replica has replayed everything it received
+    '''
+    global replica_lag_checked_at, replica_lag_seconds
+
+    now = time.monotonic()
+    if now - replica_lag_checked_at < REPLICA_LAG_CHECK_SECONDS:
+        return replica_lag_seconds
+
+    conn = replica_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            # An idle primary sends no new WAL, so a fully replayed replica counts as current
+            cur.execute("""SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                               END""")
+            replica_lag_seconds = float(cur.fetchone()[0])
+        conn.rollback()
+    finally:
+        replica_pool.putconn(conn)
+
+    replica_lag_checked_at = now
+    return replica_lag_seconds
+
+
+def _connect_to_replica():
+    '''Gets a replica connection, or None when the replica is missing, down or too stale'''
+    if not os.getenv("REPLICA_DSN"):
+        return None
+
+    try:
+        if replica_pool is None:
+            with _pool_lock:
+                if replica_pool is None:
+                    init_replica_pool()
+
+        lag = replica_lag()
+        if lag > REPLICA_MAX_LAG_SECONDS:
+            logger.warning(f"Replica is {lag:.1f}s behind, reading from primary")
+            return None
+
+        conn = replica_pool.getconn()
+        conn.autocommit = False
+        conn.readonly = True
+        conn.replica = True
+        return conn
+    except Exception as e:
+        logger.error(f"Replica unavailable, reading from primary: {e}")
+        return None
+
+
+def connect_to_db(read_only=False):
+    '''
+    Gets a connection from the pool
+
+    Args:
+        read_only: Read intent. Uses the replica pool when REPLICA_DSN is set
+            and the replica is within REPLICA_MAX_LAG_SECONDS of the primary,
+            otherwise falls back to the primary
+    '''
     global connection_pool
 
+    if read_only:
+        conn = _connect_to_replica()
+        if conn:
+            return conn
+
     # Initialize pool if not already done
     if connection_pool is None:
-        init_connection_pool()
+        with _pool_lock:
+            if connection_pool is None:
+                init_connection_pool()
 
     try:
         conn = connection_pool.getconn()
         conn.autocommit = False
         return conn
+    except psycopg2.pool.PoolError:
+        # Every connection is checked out. Callers like the API server turn this into backpressure
+        logger.warning(f"Connection pool exhausted ({DB_POOL_MAX} connections in use)")
+        raise
     except Exception as e:
         logger.error(f"Error connecting to database: {e}")
         raise
 
-def release_conn(conn):
-    '''Returns a connection to the pool'''
+def release_conn(conn, recycle=False):
+    '''
+    Returns a connection to the pool
+
+    Args:
+        conn: Connection to return
+        recycle: Closes the connection instead of keeping it, e.g after a
+            connection error. Its prepared statements are dropped first
+    '''
     global connection_pool
-    if connection_pool and conn:
-        connection_pool.putconn(conn)
+    if not conn:
+        return
+
+    pool = replica_pool if getattr(conn, "replica", False) else connection_pool
+    if pool:
+        if recycle:
+            deallocate_prepared(conn)
+        pool.putconn(conn, close=recycle)
 
 def create_tables():
     conn = connect_to_db()
@@ -82,37 +680,174 @@ def create_tables():
                     last_login TIMESTAMP
                 );""")
 
+            # Currencies Table. Other tables store the smallint currency_id
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS Currencies (
+                    currency_id SMALLSERIAL PRIMARY KEY,
+                    currency_code varchar(3) NOT NULL UNIQUE,
+                    currency_name varchar(50),
+                    minor_unit SMALLINT NOT NULL DEFAULT 2,
+                    symbol varchar(5),
+                    added_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP);""")
+
+            # Transaction types, see TX_TYPES
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS TransactionTypes (
+                    type_id SMALLINT PRIMARY KEY,
+                    name varchar(20) NOT NULL UNIQUE);""")
+
+            cur.execute("INSERT INTO TransactionTypes (type_id, name) SELECT * FROM unnest(%s::smallint[], %s::varchar[]) " \
+                        "ON CONFLICT DO NOTHING", (list(TX_TYPES.values()), list(TX_TYPES)))
+
             # Accounts Table   
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS Accounts (
                     user_id integer NOT NULL REFERENCES Users(user_id) ON DELETE CASCADE, 
                     account_id SERIAL PRIMARY KEY, 
-                    currency_code varchar(3) NOT NULL REFERENCES Currencies(currency_code), 
-                    balance DECIMAL(15,2) NOT NULL DEFAULT 0.00, 
+                    currency_id SMALLINT NOT NULL REFERENCES Currencies(currency_id), 
+                    balance BIGINT NOT NULL DEFAULT 0, 
                     created_on TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, 
                     is_active BOOLEAN DEFAULT TRUE,
-                    UNIQUE(user_id, currency_code)        
+                    UNIQUE(user_id, currency_id)        
                 );""")
         
+            # UUIDv7 for rows inserted by SQL, see new_tx_id
+            cur.execute("""
+                CREATE OR REPLACE FUNCTION uuid_v7(ts timestamptz DEFAULT clock_timestamp()) RETURNS uuid AS $$
+                    SELECT encode(set_bit(set_bit(overlay(uuid_send(gen_random_uuid())
+                                  PLACING substring(int8send(floor(extract(epoch FROM ts) * 1000)::bigint) FROM 3)
+                                  FROM 1 FOR 6), 52, 1), 53, 1), 'hex')::uuid
+                $$ LANGUAGE SQL VOLATILE;""")
+
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS Transactions (
                     tx_time TIMESTAMP, 
-                    tx_id varchar(50),
-                    type varchar(50), 
+                    tx_id uuid PRIMARY KEY DEFAULT uuid_v7(),
+                    type_id SMALLINT NOT NULL REFERENCES TransactionTypes(type_id), 
                     from_user_id integer REFERENCES Users(user_id),
                     from_account_id integer REFERENCES Accounts(account_id), 
                     to_user_id integer REFERENCES Users(user_id), 
                     to_account_id integer REFERENCES Accounts(account_id),
-                    amount DECIMAL(15, 2) NOT NULL, 
-                    currency_code varchar(3) REFERENCES Currencies(currency_code)
+                    amount BIGINT NOT NULL, 
+                    currency_id SMALLINT REFERENCES Currencies(currency_id)
                 );""")
-        
-            # Currencies Table
+
+            # Databases from before currency_id get their views from migrate_to_smallint_codes
+            cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'accounts' AND column_name = 'currency_id'")
+            if cur.fetchone():
+                _create_views(cur)
+            else:
+                logger.warning("Accounts still has currency_code. Run migrate_to_smallint_codes")
+
+            # Chunks already posted by the interest and fee engine
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS Currencies (
-                    currency_code varchar(3),
-                    currency_name varchar(50),
-                    added_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP);""")
+                CREATE TABLE IF NOT EXISTS PostingRuns (
+                    run_date DATE NOT NULL,
+                    kind varchar(20) NOT NULL,
+                    chunk_start integer NOT NULL,
+                    chunk_end integer NOT NULL,
+                    posted integer,
+                    posted_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (run_date, kind, chunk_start)
+                );""")
+
+            # Every fetched snapshot of per-USD rates, fixed-point scaled by RATE_SCALE
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS ExchangeRates (
+                    snapshot_time TIMESTAMP NOT NULL,
+                    currency_code varchar(3) NOT NULL,
+                    rate BIGINT NOT NULL,
+                    PRIMARY KEY (snapshot_time, currency_code)
+                );""")
+
+            # As-of lookups older than the in-memory index read one currency's series
+            cur.execute("CREATE INDEX IF NOT EXISTS exchange_rates_currency_time ON ExchangeRates (currency_code, snapshot_time)")
+
+            # Exchange quotes with their locked rate. executed_at is set once when the quote is used
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS FxQuotes (
+                    quote_id varchar(36) PRIMARY KEY,
+                    user_id integer NOT NULL REFERENCES Users(user_id),
+                    from_account_id integer NOT NULL REFERENCES Accounts(account_id),
+                    to_user_id integer NOT NULL REFERENCES Users(user_id),
+                    to_account_id integer NOT NULL REFERENCES Accounts(account_id),
+                    from_currency varchar(3) NOT NULL,
+                    to_currency varchar(3) NOT NULL,
+                    amount BIGINT NOT NULL,
+                    amount_received BIGINT NOT NULL,
+                    rate BIGINT NOT NULL,
+                    snapshot_time TIMESTAMP,
+                    created_on TIMESTAMP NOT NULL,
+                    expires_at TIMESTAMP NOT NULL,
+                    executed_at TIMESTAMP,
+                    debit_tx_id uuid,
+                    credit_tx_id uuid
+                );""")
+
+            # Exchange orders waiting for the FX netting engine
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS FxOrders (
+                    order_id SERIAL PRIMARY KEY,
+                    user_id integer NOT NULL REFERENCES Users(user_id),
+                    from_account_id integer NOT NULL REFERENCES Accounts(account_id),
+                    to_user_id integer NOT NULL REFERENCES Users(user_id),
+                    to_account_id integer NOT NULL REFERENCES Accounts(account_id),
+                    from_currency varchar(3) NOT NULL,
+                    to_currency varchar(3) NOT NULL,
+                    amount BIGINT NOT NULL,
+                    status varchar(10) NOT NULL DEFAULT 'pending',
+                    created_on TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    batch_id integer,
+                    rate BIGINT,
+                    amount_received BIGINT,
+                    filled_at TIMESTAMP
+                );""")
+
+            cur.execute("CREATE INDEX IF NOT EXISTS fxorders_pending_idx ON FxOrders (order_id) WHERE status = 'pending'")
+
+            # Results of deposits, withdrawals and transfers by caller supplied key
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS IdempotencyKeys (
+                    user_id integer NOT NULL REFERENCES Users(user_id),
+                    idempotency_key varchar(100) NOT NULL,
+                    operation varchar(20) NOT NULL,
+                    request varchar(200) NOT NULL,
+                    tx_id uuid,
+                    result text,
+                    created_on TIMESTAMP NOT NULL,
+                    PRIMARY KEY (user_id, idempotency_key)
+                );""")
+
+            # One row per netting run
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS FxBatches (
+                    batch_id SERIAL PRIMARY KEY,
+                    started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    orders integer,
+                    rejected integer,
+                    balance_updates integer,
+                    ledger_rows integer
+                );""")
+
+            # Months of Transactions moved to Parquet files by archive.py
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS ArchivedMonths (
+                    month DATE PRIMARY KEY,
+                    path varchar(500) NOT NULL,
+                    range_size integer NOT NULL,
+                    transactions bigint NOT NULL,
+                    archived_on TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                );""")
+
+            # Net flow per account of every transaction below high_water, one row per account range
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS ReconcileRanges (
+                    first_id integer PRIMARY KEY,
+                    last_id integer NOT NULL,
+                    high_water uuid NOT NULL,
+                    nets bytea NOT NULL,
+                    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                );""")
 
             conn.commit()
             logger.info("Database tables created successfully")
@@ -127,6 +862,158 @@ def create_tables():
             release_conn(conn)
 
 
+def _create_views(cur):
+    '''Readable views of Accounts and Transactions with currency codes and type names'''
+    cur.execute("""
+        CREATE OR REPLACE VIEW AccountDetails AS
+        SELECT a.user_id, a.account_id, c.currency_code, a.balance, a.created_on, a.is_active
+        FROM Accounts a JOIN Currencies c USING (currency_id);""")
+
+    cur.execute("""
+        CREATE OR REPLACE VIEW TransactionDetails AS
+        SELECT t.tx_time, t.tx_id, tt.name AS type, t.from_user_id, t.from_account_id,
+               t.to_user_id, t.to_account_id, t.amount, c.currency_code
+        FROM Transactions t
+        JOIN TransactionTypes tt USING (type_id)
+        LEFT JOIN Currencies c USING (currency_id);""")
+
+
+def migrate_to_minor_units():
+    '''
+    Converts an existing database from DECIMAL amounts to integer minor units.
+
+    Adds minor_unit and symbol to Currencies, then rewrites Accounts.balance
+    and Transactions.amount as BIGINT scaled by each currency's exponent.
+    Does nothing for columns that are already BIGINT.
+    '''
+    conn = connect_to_db()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("ALTER TABLE Currencies ADD COLUMN IF NOT EXISTS minor_unit SMALLINT NOT NULL DEFAULT 2")
+            cur.execute("ALTER TABLE Currencies ADD COLUMN IF NOT EXISTS symbol varchar(5)")
+
+            for code, (exponent, symbol) in DEFAULT_CURRENCIES.items():
+                cur.execute("UPDATE Currencies SET minor_unit = %s, symbol = COALESCE(symbol, %s) WHERE currency_code = %s",
+                            (exponent, symbol or None, code))
+
+            for table, column in (("Accounts", "balance"), ("Transactions", "amount")):
+                cur.execute("SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+                            (table.lower(), column))
+                rows = cur.fetchone()
+
+                if not rows or rows[0] == "bigint":
+                    continue
+
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {column}_minor BIGINT")
+                cur.execute(f"""UPDATE {table} t SET {column}_minor = round(t.{column} * power(10, COALESCE(
+                                (SELECT c.minor_unit FROM Currencies c WHERE c.currency_code = t.currency_code LIMIT 1), 2)))""")
+                cur.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+                cur.execute(f"ALTER TABLE {table} RENAME COLUMN {column}_minor TO {column}")
+                cur.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL")
+                logger.info(f"Converted {table}.{column} to minor units")
+
+            cur.execute("ALTER TABLE Accounts ALTER COLUMN balance SET DEFAULT 0")
+
+        conn.commit()
+        load_currency_table()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error migrating to minor units: {e}")
+        raise
+    finally:
+        release_conn(conn)
+
+
+def migrate_to_smallint_codes():
+    '''
+    Replaces the varchar currency_code and type columns of Accounts and
+    Transactions with smallint ids.
+
+    Gives Currencies a currency_id primary key, adds any type names missing
+    from TransactionTypes, fills the new columns, drops the old ones and
+    creates the AccountDetails and TransactionDetails views. Run it after
+    create_tables. Does nothing when Accounts already has currency_id.
+    '''
+    conn = connect_to_db()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'accounts' AND column_name = 'currency_id'")
+            if not cur.fetchone():
+                cur.execute("UPDATE Currencies SET currency_code = trim(currency_code)")
+                cur.execute("ALTER TABLE Currencies ADD COLUMN currency_id SMALLSERIAL")
+                cur.execute("ALTER TABLE Currencies ADD PRIMARY KEY (currency_id)")
+                cur.execute("ALTER TABLE Currencies ADD UNIQUE (currency_code)")
+
+                cur.execute("""INSERT INTO TransactionTypes (type_id, name)
+                               SELECT (SELECT MAX(type_id) FROM TransactionTypes) + row_number() OVER (ORDER BY type), type
+                               FROM (SELECT DISTINCT type FROM Transactions
+                                     WHERE type NOT IN (SELECT name FROM TransactionTypes)) missing""")
+
+                cur.execute("ALTER TABLE Accounts ADD COLUMN currency_id SMALLINT REFERENCES Currencies(currency_id)")
+                cur.execute("UPDATE Accounts a SET currency_id = c.currency_id FROM Currencies c " \
+                            "WHERE c.currency_code = trim(a.currency_code)")
+                cur.execute("ALTER TABLE Accounts DROP COLUMN currency_code")
+                cur.execute("ALTER TABLE Accounts ALTER COLUMN currency_id SET NOT NULL")
+                cur.execute("ALTER TABLE Accounts ADD UNIQUE (user_id, currency_id)")
+
+                cur.execute("ALTER TABLE Transactions ADD COLUMN type_id SMALLINT REFERENCES TransactionTypes(type_id)")
+                cur.execute("ALTER TABLE Transactions ADD COLUMN currency_id SMALLINT REFERENCES Currencies(currency_id)")
+                cur.execute("""UPDATE Transactions t SET type_id = tt.type_id,
+                                      currency_id = (SELECT c.currency_id FROM Currencies c
+                                                     WHERE c.currency_code = trim(t.currency_code))
+                               FROM TransactionTypes tt WHERE tt.name = t.type""")
+                cur.execute("ALTER TABLE Transactions DROP COLUMN type")
+                cur.execute("ALTER TABLE Transactions DROP COLUMN currency_code")
+                cur.execute("ALTER TABLE Transactions ALTER COLUMN type_id SET NOT NULL")
+                logger.info("Replaced currency_code and type with smallint ids")
+
+            _create_views(cur)
+
+        conn.commit()
+        load_currency_table()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error migrating to smallint codes: {e}")
+        raise
+    finally:
+        release_conn(conn)
+
+
+def migrate_tx_ids():
+    '''
+    Converts Transactions.tx_id from varchar to a UUIDv7 primary key.
+
+    The old ids are kept in legacy_tx_id. New ids are stamped with each
+    row's tx_time so they sort in time order. Does nothing when tx_id is
+    already a uuid.
+    '''
+    conn = connect_to_db()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT data_type FROM information_schema.columns " \
+                        "WHERE table_name = 'transactions' AND column_name = 'tx_id'")
+            rows = cur.fetchone()
+
+            if rows and rows[0] != "uuid":
+                cur.execute("ALTER TABLE Transactions RENAME COLUMN tx_id TO legacy_tx_id")
+                cur.execute("ALTER TABLE Transactions ADD COLUMN tx_id uuid")
+                cur.execute("UPDATE Transactions SET tx_id = uuid_v7(COALESCE(tx_time, now()))")
+                cur.execute("ALTER TABLE Transactions ALTER COLUMN tx_id SET DEFAULT uuid_v7()")
+                cur.execute("ALTER TABLE Transactions ADD PRIMARY KEY (tx_id)")
+                logger.info("Converted Transactions.tx_id to UUIDv7")
+
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error migrating transaction ids: {e}")
+        raise
+    finally:
+        release_conn(conn)
+
+
 '''
 Helper functions
 '''
@@ -136,7 +1023,7 @@ def validate_amount(amount):
 
     Args:
 
-        amount: the currency amount entered
+        amount: the currency amount entered, in integer minor units
 
     
     Result:
@@ -144,38 +1031,283 @@ def validate_amount(amount):
 
         Invalid amount if not
     '''
-    if amount > 0:
+    if isinstance(amount, int) and amount > 0:
         return True
     else:
         return "Please input valid amount"
-    
+
+
+'''
+Money
+
+Amounts are integers in the currency's minor unit (cents for USD, yen for
+JPY). The exponent and symbol of each currency come from the Currencies
+table, with DEFAULT_CURRENCIES used until it is loaded or for codes it
+doesn't have.
+'''
+# currency_code: (minor unit exponent, symbol)
+DEFAULT_CURRENCIES = {
+    'USD': (2, '$'),
+    'EUR': (2, 'E'),
+    'GBP': (2, 'P'),
+    'JPY': (0, 'Y'),
+    'KRW': (0, ''),
+    'BHD': (3, ''),
+    'KWD': (3, ''),
+}
+DEFAULT_EXPONENT = 2
+
+# Exchange rates are fixed-point integers: rate * RATE_SCALE
+RATE_SCALE = 10 ** 9
+
+currency_table = None
+currency_ids = None
+
+# Transactions.type_id of each transaction type. Append only, the ids are stored
+TX_TYPES = {
+    "Deposit": 1,
+    "Withdraw": 2,
+    "Transfer": 3,
+    "Conversion": 4,
+    "Interest": 5,
+    "Fee": 6,
+    "FX Net": 7,
+}
+TX_TYPE_NAMES = {type_id: name for name, type_id in TX_TYPES.items()}
+
+
+def load_currency_table():
+    '''
+    Loads the exponent and symbol of every currency from the Currencies table
+
+    Also loads currency_ids, the currency_id of every currency_code.
+
+    Returns:
+        Dictionary of currency_code to (exponent, symbol)
+    '''
+    global currency_table, currency_ids
+
+    table = dict(DEFAULT_CURRENCIES)
+    ids = {}
+    conn = None
+    try:
+        conn = connect_to_db()
+        with conn.cursor() as cur:
+            cur.execute("SELECT currency_code, minor_unit, symbol, currency_id FROM Currencies")
+            for code, minor_unit, symbol, currency_id in cur.fetchall():
+                default_exponent, default_symbol = table.get(code.strip(), (DEFAULT_EXPONENT, ''))
+                table[code.strip()] = (
+                    minor_unit if minor_unit is not None else default_exponent,
+                    symbol or default_symbol
+                )
+                ids[code.strip()] = currency_id
+        conn.commit()
+    except psycopg2.pool.PoolError:
+        # An exhausted pool is not a missing table. Caching the defaults here would
+        # leave currency_ids empty until the next reload
+        raise
+    except Exception as e:
+        logger.error(f"Unable to load currency table, using defaults: {e}")
+    finally:
+        release_conn(conn)
+
+    currency_table = table
+    currency_ids = ids
+    return table
+
+
+def get_currency_id(currency_code):
+    '''
+    Gets the smallint id Accounts and Transactions store for a currency
+
+    Args:
+        currency_code: Currency code
+
+    Returns:
+        currency_id from the Currencies table
+    '''
+    if currency_ids is None or currency_code not in currency_ids:
+        load_currency_table()
+
+    if currency_code not in currency_ids:
+        raise ValueError(f"Unknown currency: {currency_code}")
+    return currency_ids[currency_code]
+
+
+def get_currency(currency_code):
+    '''
+    Gets the exponent and symbol of a currency
+
+    Args:
+        currency_code: Currency code
+
+    Returns:
+        Tuple of (exponent, symbol)
+    '''
+    table = currency_table if currency_table is not None else load_currency_table()
+    return table.get(currency_code, DEFAULT_CURRENCIES.get(currency_code, (DEFAULT_EXPONENT, '')))
+
+
+def parse_amount(text, currency_code):
+    '''
+    Parses a user entered amount into integer minor units without
+    going through float
+
+    Args:
+        text: Amount as typed, e.g "12.5"
+        currency_code: Currency of the amount
+
+    Returns:
+        Integer amount in minor units
+
+    Raises:
+        ValueError if the text isn't a valid amount for the currency
+    '''
+    exponent, _ = get_currency(currency_code)
+    text = str(text).strip().replace(",", "")
+
+    if not re.fullmatch(r"\d+(\.\d*)?|\.\d+", text):
+        raise ValueError(f"Invalid amount: {text}")
+
+    whole, _, fraction = text.partition(".")
+    if len(fraction) > exponent:
+        raise ValueError(f"{currency_code} amounts can't have more than {exponent} decimal places")
+
+    return int(whole or "0") * 10 ** exponent + int(fraction.ljust(exponent, "0") or "0")
+
+
+def round_div(numerator, denominator):
+    '''
+    Integer division rounded half to even (banker's rounding)
+
+    Args:
+        numerator: Integer numerator
+        denominator: Positive integer denominator
+
+    Returns:
+        Rounded integer quotient
+    '''
+    quotient, remainder = divmod(numerator, denominator)
+    twice = 2 * remainder
+
+    if twice > denominator or (twice == denominator and quotient % 2 == 1):
+        quotient += 1
+    return quotient
+
+
+def rate_to_fixed(rate):
+    '''Converts a rate from the API into a fixed-point integer'''
+    return round(rate * RATE_SCALE)
+
+
+def convert_minor(amount, rate_fixed, from_currency, to_currency):
+    '''
+    Converts an amount between currencies with integer arithmetic
+
+    Args:
+        amount: Integer amount in from_currency minor units
+        rate_fixed: Units of to_currency per unit of from_currency, times RATE_SCALE
+        from_currency: Currency of amount
+        to_currency: Currency to convert to
+
+    Returns:
+        Integer amount in to_currency minor units, rounded half to even
+    '''
+    from_exponent, _ = get_currency(from_currency)
+    to_exponent, _ = get_currency(to_currency)
+
+    numerator = amount * rate_fixed * 10 ** to_exponent
+    denominator = RATE_SCALE * 10 ** from_exponent
+    return round_div(numerator, denominator)
+
 
 def format_currency(amount, currency_code):
     '''
     Format currency according to its code
 
     Args:
-        amount: Amount of currency
+        amount: Amount of currency in integer minor units
 
         currency code: Shows the currency we're working we
 
     Result:
         A string format of the currency in its base format
     '''
+    exponent, symbol = get_currency(currency_code)
+    sign = "-" if amount < 0 else ""
+    whole, fraction = divmod(abs(int(amount)), 10 ** exponent)
 
-    currency_symbols = {
-        'USD': '$',
-        'EUR': 'E',
-        'GBP': 'P',
-        'JPY': 'Y'
-    }
+    if exponent == 0:
+        return f"{sign}{symbol}{whole}"
+    else:
+        return f"{sign}{symbol}{whole}.{fraction:0{exponent}d}"
 
-    symbol = currency_symbols.get(currency_code, '')
-    
-    if currency_code == 'JPY':
-        return f"{symbol}{int(amount)}"
+
+'''
+Transaction ids
+
+UUIDv7: 48 bits of Unix milliseconds, then a 12-bit counter that keeps the
+ids of one process increasing within a millisecond, then 62 random bits.
+New ids land at the right edge of the Transactions primary key instead of
+at random pages. Rows written by SQL get theirs from uuid_v7() in the
+database.
+'''
+_tx_id_lock = threading.Lock()
+_tx_id_last_ms = 0
+_tx_id_counter = 0
+
+
+def new_tx_id(at=None, rng=None):
+    '''
+    Makes a time-ordered transaction id
+
+    Args:
+        at: Datetime to stamp the id with, e.g a backdated tx_time. Defaults to now
+        rng: random.Random for reproducible ids, e.g in seed_data
+
+    Returns:
+        UUIDv7 string
+    '''
+    global _tx_id_last_ms, _tx_id_counter
+
+    if at is not None:
+        ms = int(at.timestamp() * 1000)
+        counter = rng.getrandbits(12) if rng else random.getrandbits(12)
     else:
-        return f"{symbol}{amount:.2f}"
+        with _tx_id_lock:
+            ms = time.time_ns() // 1_000_000
+            if ms <= _tx_id_last_ms:
+                # Same millisecond or the clock went back: keep counting from the last id
+                ms = _tx_id_last_ms
+                _tx_id_counter += 1
+                if _tx_id_counter > 0xFFF:
+                    ms += 1
+                    _tx_id_counter = 0
+            else:
+                _tx_id_counter = 0
+            _tx_id_last_ms = ms
+            counter = _tx_id_counter
+
+    tail = rng.getrandbits(62) if rng else int.from_bytes(os.urandom(8), "big") >> 2
+    value = (ms & (2 ** 48 - 1)) << 80 | 0x7 << 76 | counter << 64 | 0b10 << 62 | tail
+    return str(uuid.UUID(int=value))
+
+
+def tx_id_floor(at):
+    '''
+    Gets the smallest UUIDv7 of a millisecond
+
+    Every id made at or after at compares greater or equal, every id made
+    before it compares less, in Python and in PostgreSQL.
+
+    Args:
+        at: Datetime of the boundary
+
+    Returns:
+        UUIDv7 string
+    '''
+    ms = int(at.timestamp() * 1000)
+    return str(uuid.UUID(int=(ms & (2 ** 48 - 1)) << 80 | 0x7 << 76 | 0b10 << 62))
 
 
 def secure_password(password):
@@ -210,28 +1342,3 @@ def verify_password(password_hash, password_attempt):
         return True
     else:
         return False
-    
-    # API functions
-def fetch_exchange_rate():
-    '''
-    Fetches exchange rates from the API
-    '''
-    import requests
-    from requests.structures import CaseInsensitiveDict
-
-    API_KEY = os.getenv("api_key")
-
-    url = "https://api.freecurrencyapi.com/v1/latest?"
-    headers = CaseInsensitiveDict()
-    headers["apikey"] = API_KEY
-
-
-    resp = requests.get(url, headers=headers)
-
-    if resp.status_code == 200:
-
-        data = resp.json()
-
-        return data
-    else:
-        return "No data found"